@@ -37,6 +37,26 @@ information about returned HTTP headers.   If any errors occur
 
 The cache does not record HTTP errors.  Only the results of 
 successful requests (200 OK) are stored.
+
+With memory_maxbytes set, each server process also keeps small,
+recently used results in memory, in front of the files on disk.
+A hit there returns a MemoryCacheFile, which has the same info(),
+geturl() and getcode() methods.
+
+An expired result can still be used for a while. Within the
+stale_while_revalidate window it's returned right away while a
+background thread in one of the server processes gets a new copy.
+Within the stale_if_error window it's returned if the service can't
+be reached or fails with a 5xx error.
+
+ResponseCache works the other way around. It memoizes the responses
+of a service in the process which implements it, and is passed to
+the service decorator:
+
+    @simple_service("GET", "http://myservices.com/bookprice",
+                    cache=ResponseCache(expires=60, key=["title"]))
+    def bookprice(title):
+        ...
 """
 
 import urllib, urllib2
@@ -46,47 +66,381 @@ import sys
 import base64
 import hashlib
 import cPickle as pickle
+import struct
+import mmap
 import time
+import fcntl
+import sqlite3
+import httplib
+import thread
+import threading
+from cStringIO import StringIO
+from email.utils import parsedate_tz, mktime_tz
 
+from akara import logger
 from akara import registry
 from akara import global_config
 
 # File object returned to clients on cache hit.  A real file, but with an info() method
 # to mimic that operation on file-like objects returned by urlopen().
+# The file position is at the start of the body, which runs to the end
+# of the file, so the server can send it with sendfile().
 
 class CacheFile(file):
     def __init__(self,*args, **kwargs):
         file.__init__(self,*args,**kwargs)
-        self.headers = None
+        self._headers = None
+        self._header_bytes = None
         self.code = 200
         self.url = None
         self.msg = "OK"
+        self.body_offset = 0
+        self.body_length = 0
+    # The headers are only parsed if they're used
+    def _get_headers(self):
+        if self._headers is None and self._header_bytes is not None:
+            self._headers = _parse_headers(self._header_bytes)
+        return self._headers
+    def _set_headers(self, headers):
+        self._headers = headers
+    headers = property(_get_headers, _set_headers)
     def getcode(self):
         return self.code
     def geturl(self):
         return self.url
     def info(self):
         return self.headers
+    def body(self):
+        """Return the body as a read-only buffer over a memory map of the file
+
+        Nothing is read until the buffer is used.
+        """
+        if not self.body_length:
+            return ""
+        m = mmap.mmap(self.fileno(), 0, access=mmap.ACCESS_READ)
+        return buffer(m, self.body_offset, self.body_length)
+
+# The files written by 'cache' start with a fixed-size record:
+#
+#   magic, format version, flags, HTTP status code,
+#   the time the response was stored, its lifetime in seconds,
+#   the SHA-1 digest of the query string,
+#   the lengths of the URL, of the headers and of the body
+#
+# followed by the URL, the response headers as they were received,
+# and the body. Files from older versions of Akara start with a
+# pickled (query, timestamp, url, headers) tuple instead. They are
+# still read, and replaced as they expire.
+
+CACHE_FILE_MAGIC = "AKcf"
+CACHE_FILE_VERSION = 1
+_RECORD = struct.Struct("!4sBBHdd20sIIQ")
+_HAS_VALIDATOR = 1
+
+def _header_bytes(headers):
+    lines = getattr(headers, "headers", None)
+    if lines is None:
+        lines = ["%s: %s\r\n" % item for item in headers.items()]
+    return "".join(lines)
+
+def _parse_headers(data):
+    headers = httplib.HTTPMessage(StringIO(data))
+    headers.fp = None
+    return headers
+
+# Header fields which a 304 response doesn't update in the stored
+# response, as they describe the stored body or the connection
+_NOT_UPDATED_BY_304 = ("content-length", "content-encoding", "content-range",
+                       "transfer-encoding", "connection", "keep-alive")
+
+def _update_headers(headers, update):
+    """Update stored response headers from those of a 304 response
+
+    As in RFC 7234 section 4.3.4, each field in the 304 response
+    replaces all of the stored fields with that name.
+    """
+    if update is None:
+        return headers
+    if getattr(update, "headers", None) is None:
+        update = _parse_headers(_header_bytes(update) + "\r\n")
+    names = set(name.lower() for name in update.keys()) - set(_NOT_UPDATED_BY_304)
+    if not names:
+        return headers
+    lines = []
+    for message, use in ((headers, False), (update, True)):
+        wanted = False
+        for line in message.headers:
+            # Continuation lines go with the field before them
+            if line[:1] not in " \t":
+                wanted = (line.split(":", 1)[0].strip().lower() in names) == use
+            if wanted:
+                lines.append(line)
+    return _parse_headers("".join(lines) + "\r\n")
+
+def _write_record(f, flags, code, timestamp, lifetime, digest, url, header_bytes, body_length):
+    f.write(_RECORD.pack(CACHE_FILE_MAGIC, CACHE_FILE_VERSION, flags, code,
+                         timestamp, lifetime, digest,
+                         len(url), len(header_bytes), body_length))
+    f.write(url)
+    f.write(header_bytes)
+
+def _read_record(f, size):
+    """Read the record at the start of a cache file into the CacheFile
+
+    Returns the query digest, lifetime and flags. Raises ValueError
+    if the file isn't in this format or is incomplete.
+    """
+    data = f.read(_RECORD.size)
+    if len(data) != _RECORD.size:
+        raise ValueError("Truncated cache file")
+    (magic, version, flags, code, timestamp, lifetime, digest,
+     url_length, headers_length, body_length) = _RECORD.unpack(data)
+    if magic != CACHE_FILE_MAGIC or version != CACHE_FILE_VERSION:
+        raise ValueError("Not a version %d cache file" % (CACHE_FILE_VERSION,))
+    data = f.read(url_length + headers_length)
+    body_offset = _RECORD.size + url_length + headers_length
+    if body_offset + body_length != size:
+        raise ValueError("Truncated cache file")
+    f.url = data[:url_length]
+    f._header_bytes = data[url_length:]
+    f.code = code
+    f.msg = httplib.responses.get(code, "OK")
+    f.body_offset = body_offset
+    f.body_length = body_length
+    return digest, lifetime, flags
+
+# File-like object returned on a hit in the in-memory tier.  cStringIO objects
+# can't be subclassed, so this wraps one.
+
+class MemoryCacheFile(object):
+    def __init__(self, data, url, headers):
+        self._f = f = StringIO(data)
+        self.read = f.read
+        self.readline = f.readline
+        self.readlines = f.readlines
+        self.close = f.close
+        self.headers = headers
+        self.code = 200
+        self.url = url
+        self.msg = "OK"
+    def __iter__(self):
+        return iter(self._f)
+    def getcode(self):
+        return self.code
+    def geturl(self):
+        return self.url
+    def info(self):
+        return self.headers
+
+class _CacheIndex(object):
+    """The size, last access time and expiry time of each file in a cache
+
+    The index is an sqlite database in the cache directory, shared by
+    all of the server processes. It also keeps the total number of
+    entries and bytes, so adding an entry can remove expired entries
+    and then the least recently used ones until the cache is back
+    within 'maxentries' and 'maxbytes' (None means no limit) without
+    listing the directory. Each update is an sqlite transaction, which
+    is safe across processes.
+
+    Entries are named by the hex digest which also names the file,
+    as "<cachedir>/<first 2 digits>/<the rest>.p". Files already in the
+    directory when the index is made are added to it.
+
+    To keep hits cheap, the access time is only written when it is
+    more than ATIME_RESOLUTION seconds old.
+    """
+    ATIME_RESOLUTION = 10.0
+    # Remove at most this many expired entries on each add
+    EXPIRED_PER_ADD = 16
+
+    def __init__(self, cachedir, maxentries=None, maxbytes=None):
+        self.cachedir = cachedir
+        self.filename = os.path.join(cachedir, "index.sqlite")
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self._local = threading.local()
+
+    def _connect(self):
+        # An sqlite connection can't be used by a forked child or
+        # another thread
+        local = self._local
+        if getattr(local, "pid", None) == os.getpid():
+            return local.db
+        db = sqlite3.connect(self.filename, timeout=30, isolation_level=None)
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if not db.execute("SELECT count(*) FROM sqlite_master "
+                              "WHERE name = 'entries'").fetchone()[0]:
+                db.execute("CREATE TABLE entries (identifier TEXT PRIMARY KEY, "
+                           "size INTEGER, atime REAL, expires REAL)")
+                db.execute("CREATE INDEX entries_atime ON entries (atime)")
+                db.execute("CREATE INDEX entries_expires ON entries (expires)")
+                db.execute("CREATE TABLE totals (entries INTEGER, bytes INTEGER)")
+                db.execute("INSERT INTO totals VALUES (0, 0)")
+                self._add_existing(db)
+        except:
+            db.execute("ROLLBACK")
+            db.close()
+            raise
+        db.execute("COMMIT")
+        local.db = db
+        local.pid = os.getpid()
+        return db
+
+    def _add_existing(self, db):
+        # The expiry time isn't known without reading the file. The
+        # cache checks it anyway when the entry is used.
+        entries = nbytes = 0
+        for subdir in os.listdir(self.cachedir):
+            path = os.path.join(self.cachedir, subdir)
+            if len(subdir) != 2 or not os.path.isdir(path):
+                continue
+            for name in os.listdir(path):
+                if not name.endswith(".p"):
+                    continue
+                st = os.stat(os.path.join(path, name))
+                db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, NULL)",
+                           (subdir + name[:-2], st.st_size, st.st_mtime))
+                entries += 1
+                nbytes += st.st_size
+        db.execute("UPDATE totals SET entries = ?, bytes = ?", (entries, nbytes))
+
+    def _filename(self, identifier):
+        return os.path.join(self.cachedir, identifier[:2], identifier[2:] + ".p")
+
+    def _remove(self, db, identifier, size):
+        db.execute("DELETE FROM entries WHERE identifier = ?", (identifier,))
+        db.execute("UPDATE totals SET entries = entries - 1, bytes = bytes - ?", (size,))
+        try:
+            os.remove(self._filename(identifier))
+        except OSError:
+            pass   # Ignore.  If the files don't exist, who cares?
+
+    def _over_limit(self, db):
+        entries, nbytes = db.execute("SELECT entries, bytes FROM totals").fetchone()
+        return ((self.maxentries is not None and entries > self.maxentries) or
+                (self.maxbytes is not None and nbytes > self.maxbytes))
+
+    def add(self, identifier, size, expires_at):
+        "Record a new cache file, and remove others to make room for it"
+        db = self._connect()
+        now = time.time()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT size FROM entries WHERE identifier = ?",
+                             (identifier,)).fetchone()
+            if row is None:
+                db.execute("UPDATE totals SET entries = entries + 1, bytes = bytes + ?",
+                           (size,))
+            else:
+                db.execute("UPDATE totals SET bytes = bytes + ?", (size - row[0],))
+            db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)",
+                       (identifier, size, now, expires_at))
+
+            expired = db.execute("SELECT identifier, size FROM entries "
+                                 "WHERE expires <= ? LIMIT ?",
+                                 (now, self.EXPIRED_PER_ADD)).fetchall()
+            for victim, victim_size in expired:
+                self._remove(db, victim, victim_size)
+            while self._over_limit(db):
+                row = db.execute("SELECT identifier, size FROM entries "
+                                 "WHERE identifier != ? ORDER BY atime LIMIT 1",
+                                 (identifier,)).fetchone()
+                if row is None:
+                    break
+                self._remove(db, row[0], row[1])
+        except:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def touch(self, identifier):
+        "Record a hit"
+        db = self._connect()
+        now = time.time()
+        row = db.execute("SELECT atime FROM entries WHERE identifier = ?",
+                         (identifier,)).fetchone()
+        if row is not None and now - row[0] > self.ATIME_RESOLUTION:
+            db.execute("UPDATE entries SET atime = ? WHERE identifier = ?",
+                       (now, identifier))
+
+    def remove(self, identifier):
+        "Remove the cache file and its entry"
+        db = self._connect()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            row = db.execute("SELECT size FROM entries WHERE identifier = ?",
+                             (identifier,)).fetchone()
+            if row is None:
+                try:
+                    os.remove(self._filename(identifier))
+                except OSError:
+                    pass
+            else:
+                self._remove(db, identifier, row[0])
+        except:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def totals(self):
+        "Return the number of entries and their total size in bytes"
+        return tuple(self._connect().execute("SELECT entries, bytes FROM totals").fetchone())
+
+def _parse_http_date(s):
+    t = parsedate_tz(s)
+    if t is None:
+        return None
+    return mktime_tz(t)
+
+def _has_validator(headers):
+    return bool(headers.get("ETag") or headers.get("Last-Modified"))
 
-# Utility function to remove the oldest entry from a cache directory.
-# Look at the modification dates for metadata files
-def remove_oldest(cachedir):
-    files = (name for name in os.listdir(cachedir) if name.endswith(".p"))
-    paths = (os.path.join(cachedir,name) for name in files)
-    time_and_paths = ((os.path.getmtime(path),path) for path in paths)
-    oldest_time, path = min(time_and_paths)
-    
-    # Remove the oldest entry
-    os.remove(path)
-    
 class cache(object):
-    def __init__(self,ident,maxentries=65536,expires=15*60,opener=None):
+    def __init__(self,ident,maxentries=65536,expires=15*60,opener=None,
+                 single_flight=False,single_flight_timeout=30,maxbytes=None,
+                 memory_maxbytes=0,memory_maxitem=64*1024,
+                 stale_while_revalidate=0,stale_if_error=0,
+                 http_expires=False,min_expires=0,max_expires=None):
         """Create a cache for another Akara service.
 
            ident is the Akara service ID
-           maxentries is the maximum number of cache entries (approximate)
+           maxentries is the maximum number of cache entries
            expires is the time in seconds after which entries expire
            opener is an alternative URL opener.  By default urllib2.urlopen is used.
+           single_flight - If True, when several server processes miss the same
+               entry at the same time, only one makes the request. The others
+               wait, up to single_flight_timeout seconds, and use its result.
+           maxbytes is the maximum total size of the cache files, or None
+               for no limit
+           memory_maxbytes is the maximum total size of the responses
+               each server process also keeps in memory. 0 turns this off.
+           memory_maxitem is the size of the largest response kept in memory
+           stale_while_revalidate is the time in seconds after an entry
+               expires during which it's still returned right away, while
+               one of the server processes gets a new copy in the background
+           stale_if_error is the time in seconds after an entry expires
+               during which it's returned if the service can't be reached
+               or returns a 5xx error
+           http_expires - If True, each response is kept for the time given
+               by its Cache-Control or Expires header, or 'expires' if it
+               has neither, but for at least min_expires and at most
+               max_expires seconds (None for no limit). A response with
+               "Cache-Control: no-store" isn't kept.
+
+        An expired entry with an ETag or Last-Modified header is checked
+        with a conditional request. If the service says it hasn't changed
+        the entry is used for another lifetime without being rewritten.
+
+        The entries are shared by all of the server processes. Once
+        there are too many, expired entries and then the least recently
+        used ones are removed.
+
+        The memory_hits, memory_misses, disk_hits, disk_misses, stale_hits,
+        stale_errors, refreshes and revalidations counters are for the
+        current process.
+        See also stats().
         """
 
         self.ident = ident
@@ -95,9 +449,31 @@ class cache(object):
         self.opener = opener
         self.maxentries = maxentries
         self.expires = expires
-        self.maxperdirectory = maxentries / 256
+        self.maxbytes = maxbytes
         self.serv = None
         self.initialized = False
+        self.single_flight = single_flight
+        self.single_flight_timeout = single_flight_timeout
+        self.flight = None
+        self.memory_maxitem = memory_maxitem
+        if memory_maxbytes:
+            self._memory = _LRU(maxbytes=memory_maxbytes)
+        else:
+            self._memory = None
+        self.stale_while_revalidate = stale_while_revalidate
+        self.stale_if_error = stale_if_error
+        self.http_expires = http_expires
+        self.min_expires = min_expires
+        self.max_expires = max_expires
+        self.refresh_flight = None
+        self.memory_hits = 0
+        self.memory_misses = 0
+        self.disk_hits = 0
+        self.disk_misses = 0
+        self.stale_hits = 0
+        self.stale_errors = 0
+        self.refreshes = 0
+        self.revalidations = 0
 
     # Internal method that locates the Akara service description and sets up a
     # base-URL for making requests.   This can not be done in __init__() since
@@ -138,11 +514,20 @@ class cache(object):
                 # Multiple server instances might enter here at the same time and try to create directory
                 pass
             assert os.path.exists(self.cachedir), "Failed to make module cache directory %s" % self.cachedir
+        self.index = _CacheIndex(self.cachedir, self.maxentries, self.maxbytes)
+
+    # How long past its expiry time an entry may still be used
+    def _stale_window(self):
+        return max(self.stale_while_revalidate, self.stale_if_error)
 
     # Method that initializes the cache if needed
     def _init_cache(self):
         self._find_service()
         self._make_cache()
+        if self.single_flight:
+            self.flight = SingleFlight(self.serv.path + ".locks", self.single_flight_timeout)
+        if self.stale_while_revalidate:
+            self.refresh_flight = SingleFlight(self.serv.path + ".refresh")
         self.initialized = True
 
     def get(self,**kwargs):
@@ -158,10 +543,6 @@ class cache(object):
         if not self.initialized:
             self._init_cache()
 
-        # This is a sanity check.  If the cache is gone, might have to rebuild it
-        if not os.path.exists(self.cachedir):
-            self._make_cache()
-
         #  Make a canonical query string from the arguments (guaranteed
         #  to be the same even if the keyword argumenst are specified in
         #  in an arbitrary order)
@@ -169,6 +550,17 @@ class cache(object):
         
         query = "&".join(name+"="+urllib.quote(str(value)) for name,value in sorted(kwargs.items()))
 
+        # Small, recently used responses may be in memory, which saves going to disk
+        if self._memory is not None:
+            entry = self._memory.get(query)
+            if entry is not None:
+                expires_at, url, headers, data = entry
+                if expires_at > time.time():
+                    self.memory_hits += 1
+                    return MemoryCacheFile(data, url, headers)
+                self._memory.remove(query)
+            self.memory_misses += 1
+
         # Take the query string and make a SHA hash key pair out of it.  The general idea here
         # is to come up with an identifier that has a reasonable number of bits, but which is extremely
         # unlikely to collide with other identifiers.  It would be extremely unlikely that the query
@@ -189,76 +581,389 @@ class cache(object):
 
         subdir = identifier[:2]
         filename = identifier[2:]
-
-        # Check for the existence of a cache subdirectory.  Make it if neeeded
         cache_subdir = os.path.join(self.cachedir,subdir)
-        if not os.path.exists(cache_subdir):
-            # Make the cache subdirectory if it doesn't exist
-            try:
-                os.mkdir(cache_subdir)
-            except OSError:
-                pass    # Here for possible race condition
-            assert os.path.exists(cache_subdir), "Failed to make directory %s" % cache_subdir
-            
-        # Check for existence of cache file
         cache_file= os.path.join(cache_subdir,filename+".p")
-        if os.path.exists(cache_file):
-            # A cache hit. Load the metadata file to get the cache information and return it.
-            f = CacheFile(cache_file,"rb")
-            metaquery,timestamp,url,headers = pickle.load(f)
-
-            # Check to make sure the query string exactly matches the meta data
-            # and that the cache data is not too old
-            if metaquery == query and (timestamp + self.expires > time.time()):
-                # A cache hit and the query matches.  Just return the file we opened.
-                # the file pointer should be set to imemdiately after the pickled
-                # metadata at the front
-                f.headers = headers
-                f.url = url
+
+        # Check for existence of cache file
+        now = time.time()
+        f, expires_at = self._lookup(identifier, cache_file, query, now)
+        if f is not None and now < expires_at:
+            self.disk_hits += 1
+            return f
+        self.disk_misses += 1
+        if f is not None and now < expires_at + self.stale_while_revalidate:
+            # Return the expired result now, and get a new one for
+            # the next caller
+            self.stale_hits += 1
+            self._refresh(identifier, cache_subdir, cache_file, query, f.headers)
+            return f
+
+        # Either a miss or an expired result. The expired one is kept for
+        # its validators, and in case the service fails and stale_if_error
+        # applies.
+        try:
+            new_f = self._get_fresh(identifier, cache_subdir, cache_file, query, f)
+        except (IOError, httplib.HTTPException), err:
+            # A 4xx from the service is an answer, not a failure
+            if (f is not None and now < expires_at + self.stale_if_error and
+                getattr(err, "code", 500) >= 500):
+                logger.warn("Unable to get %r from %r, using the expired result: %s" %
+                            (query, self.ident, err))
+                self.stale_errors += 1
                 return f
+            if f is not None:
+                f.close()
+            raise
+        if f is not None:
+            f.close()
+        return new_f
+
+    def _get_fresh(self, identifier, cache_subdir, cache_file, query, stale_f):
+        headers = None
+        if stale_f is not None:
+            headers = stale_f.headers
+        if self.flight is None:
+            return self._fetch(identifier, cache_subdir, cache_file, query, headers=headers)
 
-            # There was a cache hit, but the cache metadata is for a different query (a collision)
-            # or the timestamp is out of date.   We're going to remove the cache file and 
-            # proceed as if there was a cache miss
+        # Only one process fetches a given URL at a time. The others
+        # wait for it and then find the result in the cache.
+        lock = self.flight.acquire(identifier)
+        try:
+            now = time.time()
+            f, expires_at = self._lookup(identifier, cache_file, query, now)
+            if f is not None:
+                if now < expires_at:
+                    return f
+                f.close()
+            return self._fetch(identifier, cache_subdir, cache_file, query, headers=headers)
+        finally:
+            lock.release()
+
+    # Get a new copy of an expired entry in another thread. Only one server
+    # process at a time does this for a given entry; the others keep
+    # returning the expired one. The thread only makes an HTTP request and
+    # writes the cache file, which doesn't touch the akara.request and
+    # akara.response state of the request being handled.
+    def _refresh(self, identifier, cache_subdir, cache_file, query, headers):
+        lock = self.refresh_flight.try_acquire(identifier)
+        if lock is None:
+            return
+        self.refreshes += 1
+        t = threading.Thread(target=self._run_refresh,
+                             args=(lock, identifier, cache_subdir, cache_file, query, headers))
+        t.setDaemon(True)
+        t.start()
+
+    def _run_refresh(self, lock, identifier, cache_subdir, cache_file, query, headers):
+        try:
             try:
-                os.remove(cache_file)
-            except OSError:
-                pass   # Ignore.  If the files don't exist, who cares?
-            
+                self._fetch(identifier, cache_subdir, cache_file, query,
+                            keep=False, headers=headers)
+            except Exception:
+                logger.warn("Unable to refresh %r from %r" % (query, self.ident),
+                            exc_info=True)
+        finally:
+            lock.release()
+
+    def stats(self):
+        "Return the hit and miss counters for each tier, for this process"
+        stats = dict(memory_hits = self.memory_hits,
+                     memory_misses = self.memory_misses,
+                     disk_hits = self.disk_hits,
+                     disk_misses = self.disk_misses,
+                     stale_hits = self.stale_hits,
+                     stale_errors = self.stale_errors,
+                     refreshes = self.refreshes,
+                     revalidations = self.revalidations)
+        if self._memory is not None:
+            stats["memory_entries"] = len(self._memory)
+            stats["memory_bytes"] = self._memory.size
+        return stats
+
+    # How long a response stays fresh. With http_expires, that's from
+    # its Cache-Control or Expires header, limited to min_expires and
+    # max_expires. Returns None if the response can't be stored.
+    def _lifetime(self, headers):
+        if not self.http_expires:
+            return self.expires
+        lifetime = None
+        directives = {}
+        for directive in (headers.get("Cache-Control") or "").split(","):
+            name, sep, value = directive.partition("=")
+            directives[name.strip().lower()] = value.strip().strip('"')
+        if "no-store" in directives:
+            return None
+        if "no-cache" in directives or "private" in directives:
+            lifetime = 0
+        else:
+            # This is a shared cache, so s-maxage comes first
+            for name in ("s-maxage", "max-age"):
+                if name in directives:
+                    try:
+                        lifetime = max(int(directives[name]), 0)
+                    except ValueError:
+                        lifetime = 0
+                    break
+            else:
+                expires = headers.get("Expires")
+                if expires is not None:
+                    expires = _parse_http_date(expires)
+                    date = _parse_http_date(headers.get("Date") or "")
+                    if expires is None:
+                        # An invalid date means it has already expired
+                        lifetime = 0
+                    else:
+                        lifetime = max(expires - (date or time.time()), 0)
+        if lifetime is None:
+            lifetime = self.expires
+        lifetime = max(lifetime, self.min_expires)
+        if self.max_expires is not None:
+            lifetime = min(lifetime, self.max_expires)
+        return lifetime
+
+    # The time in the index after which an entry can't be used. Entries
+    # with validators can always be revalidated, so they are only
+    # removed to make room.
+    def _index_expires(self, headers, expires_at):
+        if _has_validator(headers):
+            return None
+        return expires_at + self._stale_window()
+
+    # Keep a response in memory if it's small enough. Returns the
+    # object to give to the client, or None if it wasn't kept.
+    def _remember(self, query, expires_at, url, headers, data):
+        if self._memory is None or len(data) > self.memory_maxitem:
+            return None
+        self._memory.put(query, (expires_at, url, headers, data), len(data))
+        return MemoryCacheFile(data, url, headers)
+
+    # Open a cache file, leaving it at the start of the body. Returns
+    # the file, the hex digest of its query, its lifetime and whether it
+    # can be revalidated. Raises ValueError for a damaged file.
+    def _open(self, cache_file):
+        f = CacheFile(cache_file,"rb")
+        size = os.fstat(f.fileno()).st_size
+        try:
+            try:
+                digest, lifetime, flags = _read_record(f, size)
+                return f, digest.encode("hex"), lifetime, bool(flags & _HAS_VALIDATOR)
+            except ValueError:
+                # Maybe written by an older Akara
+                f.seek(0)
+                if f.read(len(CACHE_FILE_MAGIC)) == CACHE_FILE_MAGIC:
+                    raise
+                f.seek(0)
+                try:
+                    metaquery,timestamp,f.url,f.headers = pickle.load(f)
+                except Exception:
+                    raise ValueError("Unreadable cache file")
+                f.body_offset = f.tell()
+                f.body_length = size - f.body_offset
+                return (f, hashlib.sha1(metaquery).hexdigest(),
+                        self._lifetime(f.headers) or 0, _has_validator(f.headers))
+        except:
+            f.close()
+            raise
+
+    # Returns the open cache file and the time it expires, or (None, None).
+    # The entry may have expired, but only by less than the stale windows
+    # or if it can be revalidated.
+    #
+    # An entry is fresh for its lifetime, counting from the modification
+    # time of the file, which is set to the time it was stored. When the
+    # service says an expired entry hasn't changed, it is stored again
+    # with the updated headers and lifetime.
+    def _lookup(self, identifier, cache_file, query, now):
+        try:
+            f, digest, lifetime, has_validator = self._open(cache_file)
+        except IOError:
+            return None, None
+        except ValueError:
+            # A damaged file. Treat it as a miss.
+            self.index.remove(identifier)
+            return None, None
+
+        # A cache hit. Check to make sure the query matches the one
+        # the file was stored for, and that the data is not too old
+        expires_at = os.fstat(f.fileno()).st_mtime + lifetime
+        if digest == identifier and (expires_at + self._stale_window() > now or
+                                     has_validator):
+            # A cache hit and the query matches.  Just return the file we opened.
+            # the file pointer is at the start of the body
+            self.index.touch(identifier)
+            if (self._memory is not None and expires_at > now and
+                f.body_length <= self.memory_maxitem):
+                data = f.read()
+                f.close()
+                f = self._remember(query, expires_at, f.url, f.headers, data)
+            return f, expires_at
+        f.close()
+
+        # There was a cache hit, but the cache metadata is for a different query (a collision)
+        # or the timestamp is out of date.   We're going to remove the cache file and 
+        # proceed as if there was a cache miss
+        self.index.remove(identifier)
+        return None, None
+
+    def _fetch(self, identifier, cache_subdir, cache_file, query, keep=True, headers=None):
         # Cache miss
         # On a miss, a GET request is issued using the cache opener object
         # (by default, urllib2.urlopen).  Any HTTP exceptions are left unhandled
         # for clients to deal with if they want (HTTP errors are not cached)
+        #
+        # 'headers' are those of the expired entry, if any. If it has an
+        # ETag or Last-Modified header, the request is conditional.
 
-        # Before adding a new cache entry. Check the number of entries in the cache subdirectory.
-        # If there are too many entries, remove the oldest entry to make room.
-        if len(os.listdir(cache_subdir)) >= self.maxperdirectory:
-            remove_oldest(cache_subdir)
+        # Check for the existence of a cache subdirectory.  Make it if neeeded
+        if not os.path.exists(cache_subdir):
+            # This is a sanity check.  If the cache is gone, might have to rebuild it
+            if not os.path.exists(self.cachedir):
+                self._make_cache()
+            # Make the cache subdirectory if it doesn't exist
+            try:
+                os.mkdir(cache_subdir)
+            except OSError:
+                pass    # Here for possible race condition
+            assert os.path.exists(cache_subdir), "Failed to make directory %s" % cache_subdir
 
         # Make an akara request
         url = self.baseurl + "?" + query
-        u = self.opener(url)
+        request = url
+        if headers is not None and _has_validator(headers):
+            request = urllib2.Request(url)
+            if headers.get("ETag"):
+                request.add_header("If-None-Match", headers.get("ETag"))
+            if headers.get("Last-Modified"):
+                request.add_header("If-Modified-Since", headers.get("Last-Modified"))
+        try:
+            u = self.opener(request)
+        except urllib2.HTTPError, err:
+            # urllib2 treats a 304 as an error
+            if err.code != 304 or request is url:
+                raise
+            return self._not_modified(identifier, cache_subdir, cache_file, query, keep,
+                                      err.info())
+        if getattr(u, "code", 200) == 304 and request is not url:
+            u.close()
+            return self._not_modified(identifier, cache_subdir, cache_file, query, keep,
+                                      u.info())
+
+        headers = u.info()
+        lifetime = self._lifetime(headers)
+        if lifetime is None:
+            # The service said not to store it
+            self.index.remove(identifier)
+            if keep:
+                return u
+            u.close()
+            return None
         
         # If successful, we'll make it here.  Read data from u and store in the cache
         # This is done by initially creating a file with a different filename, fully
         # populating it, and then renaming it to the correct cache file when done.
-        cache_tempfile = cache_file + ".%d" % os.getpid()
+        cache_tempfile = cache_file + ".%d.%d" % (os.getpid(), thread.get_ident())
         f = open(cache_tempfile,"wb")
-        pickle.dump((query,time.time(),url,u.info()),f,-1)
+        timestamp = time.time()
+        flags = 0
+        if _has_validator(headers):
+            flags |= _HAS_VALIDATOR
+        record = (flags, getattr(u, "code", None) or 200, timestamp, lifetime,
+                  hashlib.sha1(query).digest(), url, _header_bytes(headers))
+        # The body length is filled in at the end
+        _write_record(f, *(record + (0,)))
+        body_offset = f.tell()
 
-        # Write content into the file
+        # Write content into the file. Hold on to it as well, while it's
+        # small enough for the memory tier.
+        chunks = []
+        data_size = 0
         while True:
             chunk = u.read(65536)
             if not chunk: break
             f.write(chunk)
+            data_size += len(chunk)
+            if keep and self._memory is not None and data_size <= self.memory_maxitem:
+                chunks.append(chunk)
+        size = f.tell()
+        f.seek(0)
+        _write_record(f, *(record + (size - body_offset,)))
         f.close()
+        # _lookup counts the lifetime from the modification time
+        os.utime(cache_tempfile, (timestamp, timestamp))
 
-        # Rename the file, open, and return
+        # Rename the file, open, and return. Adding it to the index
+        # removes other entries if the cache is full.
         shutil.move(cache_tempfile, cache_file)
+        expires_at = timestamp + lifetime
+        self.index.add(identifier, size, self._index_expires(headers, expires_at))
+        if not keep:
+            return None
+
+        if self._memory is not None and data_size <= self.memory_maxitem:
+            return self._remember(query, expires_at, url, headers, "".join(chunks))
 
         # Return a file-like object back to the client
-        f = CacheFile(cache_file,"rb")
-        metaquery,timestamp,f.url,f.headers = pickle.load(f)
+        return self._open(cache_file)[0]
+
+    # The service says the expired entry is still good. Update the
+    # stored headers from those of the 304 response, which may also
+    # change its lifetime, and make it fresh again. The body is copied
+    # as it is.
+    def _not_modified(self, identifier, cache_subdir, cache_file, query, keep,
+                      response_headers):
+        self.revalidations += 1
+        try:
+            f, digest, lifetime, has_validator = self._open(cache_file)
+        except (IOError, ValueError):
+            # Removed or damaged in the meantime
+            return self._fetch(identifier, cache_subdir, cache_file, query, keep)
+        if digest != identifier:
+            f.close()
+            return self._fetch(identifier, cache_subdir, cache_file, query, keep)
+        headers = _update_headers(f.headers, response_headers)
+        lifetime = self._lifetime(headers)
+        if lifetime is None:
+            # The service now says not to store it. The open file still
+            # has the body.
+            self.index.remove(identifier)
+            if not keep:
+                f.close()
+                return None
+            f.headers = headers
+            return f
+
+        try:
+            cache_tempfile = cache_file + ".%d.%d" % (os.getpid(), thread.get_ident())
+            out = open(cache_tempfile, "wb")
+            try:
+                timestamp = time.time()
+                flags = 0
+                if _has_validator(headers):
+                    flags |= _HAS_VALIDATOR
+                _write_record(out, flags, f.code or 200, timestamp, lifetime,
+                              hashlib.sha1(query).digest(), f.url, _header_bytes(headers),
+                              f.body_length)
+                remaining = f.body_length
+                while remaining > 0:
+                    chunk = f.read(min(remaining, 65536))
+                    if not chunk:
+                        break
+                    out.write(chunk)
+                    remaining -= len(chunk)
+                size = out.tell()
+            finally:
+                out.close()
+            os.utime(cache_tempfile, (timestamp, timestamp))
+            shutil.move(cache_tempfile, cache_file)
+        finally:
+            f.close()
+
+        self.index.add(identifier, size, self._index_expires(headers, timestamp + lifetime))
+        if not keep:
+            return None
+        f, expires_at = self._lookup(identifier, cache_file, query, time.time())
+        if f is None:
+            return self._fetch(identifier, cache_subdir, cache_file, query, keep)
         return f
 
 
@@ -287,3 +992,359 @@ def make_named_cache(name):
         assert os.path.exists(cachedir), "Failed to make module cache directory %s" % cachedir
     return cachedir
 
+
+
+class _LRU(object):
+    """A dictionary which forgets the least recently used items
+
+    Items are removed once there are more than 'maxentries' of them or
+    their sizes add up to more than 'maxbytes'. None means no limit.
+    """
+    def __init__(self, maxentries=None, maxbytes=None):
+        self.maxentries = maxentries
+        self.maxbytes = maxbytes
+        self.size = 0
+        self._links = {}
+        # A circular doubly linked list of [prev, next, key, value, size]
+        # with the least recently used item just after the root
+        self._root = root = []
+        root[:] = [root, root, None, None, 0]
+
+    def __len__(self):
+        return len(self._links)
+
+    def __contains__(self, key):
+        return key in self._links
+
+    def get(self, key, default=None):
+        link = self._links.get(key)
+        if link is None:
+            return default
+        # Move it to the most recently used end
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+        root = self._root
+        last = root[0]
+        link[0] = last
+        link[1] = root
+        last[1] = root[0] = link
+        return link[3]
+
+    def put(self, key, value, size=0):
+        "Add an item. Returns False if it is too large to keep."
+        self.remove(key)
+        if self.maxbytes is not None and size > self.maxbytes:
+            return False
+        root = self._root
+        last = root[0]
+        link = [last, root, key, value, size]
+        last[1] = root[0] = link
+        self._links[key] = link
+        self.size += size
+        while ((self.maxentries is not None and len(self._links) > self.maxentries) or
+               (self.maxbytes is not None and self.size > self.maxbytes)):
+            self.remove(root[1][2])
+        return True
+
+    def remove(self, key):
+        link = self._links.pop(key, None)
+        if link is not None:
+            prev, next = link[0], link[1]
+            prev[1] = next
+            next[0] = prev
+            self.size -= link[4]
+
+
+class ResponseCache(object):
+    def __init__(self, expires=15*60, maxentries=1000, maxbytes=16*1024*1024,
+                 key=None, disk=None, disk_maxentries=65536,
+                 single_flight=False, single_flight_timeout=30, disk_maxbytes=None):
+        """Memoize the responses of a GET service. Use it like:
+
+            @simple_service("GET", "http://example.com/charbyname",
+                            cache=ResponseCache(expires=3600, key=["name"]))
+
+           expires is the time in seconds after which entries expire
+           maxentries is the maximum number of entries kept in memory
+           maxbytes is the maximum total size of the bodies kept in memory
+           key is the list of query parameter names which make up the
+               cache key. The default of None uses all of them.
+           disk is the name of a directory under the ModuleCache directory.
+               If given, responses are also stored there, where all of
+               the server processes can find them.
+           disk_maxentries is the maximum number of entries on disk
+           single_flight - If True, when several server processes miss the
+               same key at the same time, only one calls the service
+               function. The others wait, up to single_flight_timeout
+               seconds, and use the response it stored. Requires 'disk'.
+           disk_maxbytes is the maximum total size of the files on disk,
+               or None for no limit
+
+        Only successful (200 OK) responses with a complete body are
+        stored. The status, headers (including those from akara.response)
+        and body are returned as they were made. The hits, misses,
+        disk_hits and coalesced counters are for the current process.
+        """
+        self.expires = expires
+        if key is not None:
+            key = tuple(key)
+        self.key = key
+        self.disk = disk
+        self.disk_maxentries = disk_maxentries
+        self.disk_maxbytes = disk_maxbytes
+        self.cachedir = None
+        self.index = None
+        self._entries = _LRU(maxentries, maxbytes)
+        if single_flight:
+            if disk is None:
+                raise ValueError("single_flight requires a 'disk' cache")
+            self.flight = SingleFlight(disk + ".locks", single_flight_timeout)
+        else:
+            self.flight = None
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.coalesced = 0
+
+    def make_key(self, path, kwargs, routing_args=None):
+        "Make the cache key for a call to the service at 'path'"
+        if self.key is None:
+            items = sorted(kwargs.items())
+        else:
+            items = [(name, kwargs[name]) for name in self.key if name in kwargs]
+        query = urllib.urlencode(items, True)
+        if routing_args:
+            return "%s?%s#%s" % (path, query, urllib.urlencode(sorted(routing_args.items())))
+        return "%s?%s" % (path, query)
+
+    def get(self, key):
+        "Return the (status, headers, body) for the key, or None"
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > now:
+                self.hits += 1
+                return entry[1:]
+            self._entries.remove(key)
+        if self.disk is not None:
+            entry = self._disk_get(key, now)
+            if entry is not None:
+                self._entries.put(key, entry, len(entry[3]))
+                self.hits += 1
+                self.disk_hits += 1
+                return entry[1:]
+        self.misses += 1
+        return None
+
+    def get_or_lock(self, key):
+        """Return (response, None) for a hit and (None, lock) for a miss
+
+        With single_flight, the lock is held until its release() is
+        called, which must be done after the response is stored. If
+        another process stored the response while this one waited for
+        the lock, that's returned instead. Without single_flight the
+        lock is always None.
+        """
+        entry = self.get(key)
+        if entry is not None or self.flight is None:
+            return entry, None
+        lock = self.flight.acquire(key)
+        entry = self._disk_get(key, time.time())
+        if entry is None:
+            return None, lock
+        lock.release()
+        self._entries.put(key, entry, len(entry[3]))
+        self.coalesced += 1
+        return entry[1:], None
+
+    def put(self, key, status, headers, body):
+        "Store a response for the key"
+        entry = (time.time() + self.expires, status, list(headers), body)
+        self._entries.put(key, entry, len(body))
+        if self.disk is not None:
+            self._disk_put(key, entry)
+
+    def stats(self):
+        return dict(hits = self.hits,
+                    misses = self.misses,
+                    disk_hits = self.disk_hits,
+                    coalesced = self.coalesced,
+                    entries = len(self._entries),
+                    bytes = self._entries.size)
+
+    # The disk tier files are named from the SHA-1 of the key, like
+    # those of 'cache', but they still start with the pickled metadata
+    # (key, expiry time, status, headers), followed by the body. The
+    # binary record 'cache' uses is built around a urllib2 response;
+    # the headers here are the (name, value) list a service made.
+    def _disk_filename(self, key):
+        if self.cachedir is None:
+            self.cachedir = make_named_cache(self.disk)
+            self.index = _CacheIndex(self.cachedir, self.disk_maxentries,
+                                     self.disk_maxbytes)
+        identifier = hashlib.sha1(key).hexdigest()
+        cache_subdir = os.path.join(self.cachedir, identifier[:2])
+        return identifier, cache_subdir, os.path.join(cache_subdir, identifier[2:] + ".p")
+
+    def _disk_get(self, key, now):
+        identifier, cache_subdir, cache_file = self._disk_filename(key)
+        try:
+            f = open(cache_file, "rb")
+        except IOError:
+            return None
+        try:
+            try:
+                metakey, expires_at, status, headers = pickle.load(f)
+                body = f.read()
+            except (EOFError, ValueError, pickle.UnpicklingError):
+                # Partially written by an older process? Treat it as a miss.
+                metakey = None
+        finally:
+            f.close()
+        if metakey == key and expires_at > now:
+            self.index.touch(identifier)
+            return (expires_at, status, headers, body)
+        return None
+
+    def _disk_put(self, key, entry):
+        identifier, cache_subdir, cache_file = self._disk_filename(key)
+        if not os.path.exists(cache_subdir):
+            try:
+                os.mkdir(cache_subdir)
+            except OSError:
+                pass    # Here for possible race condition
+        expires_at, status, headers, body = entry
+        cache_tempfile = cache_file + ".%d" % os.getpid()
+        f = open(cache_tempfile, "wb")
+        try:
+            pickle.dump((key, expires_at, status, headers), f, -1)
+            f.write(body)
+            size = f.tell()
+        finally:
+            f.close()
+        shutil.move(cache_tempfile, cache_file)
+        self.index.add(identifier, size, expires_at)
+
+
+class _FlightLock(object):
+    def __init__(self, fd, filename):
+        self.fd = fd
+        self.filename = filename
+
+    def release(self):
+        "Let the next process in. Call this once the result is stored."
+        if self.fd is None:
+            return
+        # Remove the file while still holding the lock. Waiters check
+        # that the file they locked is still the one with this name.
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+        fcntl.flock(self.fd, fcntl.LOCK_UN)
+        os.close(self.fd)
+        self.fd = None
+
+
+class SingleFlight(object):
+    def __init__(self, name, timeout=30, poll_interval=0.05):
+        """Let only one server process at a time compute the result for a key
+
+           name is the name of a directory under the ModuleCache directory,
+               used for the lock files
+           timeout is the number of seconds to wait for the process which
+               is computing the result. After that, go ahead anyway.
+           poll_interval is the time in seconds between checks of the lock
+
+        When many processes want the same missing result at the same
+        time, one gets the lock and computes the result while the others
+        wait. Once the first one has stored the result it releases the
+        lock, and the others find the stored result:
+
+            lock = flight.acquire(key)
+            try:
+                result = lookup(key)
+                if result is None:
+                    result = compute(key)
+                    store(key, result)
+            finally:
+                lock.release()
+
+        which is what run() does.
+        """
+        self.name = name
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.lockdir = None
+        self.waits = 0
+        self.timeouts = 0
+
+    def _lock_filename(self, key):
+        if self.lockdir is None:
+            self.lockdir = make_named_cache(self.name)
+        return os.path.join(self.lockdir, hashlib.sha1(key).hexdigest() + ".lock")
+
+    # Returns the lock, or None if another process has it
+    def _lock(self, filename):
+        while True:
+            fd = os.open(filename, os.O_WRONLY | os.O_CREAT, 0666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                os.close(fd)
+                return None
+            # The previous holder may have removed the file before
+            # unlocking. Then someone else may have a lock on a new file.
+            try:
+                st = os.stat(filename)
+            except OSError:
+                st = None
+            fst = os.fstat(fd)
+            if st is not None and (st.st_dev, st.st_ino) == (fst.st_dev, fst.st_ino):
+                return _FlightLock(fd, filename)
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def acquire(self, key):
+        """Wait for, and get, the lock for the key.
+
+        Returns an object with a release() method. After a timeout the
+        lock isn't held, and release() does nothing.
+        """
+        filename = self._lock_filename(key)
+        deadline = None
+        while True:
+            lock = self._lock(filename)
+            if lock is not None:
+                return lock
+            if deadline is None:
+                self.waits += 1
+                deadline = time.time() + self.timeout
+            elif time.time() >= deadline:
+                self.timeouts += 1
+                return _FlightLock(None, filename)
+            time.sleep(self.poll_interval)
+
+    def try_acquire(self, key):
+        "Get the lock for the key if no other process has it, else return None"
+        return self._lock(self._lock_filename(key))
+
+    def run(self, key, lookup, compute):
+        """Return lookup(key) if not None, else compute(key)
+
+        Only one process at a time computes the result for a key. The
+        compute function must store the result where lookup() finds it.
+        """
+        result = lookup(key)
+        if result is not None:
+            return result
+        lock = self.acquire(key)
+        try:
+            # Someone else may have done the work while we waited
+            result = lookup(key)
+            if result is None:
+                result = compute(key)
+        finally:
+            lock.release()
+        return result
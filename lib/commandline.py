@@ -86,6 +86,38 @@ def status(args):
             print "PID is", pid, "and there is a process with that PID"
             # XXX try to connect to the server?
             print "Akara is running"
+            if getattr(args, "live", False):
+                live_status(settings["scoreboard_file"])
+
+def live_status(scoreboard_file):
+    from akara import scoreboard
+    print "Scoreboard file:", repr(scoreboard_file)
+    try:
+        status = scoreboard.read_scoreboard(scoreboard_file)
+    except (IOError, ValueError), err:
+        print "*** Cannot read the scoreboard:", err
+        raise SystemExit(1)
+    summary = scoreboard.summarize(status)
+    print "Uptime: %.0f seconds" % (summary["uptime"],)
+    print "Servers: %d busy, %d idle" % (summary["busy"], summary["idle"])
+    print "Total requests: %d (%.2f requests/second)" % (
+        summary["total_requests"], summary["requests_per_second"])
+    print "Total bytes sent:", summary["total_bytes"]
+    print
+    print "%5s %7s %5s %9s %9s  %s" % ("Slot", "PID", "State", "Requests", "Seconds", "Request")
+    for worker in summary["workers"]:
+        if worker["elapsed"] is None:
+            elapsed = request = ""
+        else:
+            elapsed = "%.3f" % (worker["elapsed"],)
+            request = worker["request"]
+        print "%5d %7d %5s %9d %9s  %s" % (worker["index"], worker["pid"], worker["state"],
+                                           worker["requests"], elapsed, request)
+    print
+    print ('States: "%s" starting, "%s" idle, "%s" busy, "%s" keep-alive, '
+           '"%s" notifying' %
+           (scoreboard.SLOT_STARTING, scoreboard.SLOT_IDLE, scoreboard.SLOT_BUSY,
+            scoreboard.SLOT_KEEPALIVE, scoreboard.SLOT_NOTIFY))
 
 
 def setup_config_file():
@@ -207,6 +239,8 @@ parser_restart = subparsers.add_parser("restart", help="restart an Akara server"
 parser_restart.set_defaults(func=restart)
 
 parser_status = subparsers.add_parser("status", help="display a status report")
+parser_status.add_argument("--live", dest="live", action="store_true",
+                           help="also report what each server process is doing")
 parser_status.set_defaults(func=status)
 
 parser_setup = subparsers.add_parser("setup", help="set up directories and files for Akara")
@@ -11,18 +11,19 @@ from akara.services import *
 from akara.pipeline import *
 from akara.registry import register_template, register_services, get_internal_service_url
 from akara import request, response
+from akara.caching import ResponseCache
 
 ## These are all errors in the simple_service definition.
 # They are caught in the server. Do them now because any
 # failures means the other services will not be registered
 try:
-    # Slashes are not (yet) allowed in the path
-    @simple_service("GET", "http://example.com/test_args", path="simple_service.with/slashes")
+    # Empty path segments are not allowed
+    @simple_service("GET", "http://example.com/test_args", path="simple_service.with//slashes")
     def spam():
         pass
-    raise AssertionError("simple_service.with/slashes was allowed")
+    raise AssertionError("simple_service.with//slashes was allowed")
 except ValueError, err:
-    assert "may not contain a '/'" in str(err), err
+    assert "invalid segment" in str(err), err
 
 
 try:
@@ -35,22 +36,22 @@ except ValueError, err:
     assert "only supports GET and POST methods" in str(err), err
 
 try:
-    # Slashes are not (yet) allowed in the path
-    @service("http://example.com/test_arg", path="service.with/slashes")
+    # Parameter segments must be well-formed
+    @service("http://example.com/test_arg", path="service.with/{slashes")
     def spam():
         pass
-    raise AssertionError("service.with/slashes was allowed")
+    raise AssertionError("service.with/{slashes was allowed")
 except ValueError, err:
-    assert "may not contain a '/'" in str(err), err
+    assert "invalid segment" in str(err), err
 
 try:
-    # Slashes are not (yet) allowed in the path
-    @method_dispatcher("http://example.come/mulimethod", "method_dispatcher.with/slashes")
+    # Parameter segments must be well-formed
+    @method_dispatcher("http://example.come/mulimethod", "method_dispatcher.with/{slashes")
     def spam():
         pass
-    raise AssertionError("method_dispatcher.with/slashes was allowed")
+    raise AssertionError("method_dispatcher.with/{slashes was allowed")
 except ValueError, err:
-    assert "may not contain a '/'" in str(err), err
+    assert "invalid segment" in str(err), err
 
 
 ## These services are called by the test script
@@ -162,6 +163,49 @@ def test_iterator():
     yield "When the hurlyburly's done,\n"
     yield "When the battle's lost and won.\n"
 
+# Generators can yield any of the types a simple_service can return
+@simple_service("GET", "http://example.com/test")
+def test_generator(count="3"):
+    for i in range(int(count)):
+        yield "%d: bytes\n" % (i,)
+        yield u"%d: G\xf6teborg\n" % (i,)
+        doc = tree.entity()
+        doc.xml_append(tree.element(None, u"item"))
+        yield doc
+        yield "\n"
+
+@simple_service("GET", "http://example.com/test", stream=True)
+def test_xml_stream(count="3"):
+    doc = tree.entity()
+    items = doc.xml_append(tree.element(None, u"items"))
+    for i in range(int(count)):
+        item = items.xml_append(tree.element(None, u"item"))
+        item.xml_attributes[u"n"] = unicode(i)
+        item.xml_append(tree.text(u"G\xf6teborg"))
+    return doc
+
+# Multi-segment and parameterized paths
+@simple_service("GET", "http://example.com/test_route", path="test.route/{name}/{page}")
+def test_route():
+    positional, named = request.environ["wsgiorg.routing_args"]
+    return "%s %s %s %s" % (named["name"], named["page"],
+                            request.environ["SCRIPT_NAME"], request.environ["PATH_INFO"])
+
+@simple_service("GET", "http://example.com/test_route", path="test.route/{name}/index")
+def test_route_index():
+    positional, named = request.environ["wsgiorg.routing_args"]
+    return "index of %s" % (named["name"],)
+
+# A file object is sent with wsgi.file_wrapper, starting from the
+# current file position.
+@simple_service("GET", "http://example.com/test")
+def test_file(size="100000", offset="0"):
+    import tempfile
+    f = tempfile.TemporaryFile()
+    f.write("".join([chr(i % 251) for i in xrange(int(size))]))
+    f.seek(int(offset))
+    return f
+
 
 # Basic args (repeats are not allowed)
 @simple_service("GET", "http://example.com/test_args", None, "text/plain")
@@ -174,6 +218,42 @@ def test_args(a, b=3):
 def test_repeated_args(a, b=3):
     return "Hello %s and %s" % (a, b)
 
+# Convert the query parameters
+@simple_service("GET", "http://example.com/test_args", content_type="text/plain",
+                arg_types=dict(n=int, scale=float))
+def test_arg_types(n, scale=1.0):
+    return "%r * %r = %r" % (n, scale, n*scale)
+
+
+# Memoize the response. The disk tier shares it between the server processes.
+@simple_service("GET", "http://example.com/test_cache", content_type="text/plain",
+                cache=ResponseCache(expires=60, key=["a"], disk="test_cache",
+                                    single_flight=True))
+def test_cache(a="x", b=None):
+    response.add_header("X-Akara-Test", a)
+    return "%s %s" % (a, os.urandom(8).encode("hex"))
+
+# Conditional GET, using a hash of the body as the ETag
+@simple_service("GET", "http://example.com/test_conditional", content_type="text/plain",
+                conditional=True)
+def test_conditional(a="world"):
+    if a == "nobody":
+        response.code = 404
+        return "Nobody here"
+    return "Hello %s!" % (a,)
+
+# Conditional GET, with validators from before the body is made
+def _test_validator_version(kind="etag"):
+    if kind == "etag":
+        return "v1"
+    if kind == "mtime":
+        return 1000000000
+    return None
+
+@simple_service("GET", "http://example.com/test_conditional", content_type="text/plain",
+                validator=_test_validator_version)
+def test_validator(kind="etag"):
+    return "The %s version" % (kind,)
 
 # Add new headers to the response, including multiple headers with the same name.
 @simple_service("GET", "http://example.com/test_args")
@@ -493,6 +573,43 @@ def test_template5():
         yield "spam"
         
 
+##### Failures
+
+@simple_service("GET", "http://example.com/test_exception")
+def test_exception():
+    raise ValueError("This service always fails")
+
+##### Asynchronous notifications
+
+def _notify_record_filename(key):
+    from akara.caching import make_named_cache
+    return os.path.join(make_named_cache("test_notify"), key.encode("hex"))
+
+# Records what it was sent. Any HTTP method is fine.
+@service("http://example.com/test_notify_record", "test_notify_record")
+def test_notify_record(environ, start_response):
+    import cgi
+    key = cgi.parse_qs(environ["QUERY_STRING"])["key"][0]
+    f = open(_notify_record_filename(key), "wb")
+    f.write(environ["wsgi.input"].read())
+    f.close()
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return "recorded\n"
+
+@simple_service("GET", "http://example.com/test_notify_async", content_type="text/plain",
+                notify_after=["http://example.com/test_notify_record"], notify_async=True)
+def test_notify_async(key):
+    return "Notifying for %s" % (key,)
+
+@simple_service("GET", "http://example.com/test_notify_received", content_type="text/plain")
+def test_notify_received(key):
+    try:
+        return open(_notify_record_filename(key), "rb").read()
+    except IOError:
+        response.code = 404
+        return "Nothing recorded for %r" % (key,)
+
+
 ##### extra service registration
 
 import akara.global_config
@@ -11,7 +11,7 @@ from akara.services import simple_service
 
 SERVICE_ID = 'http://purl.org/akara/services/demo/tidy'
 @simple_service('POST', SERVICE_ID, 'tidy.xml', 'application/xml',
-                writer="xml")
+                writer="xml", stream=True)
 def tidy(body, ctype):
     '''
     Tidy arbitrary HTML (using html5lib)
@@ -58,18 +58,27 @@ class MediaHandler(object):
         # the Last-Modified header. It makes media files a bit speedier
         # because the files are only read off disk for the first request
         # (assuming the browser/client supports conditional GET).
-        mtime = formatdate(os.stat(filename).st_mtime, usegmt=True)
+        st = os.fstat(fp.fileno())
+        mtime = formatdate(st.st_mtime, usegmt=True)
         headers = [('Last-Modified', mtime)]
         if environ.get('HTTP_IF_MODIFIED_SINCE', None) == mtime:
             status = '304 Not Modified'
             output = ()
+            fp.close()
         else:
             status = '200 OK'
             mime_type = mimetypes.guess_type(filename)[0]
             if mime_type:
                 headers.append(('Content-Type', mime_type))
-            output = [fp.read()]
-            fp.close()
+            headers.append(('Content-Length', str(st.st_size)))
+            # Let the server send the file without reading it all
+            # into memory. It may even be able to use sendfile().
+            file_wrapper = environ.get('wsgi.file_wrapper', None)
+            if file_wrapper is not None:
+                output = file_wrapper(fp, 64*1024)
+            else:
+                output = [fp.read()]
+                fp.close()
         start_response(status, headers)
         return output
 
@@ -11,15 +11,21 @@ server_root            : public URL to the top-level of Akara
 internal_server_root   : internal URL to the top-level of Akara
 config_root            : Akara configuration root directory (e.g., ~/.local/lib/akara)
 pid_file               : Location of the PID file
+scoreboard_file        : Location of the server status scoreboard
+max_histograms_per_server: Latency histograms each server has room for
 error_log              : Filename of the Akara error log
 access_log             : Filename of the Akara access log
+access_log_flush_interval: Max seconds an access log line is buffered
 module_dir             : Akara module directory
 module_cache           : Module cache directory
+preload_modules        : True, False, or a list of modules to import before forking
 log_level              : Logging level
 max_servers            : Maximum number of servers
 min_spare_servers      : Min spare servers
 max_spare_servers      : Max spare servers
 max_requests_per_server: Max requests per server
+max_keep_alive_requests: Max requests per keep-alive connection
+keep_alive_timeout     : Seconds to wait for the next request on a connection
 
 The primary purpose of this module is to make configuration parameters
 available to various library modules that make up the Akara core. 
@@ -27,7 +27,9 @@ Note: for a recipe for filtering the log entries, see:
 #Note: this logger seems reliably multiprocess-friendly, but not a bad idea to bookmark:
 #"How should I log while using multiprocessing in Python?": http://stackoverflow.com/questions/641420/how-should-i-log-while-using-multiprocessing-in-python/894284#894284
 
+import os
 import sys
+import time
 import logging
 
 from cStringIO import StringIO
@@ -58,14 +60,88 @@ _current_handler = None
 
 
 class AccessLogger(object):
-    """Access log writer.  Logs HTTP requests."""
+    """Access log writer.  Logs HTTP requests.
+
+    Writing each line as it comes costs a system call per request, so
+    lines are kept in a buffer and written all at once. The buffer is
+    written when it holds more than 'max_buffer_size' bytes, when the
+    oldest line in it is more than 'flush_interval' seconds old, and
+    when flush() or close() is called. A 'flush_interval' of 0 writes
+    each line immediately.
+
+    After writing, check (at most once a second) if the log file was
+    renamed or removed, e.g. by a log rotation tool. If so, continue
+    with a new file with the original name.
+    """
     access_log_fh = None
 
-    def __init__(self, filename):
-        self.access_log_fh = open(filename, 'w', 0)
+    def __init__(self, filename, flush_interval=0, max_buffer_size=64*1024):
+        self.filename = filename
+        self.flush_interval = flush_interval
+        self.max_buffer_size = max_buffer_size
+        self._open(filename, 'w')
+        self._buffer = []
+        self._buffer_size = 0
+        self._buffer_time = None   # when the oldest line was added
+        self._rotation_check_time = time.time()
+
+    def _open(self, filename, mode):
+        self.access_log_fh = open(filename, mode, 0)
+        st = os.fstat(self.access_log_fh.fileno())
+        self._file_id = (st.st_dev, st.st_ino)
 
     def write(self, s):
-        self.access_log_fh.write("%s\n" % s)
+        line = "%s\n" % s
+        self._buffer.append(line)
+        self._buffer_size += len(line)
+        if self._buffer_time is None:
+            self._buffer_time = time.time()
+        if (self._buffer_size >= self.max_buffer_size or
+            time.time() - self._buffer_time >= self.flush_interval):
+            self.flush()
+
+    def flush_if_due(self):
+        "Write the buffer if the oldest line has waited long enough"
+        if (self._buffer_time is not None and
+            time.time() - self._buffer_time >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        if self._buffer:
+            text = "".join(self._buffer)
+            del self._buffer[:]
+            self._buffer_size = 0
+            self._buffer_time = None
+            self.access_log_fh.write(text)
+        now = time.time()
+        if now - self._rotation_check_time >= 1.0:
+            self._rotation_check_time = now
+            self._check_rotation()
+
+    def _check_rotation(self):
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            file_id = None
+        else:
+            file_id = (st.st_dev, st.st_ino)
+        if file_id != self._file_id:
+            # Someone moved the log file. Start a new one.
+            old_fh = self.access_log_fh
+            try:
+                self._open(self.filename, 'a')
+            except IOError:
+                # Can't create a new one? Keep using the old one
+                # rather than lose the log messages.
+                _logger.error("Unable to reopen access log %r" % (self.filename,),
+                              exc_info = True)
+                self._file_id = file_id
+            else:
+                old_fh.close()
+
+    def close(self):
+        self.flush()
+        self.access_log_fh.close()
 
 
 def set_logfile(f):
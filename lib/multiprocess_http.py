@@ -34,7 +34,9 @@ registration occurs.
 
 """
 import datetime
+import gc
 import os
+import socket
 import string
 import sys
 import time
@@ -48,6 +50,8 @@ from wsgiref.simple_server import WSGIRequestHandler
 
 from akara import logger
 from akara import registry
+from akara import scoreboard
+from akara import notify
 
 from akara.thirdparty import preforkserver, httpserver
 
@@ -83,6 +87,26 @@ _access_logger = None
 # method that I can use to sneak in my exec before letting flup's
 # child mainloop run.
 
+# The isolation has a cost. Every child imports and keeps its own
+# copy of the extension modules and everything they use (amara, ...),
+# and a newly spawned child is slow until that's done. With the
+# PreloadModules option the master imports (some or all of) the
+# modules once, before forking, and the children share those pages
+# copy-on-write. The modules that aren't preloaded are still imported
+# in each child as before.
+
+# Each child records what it's doing in its slot of the scoreboard
+# (see akara.scoreboard). flup uses that to decide when to spawn or
+# kill children. When ScoreboardFile is set the scoreboard is also a
+# file which can be read at any time to see what the servers are up
+# to, like Apache's "server-status". The dispatcher also records the
+# time for each request in the scoreboard's latency histograms, which
+# the "metrics" service reports.
+
+# Notify services registered with notify_async=True are delivered by
+# the idle children, between requests (see akara.notify). That's why
+# the children wake up at least every NOTIFY_POLL_INTERVAL seconds.
+
 class AkaraPreforkServer(preforkserver.PreforkServer):
     def __init__(self, settings, config, access_logger,
                  minSpare=1, maxSpare=5, maxChildren=50,
@@ -90,14 +114,36 @@ class AkaraPreforkServer(preforkserver.PreforkServer):
         global _access_logger
         _access_logger = access_logger
         self.config = config
+        board = scoreboard.Scoreboard(settings["scoreboard_file"],
+                                      max(maxSpare, maxChildren),
+                                      settings["max_histograms_per_server"])
         preforkserver.PreforkServer.__init__(self,
                                              minSpare=minSpare, maxSpare=maxSpare,
                                              maxChildren=maxChildren, maxRequests=maxRequests,
                                              jobClass=AkaraJob,
-                                             jobArgs=(settings, config))
+                                             jobArgs=(settings, config),
+                                             scoreboard=board)
+        # Nothing has been forked yet. This is the time to preload.
+        self._preloaded = _preload_modules(config, settings["preload_modules"])
+        # Idle children wake up to write out the buffered access log
+        # and to deliver the spooled notifications
+        self._childTimeout = notify.NOTIFY_POLL_INTERVAL
+        if access_logger.flush_interval > 0:
+            self._childTimeout = min(self._childTimeout, access_logger.flush_interval)
+
     def _child(self, sock, parent):
-        _init_modules(self.config)
-        preforkserver.PreforkServer._child(self, sock, parent)
+        _init_modules(self.config, skip=self._preloaded)
+        try:
+            preforkserver.PreforkServer._child(self, sock, parent)
+        finally:
+            _access_logger.flush()
+
+    def _childTick(self):
+        _access_logger.flush_if_due()
+        try:
+            notify.deliver_spooled(self._scoreboardSlot)
+        except Exception:
+            logger.error("Unable to deliver the spooled notifications", exc_info=True)
 
 
 # Once the flup PreforkServer has a request, it starts up an AkaraJob.
@@ -107,7 +153,18 @@ class AkaraPreforkServer(preforkserver.PreforkServer):
 
 # AkaraWSGIHandler's third parameter, which is an 
 
+# An HTTP/1.1 client may send several requests over the same
+# connection. The job keeps the socket open for up to
+# MaxKeepAliveRequests requests, waiting at most KeepAliveTimeout
+# seconds for each new one. Every request counts against
+# MaxRequestsPerServer, so the job is never allowed more requests
+# than the child has left. flup sets 'maxRequests' and the child's
+# 'scoreboardSlot' before calling run().
+
 class AkaraJob(object):
+    maxRequests = 0   # 0 means the child has no request limit
+    scoreboardSlot = None
+
     def __init__(self, sock, addr, settings, config):
         self._sock = sock
         self._addr = addr
@@ -117,12 +174,29 @@ class AkaraJob(object):
         self._sock.setblocking(1)
         logger.debug("Start request from address %r, local socket %r" %
                      (self._addr, self._sock.getsockname()))
-        handler = AkaraWSGIDispatcher(self.settings, self.config)
-        self.handler = AkaraWSGIHandler(self._sock, self._addr, handler)
-        logger.debug("End request from address %r, local socket %r" %
-                     (self._addr, self._sock.getsockname()))
+        max_requests = self.settings["max_keep_alive_requests"]
+        if self.maxRequests > 0:
+            max_requests = min(max_requests, self.maxRequests)
+        handler = AkaraWSGIDispatcher(self.settings, self.config,
+                                      scoreboard_slot = self.scoreboardSlot)
+        self.handler = AkaraWSGIHandler(self._sock, self._addr, handler,
+                                        max_requests = max_requests,
+                                        keep_alive_timeout = self.settings["keep_alive_timeout"],
+                                        scoreboard_slot = self.scoreboardSlot)
+        logger.debug("End request from address %r, local socket %r (%d requests)" %
+                     (self._addr, self._sock.getsockname(), self.handler.request_count))
         self._sock.close()
+        return self.handler.request_count
+
 
+# A kept-alive connection is only reused once the whole request body
+# has been read, or the rest of the body would be taken as the next
+# request. The handler reads and discards up to MAX_DISCARDED_BODY
+# bytes of body the application didn't read. Otherwise, or if the
+# length of the body isn't known in advance, the connection is closed
+# after the response.
+
+MAX_DISCARDED_BODY = 64*1024
 
 # Override a few of the default settings
 class AkaraWSGIHandler(httpserver.WSGIHandler):
@@ -130,10 +204,114 @@ class AkaraWSGIHandler(httpserver.WSGIHandler):
     server_version = "Akara/2.0"  # Declare that we are an Akara server
     protocol_version = "HTTP/1.1" # Support (for the most part) HTTP/1.1 semantics
 
+    def __init__(self, request, client_address, server,
+                 max_requests=1, keep_alive_timeout=None, scoreboard_slot=None):
+        self.max_requests = max_requests
+        self.keep_alive_timeout = keep_alive_timeout
+        self.scoreboard_slot = scoreboard_slot
+        self.request_count = 0
+        self.bytes_sent = 0
+        self.must_close = False
+        # This handles all of the requests on the connection
+        httpserver.WSGIHandler.__init__(self, request, client_address, server)
+
     # Suppress access log reporting from BaseHTTPServer.py
     def log_request(self, code='-', size='-'):
         pass
 
+    def handle_one_request(self):
+        # Same as paste's version, except that on a kept-alive
+        # connection the wait for the next request line is bounded.
+        slot = self.scoreboard_slot
+        if self.request_count:
+            # Don't hold on to old access log lines while waiting
+            _access_logger.flush_if_due()
+            self.connection.settimeout(self.keep_alive_timeout)
+            if slot is not None:
+                slot.set_state(scoreboard.SLOT_KEEPALIVE)
+        try:
+            self.raw_requestline = self.rfile.readline()
+        except socket.timeout:
+            self.close_connection = 1
+            return
+        self.connection.settimeout(None)
+        if not self.raw_requestline:
+            self.close_connection = 1
+            return
+        self.request_count += 1
+        if slot is not None:
+            slot.start_request(self.raw_requestline.rstrip("\r\n"))
+        self.bytes_sent = 0
+        try:
+            if not self.parse_request(): # An error code has been sent, just exit
+                return
+            self.must_close = not self._body_length_known()
+            self.wsgi_execute()
+            if self.must_close:
+                self.close_connection = 1
+            elif not self.close_connection and not self._discard_unread_body():
+                self.close_connection = 1
+        finally:
+            if slot is not None:
+                slot.end_request(self.bytes_sent)
+
+    def _body_length_known(self):
+        # With "Expect: 100-continue" the client may or may not send
+        # the body, depending on whether it got the 100 response.
+        if self.headers.get("Expect", "").lower() == "100-continue":
+            return False
+        if self.headers.get("Transfer-Encoding") is not None:
+            return False
+        try:
+            return int(self.headers.get("Content-Length", "0")) >= 0
+        except ValueError:
+            return False
+
+    def _discard_unread_body(self):
+        "Read what's left of the request body. Returns False if that can't be done."
+        rfile = self.wsgi_environ["wsgi.input"]
+        if not isinstance(rfile, httpserver.LimitedLengthFile):
+            return int(self.headers.get("Content-Length", "0")) == 0
+        left = rfile.length - rfile._consumed
+        if left == 0:
+            return True
+        if left > MAX_DISCARDED_BODY:
+            return False
+        self.connection.settimeout(self.keep_alive_timeout)
+        try:
+            try:
+                while left > 0:
+                    data = rfile.read(min(left, 8192))
+                    if not data:
+                        return False
+                    left -= len(data)
+            except (socket.timeout, socket.error):
+                return False
+        finally:
+            self.connection.settimeout(None)
+        return True
+
+    def wsgi_write_chunk(self, chunk):
+        httpserver.WSGIHandler.wsgi_write_chunk(self, chunk)
+        if self.command != "HEAD":
+            self.bytes_sent += len(chunk)
+
+    def wsgi_send_file(self, wrapper):
+        sent = httpserver.WSGIHandler.wsgi_send_file(self, wrapper)
+        if sent is not None:
+            self.bytes_sent += sent
+        return sent
+
+    def end_headers(self):
+        # Tell the client when this is the last request we will take
+        # on this connection. parse_request() and wsgi_write_chunk()
+        # have already dealt with the other reasons to close.
+        if not self.close_connection and (self.must_close or
+                                          self.request_count >= self.max_requests):
+            self.send_header("Connection", "close")
+            self.close_connection = 1
+        httpserver.WSGIHandler.end_headers(self)
+
 # This is the the top-level WSGI dispatcher between paste.httpserver
 # and Akara proper. It only understand how to get the first part of
 # the path (called the "mount_point") and get the associated handler
@@ -158,11 +336,15 @@ ERROR_DOCUMENT_TEMPLATE = """<?xml version="1.0" encoding="ISO-8859-1"?>
 
 def _send_error(start_response, code, exc_info=None):
     reason, message = WSGIRequestHandler.responses[code]
-    start_response("%d %s" % (code, reason), [("Content-Type", "text/html")],
-                   exc_info=exc_info)
-    return ERROR_DOCUMENT_TEMPLATE % dict(code = code,
+    body = ERROR_DOCUMENT_TEMPLATE % dict(code = code,
                                           reason = reason,
                                           message = message)
+    # A list, not the string itself, which would be sent a character
+    # at a time.
+    start_response("%d %s" % (code, reason), [("Content-Type", "text/html"),
+                                              ("Content-Length", str(len(body)))],
+                   exc_info=exc_info)
+    return [body]
 
 # Output will look like Apache's "combined log format".
 #    Here's an example based on the Apache documentation (it should be on a single line)
@@ -187,10 +369,20 @@ ACCESS_LOG_MESSAGE = (
 def timetuple_to_datetime(t):
     return datetime.datetime(t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec)
 
+# The timestamp only changes once a second, so only format it once a
+# second. Saves a few datetime objects per request.
 _months = "XXX Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split()
+_time_cache = [None, None]  # [seconds, formatted time]
 def _get_time():
-    now = time.localtime()
-    utc_time = time.gmtime()
+    seconds = int(time.time())
+    if _time_cache[0] != seconds:
+        _time_cache[1] = _format_time(seconds)
+        _time_cache[0] = seconds
+    return _time_cache[1]
+
+def _format_time(seconds):
+    now = time.localtime(seconds)
+    utc_time = time.gmtime(seconds)
 
     tz_seconds = (timetuple_to_datetime(now) - timetuple_to_datetime(utc_time)).seconds
     # Round to the nearest minute
@@ -218,8 +410,9 @@ def _clean(s):
     
 
 class AkaraWSGIDispatcher(object):
-    def __init__(self, settings, config):
+    def __init__(self, settings, config, scoreboard_slot=None):
         self.server_address = settings["server_address"]
+        self.scoreboard_slot = scoreboard_slot
 
     def wsgi_application(self, environ, start_response):
         # There's some sort of problem if the application
@@ -285,25 +478,41 @@ class AkaraWSGIDispatcher(object):
             # Forward things to the real start_response
             return start_response(status, headers, exc_info)
 
-        # Get the handler for this mount point
-        if "/" not in environ.get("PATH_INFO", "/"):
+        # Get the handler for this path
+        path_info = environ.get("PATH_INFO", "/")
+        if "/" not in path_info:
             # This happens with very ill-formed queries
             # Like when you use httplib directly and forget the leading '/'.
             return _send_error(start_response, 400)
-        mount_point = shift_path_info(environ)
+        try:
+            service, args, num_segments = registry.match_path(path_info)
+        except KeyError:
+            service = None
+            mount_point = shift_path_info(environ)
+        else:
+            # Move the matched part of the path to SCRIPT_NAME
+            for i in range(num_segments):
+                shift_path_info(environ)
+            environ["wsgiorg.routing_args"] = ((), args)
+            mount_point = service.path
+        if self.scoreboard_slot is not None:
+            self.scoreboard_slot.set_mount_point(mount_point or "")
 
         # Call the handler, deal with any errors, do access logging
+        histogram_name = mount_point
         try:
             timing_start_time = time.time()
-            try:
-                service = registry.get_service(mount_point)
-            except KeyError:
-                # Not found. Report something semi-nice to the user
+            if service is None:
+                # Not found. Report something semi-nice to the user.
+                # (And don't let random URLs fill the latency histograms.)
+                histogram_name = scoreboard.UNKNOWN_MOUNT_POINT
                 return _send_error(start_response_, 404)
             try:
                 result = service.handler(environ, start_response_)
                 if is_head_request:
                     # successful HEAD requests MUST return an empty message-body
+                    if hasattr(result, "close"):
+                        result.close()
                     return []
                 return result
             except Exception, err:
@@ -320,6 +529,9 @@ class AkaraWSGIDispatcher(object):
             timing_end_time = time.time()
             access_data["elapsed_us"] = int((timing_end_time - timing_start_time) * 1000000)
             self.save_to_access_log(environ, access_data)
+            if self.scoreboard_slot is not None:
+                self.scoreboard_slot.record_latency(histogram_name, access_data["status"],
+                                                    access_data["elapsed_us"])
 
 
     def save_to_access_log(self, environ, access_data):
@@ -350,7 +562,7 @@ class AkaraWSGIDispatcher(object):
 # exec the byte code. That's the job for the spawned-off HTTP listener
 # classes.
 
-def _init_modules(config):
+def _init_modules(config, skip=()):
     try:
         modules = config["MODULES"]
     except KeyError:
@@ -358,6 +570,9 @@ def _init_modules(config):
                      "No extensions will be installed.")
         return
     for module_name in modules:
+        if module_name in skip:
+            # Already imported (and registered) by the master
+            continue
         # import the module
         try:
             __import__(module_name)
@@ -367,3 +582,52 @@ def _init_modules(config):
                          exc_info = True)
     
 
+
+# Names of the modules preloaded by this (master) process
+_preloaded_modules = []
+
+def _preload_modules(config, preload):
+    """Import extension modules in the master, before any child is forked
+
+    'preload' is the PreloadModules setting: False, True (preload all
+    of MODULES) or a list of the module names to preload. Returns the
+    names of the modules which were successfully imported.
+    """
+    if not preload:
+        return ()
+    modules = config.get("MODULES", [])
+    if preload is not True:
+        for module_name in preload:
+            if module_name not in modules:
+                logger.warn("PreloadModules lists %r, which is not in MODULES - "
+                            "not preloading it" % (module_name,))
+        modules = [name for name in modules if name in preload]
+
+    # After a SIGHUP the previous modules are still in sys.modules.
+    # Forget them so the (possibly new) code is executed again.
+    for module_name in _preloaded_modules:
+        sys.modules.pop(module_name, None)
+    del _preloaded_modules[:]
+
+    for module_name in modules:
+        if module_name in _preloaded_modules:
+            continue
+        try:
+            __import__(module_name)
+        except:
+            # The child will try again, and report it again. That's
+            # better than having a broken module take down the master.
+            logger.error("Unable to preload module %r - the servers will import it" %
+                         (module_name,), exc_info = True)
+        else:
+            _preloaded_modules.append(module_name)
+    logger.info("Preloaded %d extension modules" % (len(_preloaded_modules),))
+
+    # Clean up the import garbage now rather than have each child's
+    # first collection touch (and so copy) the shared pages. Python
+    # 3.7 and later can also take the survivors out of the collector's
+    # view entirely.
+    gc.collect()
+    if hasattr(gc, "freeze"):
+        gc.freeze()
+    return tuple(_preloaded_modules)
@@ -0,0 +1,326 @@
+"""Spool for asynchronous notify_before and notify_after deliveries
+
+This is an internal module and should not be used by other libraries.
+
+A service registered with notify_async=True does not call its notify
+services while handling the request. Instead each notification, with
+the request body (or the response body for notify_after) and a copy
+of the WSGI environ, is written to a file in the "notify_spool"
+directory under the ModuleCache directory and the response goes back
+to the client right away.
+
+The server processes deliver the spooled notifications between
+requests. (The akara.request and akara.response modules hold the
+state of the current request so a notify service can't be called
+from another thread.) An idle server checks the spool about once a
+second; see NOTIFY_POLL_INTERVAL. At most MAX_CONCURRENT_DELIVERIES
+servers deliver at the same time, each holding one of the lock files
+in the spool directory. A server stops starting new deliveries after
+DELIVERIES_PER_TICK of them or DELIVERY_TIME_LIMIT seconds, whichever
+comes first, and shows as "notifying" in the scoreboard meanwhile so
+the master starts another spare server if needed. A notify service
+which runs for more than DELIVERY_TIMEOUT seconds is interrupted (with
+SIGALRM, so only in the main thread) and counts as a failed attempt.
+
+Spool file names start with the time of the next delivery attempt, so
+a directory listing gives them in order. A server claims a file by
+renaming it to "<name>.<pid>.work", which is atomic, and removes it
+once the notify service succeeds. A notify service fails if it raises
+an exception or returns a 5xx status. A failed delivery is retried
+after RETRY_DELAY seconds, doubling each time, up to
+MAX_DELIVERY_ATTEMPTS attempts. After that the file is moved to the
+"failed" subdirectory and the error is logged, as is a file which
+can't be read. Files claimed by a server which has since died are put
+back in the spool.
+
+Each delivery is recorded in the scoreboard latency histograms under
+the mount point "notify:<path>", measured from when the notification
+was spooled. The "metrics" service reports them separately from the
+request latencies, along with the spool depth.
+"""
+
+import os
+import sys
+import time
+import errno
+import signal
+import fcntl
+import cPickle as pickle
+from cStringIO import StringIO
+
+from akara import logger, registry, global_config, scoreboard
+
+__all__ = ["spool_notifications", "deliver_spooled", "spool_depth"]
+
+NOTIFY_POLL_INTERVAL = 1.0
+MAX_CONCURRENT_DELIVERIES = 2
+DELIVERIES_PER_TICK = 10
+DELIVERY_TIME_LIMIT = 0.5
+DELIVERY_TIMEOUT = 30.0
+MAX_DELIVERY_ATTEMPTS = 5
+RETRY_DELAY = 2.0
+
+# Delivery latencies are recorded in the scoreboard under this prefix
+MOUNT_POINT_PREFIX = "notify:"
+
+_spool_dir = None
+_counter = 0
+
+def get_spool_dir():
+    "Return the spool directory, making it if needed"
+    global _spool_dir
+    if _spool_dir is None:
+        from akara.caching import make_named_cache
+        spool_dir = make_named_cache("notify_spool")
+        failed_dir = os.path.join(spool_dir, "failed")
+        if not os.path.exists(failed_dir):
+            try:
+                os.mkdir(failed_dir)
+            except OSError:
+                pass    # Here for possible race condition
+        _spool_dir = spool_dir
+    return _spool_dir
+
+def _copy_environ(environ):
+    # Keep only what can be written to disk. The WSGI streams and
+    # callables are made again when the notification is delivered.
+    copy = {}
+    for k, v in environ.iteritems():
+        if isinstance(v, (basestring, int, long, float, bool)):
+            copy[k] = v
+    routing_args = environ.get("wsgiorg.routing_args")
+    if routing_args is not None:
+        copy["wsgiorg.routing_args"] = routing_args
+    return copy
+
+def _job_filename(when):
+    global _counter
+    _counter += 1
+    return "%017.6f-%d-%d.job" % (when, os.getpid(), _counter)
+
+def _write_job(spool_dir, filename, job):
+    tempname = os.path.join(spool_dir, filename + ".tmp")
+    f = open(tempname, "wb")
+    try:
+        pickle.dump(job, f, -1)
+        # It's a durable spool. Don't let the rename get ahead of the data.
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(tempname, os.path.join(spool_dir, filename))
+
+def spool_notifications(environ, body, service_list):
+    "Save a notification for each of the notify services, for later delivery"
+    spool_dir = get_spool_dir()
+    environ = _copy_environ(environ)
+    now = time.time()
+    for service_id in service_list:
+        job = dict(service_id = service_id,
+                   environ = environ,
+                   body = body,
+                   created = now,
+                   attempts = 0)
+        _write_job(spool_dir, _job_filename(now), job)
+
+
+def _acquire_delivery_lock(spool_dir):
+    for i in range(MAX_CONCURRENT_DELIVERIES):
+        fd = os.open(os.path.join(spool_dir, "lock.%d" % (i,)), os.O_WRONLY | os.O_CREAT)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            os.close(fd)
+            continue
+        return fd
+    return None
+
+def _release_delivery_lock(fd):
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, err:
+        return err.errno != errno.ESRCH
+    return True
+
+def _reclaim_abandoned(spool_dir, names):
+    "Put back the files claimed by servers which no longer exist, and add them to 'names'"
+    for name in names:
+        if not name.endswith(".work"):
+            continue
+        job_name, pid, _ = name.rsplit(".", 2)
+        try:
+            pid = int(pid)
+        except ValueError:
+            continue
+        if pid != os.getpid() and not _is_alive(pid):
+            try:
+                os.rename(os.path.join(spool_dir, name), os.path.join(spool_dir, job_name))
+            except OSError:
+                pass   # Someone else got to it first
+            else:
+                names.append(job_name)
+
+def _run_notify_service(job):
+    "Call the notify service. Returns its path and status, or raises an exception"
+    from akara.services import new_request
+    service = registry.get_a_service_by_id(job["service_id"])
+    if service is None:
+        raise KeyError("No service with ident %r" % (job["service_id"],))
+    body = job["body"]
+    environ = job["environ"].copy()
+    environ["PATH_INFO"] = service.path
+    environ["CONTENT_LENGTH"] = str(len(body))
+    environ["wsgi.input"] = StringIO(body)
+    environ["wsgi.errors"] = sys.stderr
+    environ["wsgi.version"] = (1, 0)
+    status = []
+    def start_response(code, headers, exc_info=None):
+        status[:] = [code]
+        return _ignore_write
+    new_request(environ)
+    result = service.handler(environ, start_response)
+    # Run it to the end, in case it's a generator
+    try:
+        for block in result:
+            pass
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return service.path, (status or ["200"])[0]
+
+def _ignore_write(data):
+    pass
+
+class _DeliveryTimeout(BaseException):
+    # Not an Exception, so the notify service can't catch it by accident
+    pass
+
+def _alarm_handler(signum, frame):
+    raise _DeliveryTimeout("notify service did not finish in time")
+
+def _run_with_timeout(job, timeout):
+    "Call the notify service, raising _DeliveryTimeout after 'timeout' seconds"
+    if not timeout:
+        return _run_notify_service(job)
+    try:
+        old_handler = signal.signal(signal.SIGALRM, _alarm_handler)
+    except ValueError:
+        # Signal handlers can only be set in the main thread
+        return _run_notify_service(job)
+    try:
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+        try:
+            return _run_notify_service(job)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    finally:
+        signal.signal(signal.SIGALRM, old_handler)
+
+def _deliver(spool_dir, name, scoreboard_slot, timeout):
+    filename = os.path.join(spool_dir, name)
+    work_filename = "%s.%d.work" % (filename, os.getpid())
+    try:
+        os.rename(filename, work_filename)
+    except OSError:
+        # Another server is delivering it
+        return
+    try:
+        f = open(work_filename, "rb")
+        try:
+            job = pickle.load(f)
+        finally:
+            f.close()
+    except Exception:
+        # Otherwise it would be reclaimed and tried again forever
+        logger.error("Unable to read spooled notification %r" % (name,), exc_info=True)
+        os.rename(work_filename, os.path.join(spool_dir, "failed", name))
+        return
+
+    try:
+        path, status = _run_with_timeout(job, timeout)
+        if status[:1] == "5":
+            raise ValueError("notify service returned %r" % (status,))
+    except (Exception, _DeliveryTimeout):
+        job["attempts"] += 1
+        if job["attempts"] >= MAX_DELIVERY_ATTEMPTS:
+            logger.error("Unable to deliver notification to %r after %d attempts" %
+                         (job["service_id"], job["attempts"]), exc_info=True)
+            os.rename(work_filename, os.path.join(spool_dir, "failed", name))
+        else:
+            logger.warn("Unable to deliver notification to %r (attempt %d)" %
+                        (job["service_id"], job["attempts"]), exc_info=True)
+            delay = RETRY_DELAY * 2 ** (job["attempts"]-1)
+            _write_job(spool_dir, _job_filename(time.time() + delay), job)
+            os.remove(work_filename)
+        return
+
+    os.remove(work_filename)
+    if scoreboard_slot is not None:
+        elapsed_us = int((time.time() - job["created"]) * 1000000)
+        scoreboard_slot.record_latency(MOUNT_POINT_PREFIX + path, status[:3], elapsed_us)
+
+def deliver_spooled(scoreboard_slot=None, max_deliveries=DELIVERIES_PER_TICK,
+                    time_limit=DELIVERY_TIME_LIMIT, timeout=DELIVERY_TIMEOUT):
+    """Deliver spooled notifications which are due. Called by idle servers.
+
+    Stops after 'max_deliveries' deliveries or once 'time_limit' seconds
+    have passed. A delivery already started runs to the end, or until
+    'timeout' seconds, after which it counts as a failed attempt.
+    """
+    if getattr(global_config, "module_cache", None) is None:
+        return
+    # Don't make the spool until there is something to put in it
+    spool_dir = os.path.join(global_config.module_cache, "notify_spool")
+    try:
+        names = [name for name in os.listdir(spool_dir)
+                     if name.endswith(".job") or name.endswith(".work")]
+    except OSError:
+        return
+    if not names:
+        return
+    lock = _acquire_delivery_lock(spool_dir)
+    if lock is None:
+        return
+    try:
+        _reclaim_abandoned(spool_dir, names)
+        names.sort()
+        start_time = time.time()
+        now = "%017.6f" % (start_time,)
+        for name in names:
+            if not name.endswith(".job"):
+                continue
+            if name[:17] > now:
+                # Not due yet, and neither are the ones after it
+                break
+            if max_deliveries <= 0 or time.time() - start_time >= time_limit:
+                break
+            if scoreboard_slot is not None:
+                # Not available for connections until the server's
+                # main loop marks it idle again
+                scoreboard_slot.set_state(scoreboard.SLOT_NOTIFY)
+            _deliver(spool_dir, name, scoreboard_slot, timeout)
+            max_deliveries -= 1
+    finally:
+        _release_delivery_lock(lock)
+
+def spool_depth():
+    "Return the number of queued, in delivery and failed notifications"
+    if getattr(global_config, "module_cache", None) is None:
+        return 0, 0, 0
+    # Like deliver_spooled, don't make the spool just to look at it
+    spool_dir = os.path.join(global_config.module_cache, "notify_spool")
+    try:
+        names = os.listdir(spool_dir)
+    except OSError:
+        return 0, 0, 0
+    queued = len([name for name in names if name.endswith(".job")])
+    delivering = len([name for name in names if name.endswith(".work")])
+    try:
+        failed = len(os.listdir(os.path.join(spool_dir, "failed")))
+    except OSError:
+        failed = 0
+    return queued, delivering, failed
@@ -9,7 +9,7 @@ import urlparse
 import urllib
 
 
-__all__ = ["make_template", "apply_template"]
+__all__ = ["make_template", "apply_template", "TemplateMatcher"]
 
 # The OpenSearch format is documented at
 #   http://www.opensearch.org/Specifications/OpenSearch/1.1/Draft_4
@@ -59,6 +59,18 @@ __all__ = ["make_template", "apply_template"]
 # Template substitution is a merger of either the byte string or the
 # result of calling the function with the input parameters.
 
+# Services build URLs from the same few templates over and over, so
+# make_template() remembers the Template for each template string, and
+# each Template compiles its parts into a single Python function.
+
+# Going the other way, Template.match() takes a URL and returns the
+# template parameters. Each template field knows the regular
+# expression for its encoded value and how to decode it, and the
+# Template joins these into one regular expression for the part of
+# the URL before the query, and one for each query parameter value.
+# The query parameters are found by name, in any order. A
+# TemplateMatcher finds which of many templates matches a URL.
+
 ### Syntax definitions from the relevant specs
 
 # tparameter     = "{" tqname [ tmodifier ] "}"
@@ -124,11 +136,8 @@ def _parse_scheme(uri):
 
     if _is_optional(m):
         raise TypeError("URI scheme cannot be an optional template variable")
-    def convert_scheme(params, tlname=m.group("tlname")):
-        # I could make this a more rigorous test for the legal scheme characters
-        return params[tlname].encode("ascii")  # the scheme can only be ASCII
 
-    return m.end(), [convert_scheme, ":"]
+    return m.end(), [_SchemeField(m.group("tlname")), ":"]
 
 # Find the end of the network location field. The start is just after the '//'.
 # To make things easier, this must be a string with all template {names} removed!
@@ -177,33 +186,23 @@ def _parse_netloc(netloc, xnetloc):
 
     # Create a list of subparts, either:
     #    - strings which are *not* encoded
-    #    - a function to look up the value in the dictionary
+    #    - the name of a value to look up in the dictionary
     subparts = []
     for m in template_pat.finditer(hostname):
         tlname = m.group("tlname")
         if tlname is None:
-            subparts.append(m.group(0))
+            subparts.append( (m.group(0), None) )
         else:
             if m.group("tmodifier") == "?":
                 raise TypeError("URI hostname cannot contain an optional template variable")
-            subparts.append(lambda d, tlname=tlname: d[tlname])
+            subparts.append( (None, tlname) )
 
     # In the common case this is a string. No need for the extra overhead.
-    if len(subparts) == 1 and isinstance(subparts[0], basestring):
-        yield subparts[0].encode("idna")
+    if len(subparts) == 1 and subparts[0][1] is None:
+        yield subparts[0][0].encode("idna")
 
     else:
-        # Function to convert, join, and encode based the parts
-        def convert_hostname(params, parts=subparts):
-            results = []
-            for part in parts:
-                if isinstance(part, basestring):
-                    results.append(part)
-                else:
-                    results.append(part(params))
-            result = "".join(results)
-            return result.encode("idna")
-        yield convert_hostname
+        yield _HostnameField(subparts)
 
     # And finally, the port.
     if port is None:
@@ -220,14 +219,77 @@ def _parse_netloc(netloc, xnetloc):
         raise TypeError("Port must be either a number or a template name")
     if m.end() != len(port):
         raise TypeError("Port may not contain anything after the template name")
-    tlname = m.group("tlname")
-    if _is_optional(m):
-        extract = lambda params, tlname=tlname: params.get(tlname, "")
-    else:
-        extract = lambda params, tlname=tlname: params[tlname]
-        
-    def convert_port(params, extract=extract, tlname=tlname):
-        value = extract(params)
+    yield _PortField(m.group("tlname"), _is_optional(m))
+
+#### Template fields
+
+# Calling a field with the input parameters returns the encoded value.
+# The 'regex' attribute matches the encoded value in a URL, using one
+# group for each name in 'tlnames', and decode() turns the matched
+# groups back into a list of (tlname, value) pairs.
+
+# A _QuotedField's regex depends on where it is. Before the query it
+# matches up to the next "/", and in the query, up to the next "&".
+# Either way it takes what a real URL has there, not only what
+# quote_plus() makes.
+_PATH_FIELD_REGEX = r"([^/?#]*)"
+_QUERY_FIELD_REGEX = r"([^&#]*)"
+
+class _SchemeField(object):
+    regex = r"([a-zA-Z0-9+.-]+)"
+    optional = False
+    def __init__(self, tlname):
+        self.tlname = tlname
+        self.tlnames = (tlname,)
+    def __call__(self, params):
+        # I could make this a more rigorous test for the legal scheme characters
+        return params[self.tlname].encode("ascii")  # the scheme can only be ASCII
+    def decode(self, groups):
+        return [(self.tlname, groups[0])]
+
+class _HostnameField(object):
+    regex = r"([^/?#@:]*)"
+    optional = False
+    def __init__(self, subparts):
+        self.subparts = subparts
+        self.tlnames = tuple(tlname for (text, tlname) in subparts if tlname is not None)
+        self._hostname_pat = None
+    def __call__(self, params):
+        # Convert, join, and encode based the parts
+        results = []
+        for (text, tlname) in self.subparts:
+            if tlname is None:
+                results.append(text)
+            else:
+                results.append(params[tlname])
+        result = "".join(results)
+        return result.encode("idna")
+    def decode(self, groups):
+        # The parts have to be found in the decoded hostname
+        if self._hostname_pat is None:
+            terms = []
+            for (text, tlname) in self.subparts:
+                if tlname is None:
+                    terms.append(re.escape(text))
+                else:
+                    terms.append("(.+?)")
+            self._hostname_pat = re.compile("".join(terms) + r"\Z", re.I|re.U)
+        m = self._hostname_pat.match(groups[0].decode("idna"))
+        if m is None:
+            return None
+        return zip(self.tlnames, m.groups())
+
+class _PortField(object):
+    regex = r"(?::([0-9]+))?"
+    def __init__(self, tlname, optional):
+        self.tlname = tlname
+        self.tlnames = (tlname,)
+        self.optional = optional
+    def __call__(self, params):
+        if self.optional:
+            value = params.get(self.tlname, "")
+        else:
+            value = params[self.tlname]
         if isinstance(value, int):
             # Allow people to pass in a port number as an integer
             return ":%d" % (value,)
@@ -237,8 +299,28 @@ def _parse_netloc(netloc, xnetloc):
         if value.isdigit():
             return ":" + value
         raise TypeError("Port template parameter %r is not an integer (%r)" %
-                        (tlname, value))
-    yield convert_port
+                        (self.tlname, value))
+    def decode(self, groups):
+        return [(self.tlname, groups[0] or "")]
+
+# A field escaped via URL-encoded UTF-8. _compile_terms() writes the
+# conversion inline.
+class _QuotedField(object):
+    def __init__(self, tlname, optional):
+        self.tlname = tlname
+        self.tlnames = (tlname,)
+        self.optional = optional
+    def __call__(self, params):
+        if self.optional:
+            return urllib.quote_plus(params.get(self.tlname, "").encode("utf8"))
+        return urllib.quote_plus(params[self.tlname].encode("utf8"))
+    def decode(self, groups):
+        value = urllib.unquote_plus(groups[0])
+        try:
+            value = value.decode("utf8")
+        except UnicodeDecodeError:
+            pass  # Leave it as bytes
+        return [(self.tlname, value)]
 
 # Handle the text fields which are escaped via URL-encoded UTF-8
 def _parse_template(template):
@@ -247,13 +329,7 @@ def _parse_template(template):
             # "ascii" to ensure that no Unicode characters are in the template
             yield m.group(0).encode("ascii") # You must pre-encode non-ASCII text yourself
         else:
-            if _is_optional(m):
-                def convert_scheme(params, tlname=m.group("tlname")):
-                    return urllib.quote_plus(params.get(tlname, "").encode("utf8"))
-            else:
-                def convert_scheme(params, tlname=m.group("tlname")):
-                    return urllib.quote_plus(params[tlname].encode("utf8"))
-            yield convert_scheme
+            yield _QuotedField(m.group("tlname"), _is_optional(m))
 
 
 def decompose_template(uri):
@@ -318,6 +394,128 @@ def decompose_template(uri):
     return parts
 
 
+def _compile_terms(terms):
+    """Internal function to turn Template terms into a function of the parameters
+
+    The function returns the same string as joining the strings and
+    the results of calling the other terms with the parameters.
+    """
+    namespace = {"quote_plus": urllib.quote_plus}
+    exprs = []
+    text = []  # Merge neighboring strings
+    for term in terms:
+        if isinstance(term, basestring):
+            text.append(term)
+            continue
+        if text:
+            exprs.append(repr("".join(text)))
+            text = []
+        if isinstance(term, _QuotedField):
+            if term.optional:
+                exprs.append("quote_plus(params.get(%r, '').encode('utf8'))" % (term.tlname,))
+            else:
+                exprs.append("quote_plus(params[%r].encode('utf8'))" % (term.tlname,))
+        else:
+            name = "term%d" % (len(namespace),)
+            namespace[name] = term
+            exprs.append("%s(params)" % (name,))
+    if text:
+        exprs.append(repr("".join(text)))
+
+    if not exprs:
+        expr = "''"
+    elif len(exprs) == 1:
+        expr = exprs[0]
+    else:
+        expr = "''.join((%s))" % (", ".join(exprs),)
+    source = "def substitute(params):\n    return %s\n" % (expr,)
+    exec source in namespace
+    return namespace["substitute"]
+
+def _compile_match(terms, field_regex):
+    "Internal function to make a regular expression for Template.match()"
+    regexes = []
+    for term in terms:
+        if isinstance(term, basestring):
+            regexes.append(re.escape(term))
+        elif isinstance(term, _QuotedField):
+            regexes.append(field_regex)
+        else:
+            regexes.append(term.regex)
+    return "".join(regexes)
+
+def _split_at_query(terms):
+    """Internal function to split Template terms at the "?" of the query
+
+    Returns the terms before it and those after it, or None for those
+    after if there is no query.
+    """
+    for i, term in enumerate(terms):
+        if isinstance(term, basestring) and "?" in term:
+            before, after = term.split("?", 1)
+            return (terms[:i] + [before] * bool(before),
+                    [after] * bool(after) + terms[i+1:])
+    return terms, None
+
+def _query_params(terms):
+    """Internal function to split the query terms into its parameters
+
+    Returns a list of (name, value terms), or None unless each
+    parameter is a different plain text name, "=" and a value.
+    """
+    for term in terms:
+        if isinstance(term, basestring) and "#" in term:
+            return None
+    current = []
+    items = [current]
+    for term in terms:
+        if isinstance(term, basestring):
+            pieces = term.split("&")
+            current.extend(pieces[:1])
+            for piece in pieces[1:]:
+                current = [piece]
+                items.append(current)
+        else:
+            current.append(term)
+    params = []
+    names = set()
+    for item in items:
+        item = [term for term in item if term != ""]
+        if not item:
+            continue
+        if not isinstance(item[0], basestring) or "=" not in item[0]:
+            return None
+        name, value = item[0].split("=", 1)
+        if not name or name in names:
+            return None
+        names.add(name)
+        params.append( (name, [value] * bool(value) + item[1:]) )
+    return params
+
+def _decode_fields(terms, groups, result):
+    """Internal function to add the values of the fields in 'groups' to 'result'
+
+    Returns False if they can't be decoded or don't agree with values
+    already in 'result'.
+    """
+    i = 0
+    for term in terms:
+        if isinstance(term, basestring):
+            continue
+        n = len(term.tlnames)
+        values = term.decode(groups[i:i+n])
+        i += n
+        if values is None:
+            return False
+        for (tlname, value) in values:
+            if tlname in result:
+                # The same field used more than once. The values must agree.
+                if result[tlname] != value:
+                    return False
+            elif value or not term.optional:
+                result[tlname] = value
+    return True
+
 class Template(object):
     """A parsed OpenSearch Template object.
 
@@ -327,19 +525,155 @@ class Template(object):
         """You should not call this constructor directly."""
         self.template = template
         self.terms = terms
+        self._substitute = _compile_terms(terms)
+        self._matcher = None
     def substitute(self, **kwargs):
         """Use kwargs to fill in the template fields.
 
         Keywords unknown to the template ignored.
         """
         #XXX: this used to use kwargs, but that's not a good idea because not all 
-        results = []
-        for term in self.terms:
-            if isinstance(term, basestring):
-                results.append(term)
-            else:
-                results.append(term(kwargs))
-        return "".join(results)
+        return self._substitute(kwargs)
+    def _compile_matcher(self):
+        path_terms, query_terms = _split_at_query(list(self.terms))
+        if query_terms is None:
+            query_params = None
+        else:
+            query_params = _query_params(query_terms)
+        if query_params is None:
+            # Match the whole URL at once
+            regex = _compile_match(path_terms, _PATH_FIELD_REGEX)
+            if query_terms is not None:
+                regex += r"\?" + _compile_match(query_terms, _QUERY_FIELD_REGEX)
+                path_terms = path_terms + query_terms
+        else:
+            regex = _compile_match(path_terms, _PATH_FIELD_REGEX)
+            query_params = [
+                (name, re.compile(_compile_match(value_terms, _QUERY_FIELD_REGEX) + r"\Z"),
+                 value_terms,
+                 # Can the parameter be left out?
+                 not [term for term in value_terms
+                      if isinstance(term, basestring) or not term.optional])
+                for (name, value_terms) in query_params]
+        self._matcher = (re.compile(regex + r"\Z"), path_terms, query_params)
+
+    def _literal_base(self):
+        """Return the part of the template before the query if it has no fields, else None"""
+        path_terms, query_terms = _split_at_query(list(self.terms))
+        for term in path_terms:
+            if not isinstance(term, basestring):
+                return None
+        return "".join(path_terms)
+
+    def match(self, url):
+        """Extract the template fields from a URL made with this template
+
+        Returns a dictionary of the field values, or None if the URL
+        doesn't match. Query and path fields are percent-decoded and
+        converted from UTF-8. An optional field which is empty in the
+        URL is left out of the dictionary.
+
+        The part of the URL before the query must have the same
+        structure as the template. A field there matches up to the next
+        "/". If each query parameter in the template is a name, "=" and
+        a value, the URL must have the same query parameters, in any
+        order, and a field matches up to the next "&". A parameter whose
+        value is only optional fields may be left out. Otherwise the
+        query must have the same structure as the template. If two
+        fields are next to each other, the first gets as much as it can.
+        """
+        if self._matcher is None:
+            self._compile_matcher()
+        pat, path_terms, query_params = self._matcher
+        if query_params is None:
+            m = pat.match(url)
+            if m is None:
+                return None
+            result = {}
+            if not _decode_fields(path_terms, m.groups(), result):
+                return None
+            return result
+
+        path, sep, query = url.partition("?")
+        if "#" in query:
+            return None
+        m = pat.match(path)
+        if m is None:
+            return None
+        result = {}
+        if not _decode_fields(path_terms, m.groups(), result):
+            return None
+        values = {}
+        for item in query.split("&"):
+            if not item:
+                continue
+            name, sep, value = item.partition("=")
+            if name in values:
+                # Which one would it be?
+                return None
+            values[name] = value
+        for (name, value_pat, value_terms, may_omit) in query_params:
+            value = values.pop(name, None)
+            if value is None:
+                if may_omit:
+                    continue
+                return None
+            m = value_pat.match(value)
+            if m is None or not _decode_fields(value_terms, m.groups(), result):
+                return None
+        if values:
+            # Parameters which aren't in the template
+            return None
+        return result
+    def substitute_many(self, params_list):
+        """Fill in the template once for each dictionary in params_list
+
+        Returns the list of results. This is faster than calling
+        substitute() for each one.
+        """
+        return map(self._substitute, params_list)
+
+class TemplateMatcher(object):
+    """Find which of many templates matches a URL
+
+    Templates which have no fields before the query, like the query
+    templates of Akara services, are found by looking up the part of
+    the URL before the "?". The others are tried one after another.
+    """
+    def __init__(self, templates=()):
+        self._by_base = {}
+        self._others = []
+        for template in templates:
+            self.add(template)
+    def add(self, template):
+        "Add a Template, or a template string"
+        if isinstance(template, basestring):
+            template = make_template(template)
+        base = template._literal_base()
+        if base is None:
+            self._others.append(template)
+        else:
+            self._by_base.setdefault(base, []).append(template)
+    def match(self, url):
+        """Return the first matching template and its field values
+
+        Templates with no fields before the query come first, in the
+        order they were added. Returns (None, None) if none match.
+        """
+        for template in self._by_base.get(url.split("?", 1)[0], ()):
+            result = template.match(url)
+            if result is not None:
+                return template, result
+        for template in self._others:
+            result = template.match(url)
+            if result is not None:
+                return template, result
+        return None, None
+
+# Template string -> Template. Cleared if it gets too big, in case
+# someone makes templates on the fly.
+_template_cache = {}
+MAX_CACHED_TEMPLATES = 1000
 
 def make_template(template):
     """Given an OpenSearch template, return a Template instance for it.
@@ -349,8 +683,16 @@ def make_template(template):
     'http://localhost/search?q=opensearch+syntax'
     >>>
     """
+    try:
+        return _template_cache[template]
+    except KeyError:
+        pass
     terms = decompose_template(template)
-    return Template(template, terms)
+    t = Template(template, terms)
+    if len(_template_cache) >= MAX_CACHED_TEMPLATES:
+        _template_cache.clear()
+    _template_cache[template] = t
+    return t
 
 def apply_template(template, **kwargs):
     """Apply the kwargs to the template fields and return the result
@@ -364,6 +706,5 @@ def apply_template(template, **kwargs):
     
     apply_template(tpl, **{'a-b': 'cd'})
     """
-    t = make_template(template)
-    return t.substitute(**kwargs)
+    return make_template(template)._substitute(kwargs)
 
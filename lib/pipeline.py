@@ -56,6 +56,8 @@ class Pipeline(object):
         def capture_start_response(status, headers, exc_info=None):
             if exc_info is None:
                 captured_response[:] = [status, headers, False]
+                # The write() callable, for stages which stream their output
+                return captured_body.write
             else:
                 captured_response[:] = [status, headers, True]
                 # Forward this to the real start_response
@@ -18,16 +18,22 @@ class AkaraDefault:
     #"ServerRoot": None
     #"InternalServerRoot": None
     PidFile = "logs/akara.pid"
+    ScoreboardFile = "logs/akara.scoreboard"
+    MaxHistogramsPerServer = 128
 
     MinSpareServers = 5
     MaxSpareServers = 10
     MaxServers = 150
     MaxRequestsPerServer = 10000
+    MaxKeepAliveRequests = 100
+    KeepAliveTimeout = 5
 
     ModuleDir = 'modules'
     ModuleCache = 'caches'
+    PreloadModules = 0
     ErrorLog = 'logs/error.log'
     AccessLog = 'logs/access.log'
+    AccessLogFlushInterval = 1
     LogLevel = 'INFO'
 
 
@@ -186,11 +192,26 @@ def _extract_settings(config):
     pid_file = getstring('PidFile')
     settings["pid_file"] = os.path.join(config_root, pid_file)
 
+    scoreboard_file = getstring('ScoreboardFile')
+    settings["scoreboard_file"] = os.path.join(config_root, scoreboard_file)
+    # The last 6 are for the "*other*" histograms
+    max_histograms = getint("MaxHistogramsPerServer")
+    if max_histograms < 8:
+        raise Error("'Akara' configuration 'MaxHistogramsPerServer' must be "
+                    "at least 8, not %r" % (max_histograms,))
+    settings["max_histograms_per_server"] = max_histograms
+
     error_log = getstring('ErrorLog')
     settings["error_log"] = os.path.join(config_root, error_log)
 
     access_log = getstring('AccessLog')
     settings["access_log"] = os.path.join(config_root, access_log)
+    # 0 means don't buffer
+    flush_interval = getint("AccessLogFlushInterval")
+    if flush_interval < 0:
+        raise Error("'Akara' configuration 'AccessLogFlushInterval' must be "
+                    "a non-negative integer, not %r" % (flush_interval,))
+    settings["access_log_flush_interval"] = flush_interval
 
     module_dir = getstring("ModuleDir")
     settings["module_dir"] = os.path.join(config_root, module_dir)
@@ -198,6 +219,20 @@ def _extract_settings(config):
     module_cache = getstring("ModuleCache")
     settings["module_cache"] = os.path.join(config_root, module_cache)
 
+    # Either 0, 1 or a list of module names
+    preload_modules = get("PreloadModules")
+    if isinstance(preload_modules, (list, tuple)):
+        for name in preload_modules:
+            if not isinstance(name, basestring):
+                raise Error("'Akara' configuration 'PreloadModules' must contain "
+                            "only module names, not %r" % (name,))
+        settings["preload_modules"] = list(preload_modules)
+    elif preload_modules in (0, 1):
+        settings["preload_modules"] = bool(preload_modules)
+    else:
+        raise Error("'Akara' configuration 'PreloadModules' must be 0, 1, "
+                    "or a list of module names, not %r" % (preload_modules,))
+
     log_level_orig = getstring('LogLevel')
     log_level_s = log_level_orig.upper()
     if log_level_s in _valid_log_levels:
@@ -218,5 +253,7 @@ def _extract_settings(config):
         raise Error("MaxSpareServers (%r) must be greater than MinSpareServers (%r)" %
                     (settings["max_spare_servers"], settings["min_spare_servers"]))
     settings["max_requests_per_server"] = getpositive("MaxRequestsPerServer")
+    settings["max_keep_alive_requests"] = getpositive("MaxKeepAliveRequests")
+    settings["keep_alive_timeout"] = getpositive("KeepAliveTimeout")
 
     return settings
@@ -5,6 +5,7 @@ Add WSGI handlers to the Akara HTTP dispatch registry.
 """
 
 import inspect
+import re
 
 import amara
 from amara import tree
@@ -24,15 +25,88 @@ __all__ = ("register_service", "get_service")
 
 
 # We had some discussion about using the term 'path' or 'mount_point'?
-# Right now we don't really have '/' paths so there's no real difference
-# Therefore, you register mount_points, which must not have a "/" in them.
-# Incoming requests have a path, and the first segment (before the "/")
-# is used to find the mount point.
-
-# We're calling it a 'path' for future compatibility.  For more
-# complex paths we might want to use Routes or similar system, in
-# which case we'll also have pattern matching on the path segments.
-# You'll likely register a path pattern, still with the name 'path'.
+# A service is registered under a path pattern. This is one or more
+# segments separated by "/". A segment is either literal text or a
+# parameter like "{wiki}", which matches any one non-empty segment.
+# For example:
+#   "akara.xslt"
+#   "moin/{wiki}/{page}"
+# An incoming request goes to the service whose pattern matches the
+# most leading segments of the request path. The rest of the path is
+# left in PATH_INFO for the handler. The parameter values go in the
+# environ as "wsgiorg.routing_args".
+
+# The patterns are compiled into a trie with one node per segment, so
+# finding the service takes time proportional to the length of the
+# request path, and not to the number of registered services. A
+# literal segment is tried before a parameter, and wins if both match
+# the same number of segments. If the literal branch doesn't match the
+# whole path the parameter branch is tried as well, so "a/b" doesn't
+# hide "{x}/c" for the request path "a/c".
+
+_param_segment_pat = re.compile(r"^\{([A-Za-z_][A-Za-z0-9_]*)\}$")
+
+def _parse_path(path):
+    "Return the list of (literal text, parameter name) pairs for a path pattern"
+    if path == "":
+        # The special case for the server's root
+        return [("", None)]
+    segments = []
+    for segment in path.split("/"):
+        m = _param_segment_pat.match(segment)
+        if m is not None:
+            segments.append( (None, m.group(1)) )
+        elif not segment or "{" in segment or "}" in segment:
+            raise ValueError("Registered path %r has an invalid segment %r" %
+                             (path, segment))
+        else:
+            segments.append( (segment, None) )
+    return segments
+
+def _match(node, segments, index, values):
+    """Find the deepest service at or below 'node' for the request path
+
+    'node' matched segments[:index], with the parameter values in the
+    tuple 'values'. Returns (node, values, num_segments) or None.
+    """
+    best = None
+    if node.service is not None:
+        best = (node, values, index)
+    if index == len(segments):
+        return best
+    segment = segments[index]
+    child = node.literals.get(segment, None)
+    if child is not None:
+        match = _match(child, segments, index+1, values)
+        if match is not None:
+            best = match
+            if match[2] == len(segments):
+                # Nothing can match more
+                return best
+    if node.param is not None and segment:
+        match = _match(node.param, segments, index+1, values + (segment,))
+        if match is not None and (best is None or match[2] > best[2]):
+            best = match
+    return best
+
+def _split_path_info(path_info):
+    """Split a request path into segments
+
+    This gives the same segments as repeated calls to
+    wsgiref.util.shift_path_info(), which is what moves
+    them from PATH_INFO to SCRIPT_NAME.
+    """
+    parts = path_info.split("/")
+    parts[1:-1] = [p for p in parts[1:-1] if p and p != "."]
+    return parts[1:]
+
+class _RouteNode(object):
+    __slots__ = ("literals", "param", "service", "param_names")
+    def __init__(self):
+        self.literals = {}  # segment text -> _RouteNode
+        self.param = None   # _RouteNode for a parameter segment
+        self.service = None # the service mounted here
+        self.param_names = None  # its parameter names, in order
 
 class Service(object):
     "Internal class to store information about a given service resource"
@@ -85,28 +159,89 @@ class Registry(object):
     "Internal class to handle resource registration information"
     def __init__(self):
         self._registered_services = {}
+        # ident -> list of services with that ident, in registration order.
+        # An ident may be mounted at several paths.
+        self._services_by_ident = {}
+        self._routes = _RouteNode()
+        # Changes whenever a service is registered. Anything derived
+        # from the registered services can use this to tell if it is
+        # out of date.
+        self.generation = 0
 
     def register_service(self, ident, path, handler, doc=None, query_template=None):
-        if "/" in path:
-            raise ValueError("Registered path %r may not contain a '/'" % (path,))
+        segments = _parse_path(path)
         if doc is None:
             doc = inspect.getdoc(handler) or ""
-        if ident in self._registered_services:
+
+        # Find (or make) the trie node for the pattern
+        node = self._routes
+        param_names = []
+        for (text, param_name) in segments:
+            if param_name is None:
+                child = node.literals.get(text, None)
+                if child is None:
+                    child = node.literals[text] = _RouteNode()
+            else:
+                child = node.param
+                if child is None:
+                    child = node.param = _RouteNode()
+                param_names.append(param_name)
+            node = child
+
+        old_serv = node.service
+        if old_serv is not None:
+            if old_serv.path != path:
+                raise ValueError("Registered path %r conflicts with %r" %
+                                 (path, old_serv.path))
             logger.warn("Replacing mount point %r (%r)" % (path, ident))
+            self._services_by_ident[old_serv.ident].remove(old_serv)
+            if not self._services_by_ident[old_serv.ident]:
+                del self._services_by_ident[old_serv.ident]
         else:
             logger.debug("Created new mount point %r (%r)" % (path, ident))
         serv = Service(handler, path, ident, doc, query_template)
         self._registered_services[path] = serv
+        self._services_by_ident.setdefault(ident, []).append(serv)
+        node.service = serv
+        node.param_names = tuple(param_names)
+        self.generation += 1
 
     def get_service(self, path):
         return self._registered_services[path]
 
+    def match_path(self, path_info):
+        """Find the service for a request path
+
+        Returns a (service, args, num_segments) tuple where 'args' is
+        the dictionary of parameter values and 'num_segments' is the
+        number of leading path segments matched by the service
+        pattern. Raises a KeyError if there is no match.
+        """
+        best = _match(self._routes, _split_path_info(path_info), 0, ())
+        if best is None:
+            raise KeyError(path_info)
+        node, values, num_segments = best
+        return node.service, dict(zip(node.param_names, values)), num_segments
+
+    def get_services_by_ident(self, ident):
+        "Return the list of services with the given ident"
+        return self._services_by_ident.get(ident, [])
+
+    def get_a_service_by_ident(self, ident):
+        "Return the first registered service with the given ident, or None"
+        services = self._services_by_ident.get(ident, None)
+        if services:
+            return services[0]
+        return None
+
     def list_services(self, ident=None):
         document = tree.entity()
         services = document.xml_append(tree.element(None, 'services'))
-        for path, service in sorted(self._registered_services.iteritems()):
-            if ident is not None and service.ident != ident:
-                continue
+        if ident is None:
+            items = self._registered_services.iteritems()
+        else:
+            items = [(service.path, service) for service in self.get_services_by_ident(ident)]
+        for path, service in sorted(items):
             service_node = services.xml_append(tree.element(None, 'service'))
             service_node.xml_attributes['ident'] = service.ident
             E = service_node.xml_append(tree.element(None, 'path'))
@@ -127,14 +262,20 @@ def register_service(ident, path, function, doc=None, query_template=None):
 def get_service(mount_point):
     return _current_registry.get_service(mount_point)
 
+def match_path(path_info):
+    return _current_registry.match_path(path_info)
+
 def list_services(ident=None):
     return _current_registry.list_services(ident)
 
+def get_generation():
+    return _current_registry.generation
+
 def get_a_service_by_id(ident):
-    for path, service in _current_registry._registered_services.items():
-        if service.ident == ident:
-            return service
-    return None
+    return _current_registry.get_a_service_by_ident(ident)
+
+def get_services_by_id(ident):
+    return _current_registry.get_services_by_ident(ident)
 
 
 # ident -> template
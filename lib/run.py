@@ -236,7 +236,9 @@ You may want to use 'akara setup' to set up the directory structure.""" % err)
             # within a few check intervals (each about 1 second), so it
             # didn't have much long-term effect.
             logger.info("Akara server is running")
-            access_logger = logger_config.AccessLogger(settings["access_log"])
+            access_logger = logger_config.AccessLogger(
+                settings["access_log"],
+                flush_interval = settings["access_log_flush_interval"])
             server = AkaraPreforkServer(
                 minSpare = settings["min_spare_servers"],
                 maxSpare = settings["max_spare_servers"],
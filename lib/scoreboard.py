@@ -0,0 +1,486 @@
+"""Shared-memory scoreboard for the Akara server processes
+
+This is an internal module and should not be used by other libraries.
+
+The scoreboard is a memory-mapped file with one fixed-size slot for
+each server process, in the spirit of Apache's scoreboard. The master
+process creates it before it forks any servers and assigns each
+server a slot. A server only ever writes to its own slot, so no
+locking is needed, and the master never has to ask a server what it
+is doing. It reads the slot instead.
+
+Each slot holds:
+  pid - the server's process id
+  state - one of the SLOT_* characters below
+  start - when the current (or last) request started, as a time.time()
+  requests - the number of requests the server has handled
+  bytes - the number of body bytes the server has sent
+  mount_point - the mount point of the current (or last) request
+  request - the request line, like "GET /xslt?... HTTP/1.1"
+
+Each server also has its own region of latency histograms, one
+histogram for each (mount point, status class) pair it has seen, like
+("xslt", "2"). The buckets are fixed powers of two in microseconds:
+bucket 0 counts requests which took less than 2us, bucket i those
+which took [2**i, 2**(i+1)) microseconds, and the last bucket
+everything slower. That's enough to estimate quantiles to within a
+factor of two, in a few hundred bytes per histogram. A server has
+room for a fixed number of histograms, MAX_HISTOGRAMS by default. The
+last six are kept for "*other*" histograms, one for each status class,
+which count the pairs a server sees once the rest are in use.
+
+When a server exits the master adds its counts and histograms to the
+"retired" totals and frees the slot for the next server. The retired
+histograms come after the server regions, one for each pair any
+server has seen, and the file grows as needed, so a pair never moves
+into "*other*" because its server exited.
+
+Because the scoreboard is a file, anyone who can read it can see the
+current server status without disturbing the servers. The values are
+written without locks so a reader may see a slot in the middle of an
+update. That's fine for status reports.
+"""
+
+import os
+import math
+import mmap
+import struct
+import time
+
+__all__ = ["Scoreboard", "read_scoreboard", "summarize", "quantile"]
+
+# The different server states
+SLOT_FREE = "."       # no server uses this slot
+SLOT_STARTING = "S"   # forked, but still initializing
+SLOT_IDLE = "_"       # waiting for a connection
+SLOT_BUSY = "W"       # reading a request or sending a response
+SLOT_KEEPALIVE = "K"  # waiting for the next request on a kept-alive connection
+SLOT_NOTIFY = "N"     # delivering spooled notifications between requests
+
+# Servers in these states can take on a new connection
+AVAILABLE_STATES = (SLOT_STARTING, SLOT_IDLE)
+
+MAGIC = "AKSB"
+VERSION = 3
+
+# magic, version, number of slots, server start time,
+# total requests and bytes from servers which have exited,
+# the number of histograms in each server's region and
+# the number of retired histograms
+_HEADER = struct.Struct("=4sHHdQQII")
+
+# The slot fields, in order. Aligned so the numeric fields don't
+# straddle word boundaries.
+_SLOT_FIELDS = (
+    ("start", "d"),
+    ("requests", "Q"),
+    ("bytes", "Q"),
+    ("pid", "i"),
+    ("state", "c"),
+    (None, "3x"),
+    ("mount_point", "64s"),
+    ("request", "128s"),
+    )
+_SLOT_SIZE = 256
+
+def _field_layout():
+    offsets = {}
+    fmt = "="
+    for name, code in _SLOT_FIELDS:
+        if name is not None:
+            offsets[name] = (struct.calcsize(fmt), struct.Struct("=" + code))
+        fmt += code
+    assert struct.calcsize(fmt) <= _SLOT_SIZE
+    return struct.Struct(fmt + "%dx" % (_SLOT_SIZE - struct.calcsize(fmt))), offsets
+
+_SLOT, _SLOT_OFFSETS = _field_layout()
+_SLOT_NAMES = [name for (name, code) in _SLOT_FIELDS if name is not None]
+
+# Latency histograms: mount point, status class, number of requests,
+# total time (in microseconds), and the bucket counts.
+NUM_BUCKETS = 32
+MAX_HISTOGRAMS = 128
+_HISTOGRAM = struct.Struct("=64sc7xQQ%dQ" % NUM_BUCKETS)
+_HISTOGRAM_COUNT = struct.Struct("=QQ")
+_HISTOGRAM_COUNT_OFFSET = 72
+_BUCKET = struct.Struct("=Q")
+_BUCKET_OFFSET = 88
+
+# Used when a server has more histograms than fit in its region. The
+# last entries of each region are kept for these, one for each status
+# class, so requests are still counted under their own status class.
+OTHER_MOUNT_POINTS = "*other*"
+_OVERFLOW_CLASSES = ("1", "2", "3", "4", "5", "-")
+# Used for requests which didn't match a mount point
+UNKNOWN_MOUNT_POINT = "*unknown*"
+
+def _region_offset(num_slots, num_histograms, index):
+    # The histogram regions come after the slots. After the last one
+    # are the retired histograms.
+    return (_HEADER.size + num_slots * _SLOT_SIZE +
+            index * num_histograms * _HISTOGRAM.size)
+
+def _bucket(elapsed_us):
+    if elapsed_us < 2:
+        return 0
+    return min(math.frexp(elapsed_us)[1] - 1, NUM_BUCKETS - 1)
+
+def _histogram_key(mount_point, status):
+    if isinstance(mount_point, unicode):
+        mount_point = mount_point.encode("utf8")
+    if len(mount_point) > 64:
+        mount_point = OTHER_MOUNT_POINTS
+    # Only the status class ("2" for "200", "4" for "404", ...)
+    status = str(status or "-")[:1]
+    return mount_point, status
+
+def _overflow_key(key, num_histograms):
+    "Return the region index and key of the overflow histogram for a key"
+    status = key[1]
+    if status not in _OVERFLOW_CLASSES:
+        status = "-"
+    index = num_histograms - len(_OVERFLOW_CLASSES) + _OVERFLOW_CLASSES.index(status)
+    return index, (OTHER_MOUNT_POINTS, status)
+
+def _read_histograms(data, offset, num_histograms, num_regular):
+    """Read the used histograms of a region
+
+    The first 'num_regular' histograms are used in order, so the first
+    one with no status class ends them. Any after those are read too.
+    """
+    histograms = []
+    i = 0
+    while i < num_histograms:
+        values = _HISTOGRAM.unpack_from(data, offset + i * _HISTOGRAM.size)
+        if i < num_regular and values[1] == "\0":
+            i = num_regular
+            continue
+        if values[2]:
+            histograms.append(((values[0].rstrip("\0"), values[1]),
+                               values[2], values[3], values[4:]))
+        i += 1
+    return histograms
+
+
+def _encode(s, size):
+    if isinstance(s, unicode):
+        s = s.encode("utf8")
+    return s[:size]
+
+
+class Slot(object):
+    """A server's view of its own scoreboard slot"""
+    def __init__(self, mm, index, num_slots, num_histograms):
+        self._mm = mm
+        self.index = index
+        self._offset = _HEADER.size + index * _SLOT_SIZE
+        self._requests = 0
+        self._bytes = 0
+        self._region = _region_offset(num_slots, num_histograms, index)
+        self._num_histograms = num_histograms
+        # (mount point, status class) -> offset of its histogram
+        self._histograms = {}
+        self._num_regular = 0
+
+    def _set(self, name, value):
+        offset, field = _SLOT_OFFSETS[name]
+        field.pack_into(self._mm, self._offset + offset, value)
+
+    def set_state(self, state):
+        self._set("state", state)
+
+    def start_request(self, request):
+        "Called when a new request line has been read"
+        self._set("start", time.time())
+        self._set("mount_point", "")
+        self._set("request", _encode(request, 128))
+        self._set("state", SLOT_BUSY)
+
+    def set_mount_point(self, mount_point):
+        self._set("mount_point", _encode(mount_point, 64))
+
+    def end_request(self, bytes_sent):
+        "Called when the response has been sent"
+        self._requests += 1
+        self._bytes += bytes_sent
+        self._set("requests", self._requests)
+        self._set("bytes", self._bytes)
+
+    def record_latency(self, mount_point, status, elapsed_us):
+        "Add a request to the latency histogram for its mount point and status"
+        key = _histogram_key(mount_point, status)
+        entry = self._histograms.get(key)
+        if entry is None:
+            entry = self._new_histogram(key)
+        mm = self._mm
+        count, sum_us = _HISTOGRAM_COUNT.unpack_from(mm, entry + _HISTOGRAM_COUNT_OFFSET)
+        offset = entry + _BUCKET_OFFSET + _BUCKET.size * _bucket(elapsed_us)
+        _BUCKET.pack_into(mm, offset, _BUCKET.unpack_from(mm, offset)[0] + 1)
+        # Update the count last so readers never see an incomplete entry
+        _HISTOGRAM_COUNT.pack_into(mm, entry + _HISTOGRAM_COUNT_OFFSET,
+                                   count + 1, sum_us + elapsed_us)
+
+    def _new_histogram(self, key):
+        num_histograms = self._num_histograms
+        if (key[0] != OTHER_MOUNT_POINTS and
+            self._num_regular < num_histograms - len(_OVERFLOW_CLASSES)):
+            index = self._num_regular
+            self._num_regular += 1
+        else:
+            index, key = _overflow_key(key, num_histograms)
+            if key in self._histograms:
+                return self._histograms[key]
+        entry = self._region + index * _HISTOGRAM.size
+        # The count stays 0 until the first request is recorded
+        _HISTOGRAM.pack_into(self._mm, entry, key[0], key[1], 0, 0,
+                             *((0,) * NUM_BUCKETS))
+        self._histograms[key] = entry
+        return entry
+
+
+class Scoreboard(object):
+    """The scoreboard, as seen by the master process
+
+    If 'filename' is None the scoreboard is kept in anonymous shared
+    memory, which is only visible to the master and its servers, and
+    the retired histograms are only kept by the master.
+
+    Each server has room for 'num_histograms' latency histograms.
+    """
+    def __init__(self, filename, num_slots, num_histograms=MAX_HISTOGRAMS):
+        if num_histograms <= len(_OVERFLOW_CLASSES):
+            raise ValueError("num_histograms must be more than %d, not %r" %
+                             (len(_OVERFLOW_CLASSES), num_histograms))
+        self.filename = filename
+        self.num_slots = num_slots
+        self.num_histograms = num_histograms
+        # Only the slots and the server regions are mapped. The master
+        # appends the retired histograms to the file.
+        size = _region_offset(num_slots, num_histograms, num_slots)
+        if filename is None:
+            self._mm = mmap.mmap(-1, size)
+        else:
+            fd = os.open(filename, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0644)
+            try:
+                os.ftruncate(fd, size)
+                self._mm = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+        # (mount point, status class) -> [index, count, sum_us, buckets]
+        self._retired = {}
+        _HEADER.pack_into(self._mm, 0, MAGIC, VERSION, num_slots, time.time(), 0, 0,
+                          num_histograms, 0)
+        for index in range(num_slots):
+            self._clear(index)
+        # Allocate from the front, to make it easier to read
+        self._free = range(num_slots-1, -1, -1)
+
+    def _clear(self, index):
+        _SLOT.pack_into(self._mm, _HEADER.size + index * _SLOT_SIZE,
+                        0.0, 0, 0, 0, SLOT_FREE, "", "")
+        offset = _region_offset(self.num_slots, self.num_histograms, index)
+        region_size = self.num_histograms * _HISTOGRAM.size
+        self._mm[offset:offset + region_size] = "\0" * region_size
+
+    def _retire_histograms(self, index):
+        "Add the histograms of a server to the retired ones"
+        num_histograms = self.num_histograms
+        changed = []
+        for key, count, sum_us, buckets in _read_histograms(
+                self._mm, _region_offset(self.num_slots, num_histograms, index),
+                num_histograms, num_histograms - len(_OVERFLOW_CLASSES)):
+            retired = self._retired.get(key)
+            if retired is None:
+                retired = self._retired[key] = [len(self._retired), 0, 0,
+                                                [0] * NUM_BUCKETS]
+            retired[1] += count
+            retired[2] += sum_us
+            retired[3] = [a+b for (a, b) in zip(retired[3], buckets)]
+            changed.append((key, retired))
+        if not changed or self.filename is None:
+            return
+        offset = _region_offset(self.num_slots, num_histograms, self.num_slots)
+        f = open(self.filename, "r+b")
+        try:
+            for key, (i, count, sum_us, buckets) in changed:
+                f.seek(offset + i * _HISTOGRAM.size)
+                f.write(_HISTOGRAM.pack(key[0], key[1], count, sum_us, *buckets))
+        finally:
+            f.close()
+
+    def _get(self, index, name):
+        offset, field = _SLOT_OFFSETS[name]
+        return field.unpack_from(self._mm, _HEADER.size + index * _SLOT_SIZE + offset)[0]
+
+    def allocate(self):
+        "Reserve a slot for a new server. Returns the index, or None if all are in use"
+        if not self._free:
+            return None
+        index = self._free.pop()
+        _SLOT.pack_into(self._mm, _HEADER.size + index * _SLOT_SIZE,
+                        0.0, 0, 0, 0, SLOT_STARTING, "", "")
+        return index
+
+    def set_pid(self, index, pid):
+        offset, field = _SLOT_OFFSETS["pid"]
+        field.pack_into(self._mm, _HEADER.size + index * _SLOT_SIZE + offset, pid)
+
+    def release(self, index):
+        "The server in the slot has exited. Keep its totals and free the slot"
+        (magic, version, num_slots, start_time, retired_requests, retired_bytes,
+         num_histograms, num_retired) = _HEADER.unpack_from(self._mm, 0)
+        retired_requests += self._get(index, "requests")
+        retired_bytes += self._get(index, "bytes")
+        # Write the histograms before the header says they are there
+        self._retire_histograms(index)
+        _HEADER.pack_into(self._mm, 0, magic, version, num_slots, start_time,
+                          retired_requests, retired_bytes,
+                          num_histograms, len(self._retired))
+        self._clear(index)
+        self._free.append(index)
+
+    def slot(self, index):
+        "Get the Slot used by a server to update its own status"
+        return Slot(self._mm, index, self.num_slots, self.num_histograms)
+
+    def state(self, index):
+        return self._get(index, "state")
+
+    def is_available(self, index):
+        return self._get(index, "state") in AVAILABLE_STATES
+
+    def close(self):
+        self._mm.close()
+
+
+def _read(data):
+    (magic, version, num_slots, start_time, retired_requests, retired_bytes,
+     num_histograms, num_retired) = _HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not an Akara scoreboard (or an unsupported version)")
+    retired_offset = _region_offset(num_slots, num_histograms, num_slots)
+    if len(data) < retired_offset:
+        raise ValueError("Truncated Akara scoreboard")
+    # Each server's region, then the retired histograms
+    regions = [(_region_offset(num_slots, num_histograms, index), num_histograms,
+                num_histograms - len(_OVERFLOW_CLASSES)) for index in range(num_slots)]
+    num_retired = min(num_retired, (len(data) - retired_offset) // _HISTOGRAM.size)
+    regions.append( (retired_offset, num_retired, num_retired) )
+    slots = []
+    for index in range(num_slots):
+        values = _SLOT.unpack_from(data, _HEADER.size + index * _SLOT_SIZE)
+        slot = dict(zip(_SLOT_NAMES, values))
+        slot["index"] = index
+        slot["mount_point"] = slot["mount_point"].rstrip("\0")
+        slot["request"] = slot["request"].rstrip("\0")
+        slots.append(slot)
+
+    # Merge the histograms from all of the servers, past and present
+    histograms = {}
+    for offset, num_entries, num_regular in regions:
+        for key, count, sum_us, buckets in _read_histograms(
+                                    data, offset, num_entries, num_regular):
+            if key in histograms:
+                old = histograms[key]
+                buckets = [a+b for (a, b) in zip(old["buckets"], buckets)]
+                count += old["count"]
+                sum_us += old["sum_us"]
+            histograms[key] = dict(count = count, sum_us = sum_us,
+                                   buckets = list(buckets))
+    return dict(start_time = start_time,
+                retired_requests = retired_requests,
+                retired_bytes = retired_bytes,
+                slots = slots,
+                histograms = histograms)
+
+def read_scoreboard(filename):
+    """Read a snapshot of the scoreboard file
+
+    Returns a dictionary with the server 'start_time', the
+    'retired_requests' and 'retired_bytes' of servers which have
+    exited, 'slots', a list with a dictionary for each slot, and
+    'histograms', which maps each (mount point, status class) to a
+    dictionary with the 'count', total time ('sum_us') and 'buckets'
+    of the latency histogram, merged across all of the servers.
+    """
+    f = open(filename, "rb")
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    if len(data) < _HEADER.size:
+        raise ValueError("Not an Akara scoreboard (or an unsupported version)")
+    return _read(data)
+
+def summarize(status, now=None):
+    """Summarize a read_scoreboard() snapshot for a status report
+
+    Returns a dictionary with:
+      busy - the number of servers handling a connection
+      idle - the number of servers waiting for a connection
+      total_requests - the number of requests since the server started
+      total_bytes - the number of body bytes sent since then
+      uptime - the number of seconds since the server started
+      requests_per_second - the average since the server started
+      workers - a list of the slot dictionaries of the running servers,
+         each with an extra 'elapsed' field. For busy servers that's
+         the number of seconds spent so far on the current request,
+         otherwise it's None.
+    """
+    if now is None:
+        now = time.time()
+    busy = idle = 0
+    total_requests = status["retired_requests"]
+    total_bytes = status["retired_bytes"]
+    workers = []
+    for slot in status["slots"]:
+        state = slot["state"]
+        if state == SLOT_FREE:
+            continue
+        total_requests += slot["requests"]
+        total_bytes += slot["bytes"]
+        worker = slot.copy()
+        if state in AVAILABLE_STATES:
+            idle += 1
+            worker["elapsed"] = None
+        else:
+            busy += 1
+            if state == SLOT_BUSY:
+                worker["elapsed"] = max(0.0, now - slot["start"])
+            else:
+                worker["elapsed"] = None
+        workers.append(worker)
+
+    uptime = max(0.0, now - status["start_time"])
+    if uptime > 0:
+        requests_per_second = total_requests / uptime
+    else:
+        requests_per_second = 0.0
+    return dict(busy = busy,
+                idle = idle,
+                total_requests = total_requests,
+                total_bytes = total_bytes,
+                uptime = uptime,
+                requests_per_second = requests_per_second,
+                workers = workers)
+
+def quantile(buckets, q):
+    """Estimate the q-quantile (0.0 <= q <= 1.0) of a latency histogram
+
+    Returns the estimate in microseconds, interpolating linearly
+    within the bucket, or None if the histogram is empty.
+    """
+    total = sum(buckets)
+    if total == 0:
+        return None
+    rank = q * total
+    seen = 0
+    for i, count in enumerate(buckets):
+        if count and seen + count >= rank:
+            if i == 0:
+                low, high = 0, 2
+            else:
+                low, high = 2**i, 2**(i+1)
+            return low + (high - low) * (rank - seen) / float(count)
+        seen += count
+    return float(2**NUM_BUCKETS)
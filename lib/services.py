@@ -8,18 +8,25 @@ module.
 import httplib
 import warnings
 import functools
-import cgi
+import hashlib
 import inspect
+import os
+import re
+import types
+import urllib
 from cStringIO import StringIO
+from email.utils import formatdate, parsedate_tz, mktime_tz
 from xml.sax.saxutils import escape as xml_escape
 
 from BaseHTTPServer import BaseHTTPRequestHandler
+from wsgiref.util import shift_path_info
 http_responses = BaseHTTPRequestHandler.responses
 del BaseHTTPRequestHandler
 
 from amara import tree, writers
 
-from akara import logger, registry
+from akara import logger, registry, notify
+from akara.thirdparty import httpserver
 
 __all__ = ("service", "simple_service", "method_dispatcher")
 
@@ -64,38 +71,122 @@ class _HTTP405(_HTTPError):
         self.headers.append( ("Allow", ", ".join(methods)) )
 
 
-# Pull out any query arguments and set up input from any POST request
-def _get_function_args(environ, allow_repeated_args):
-    request_method = environ.get("REQUEST_METHOD")
-    if request_method == "POST":
+# Read the body of a POST request, which is passed as the
+# first two positional arguments of a simple service
+def _get_post_args(environ):
+    try:
+        request_length = int(environ["CONTENT_LENGTH"])
+    except (KeyError, ValueError):
+        raise _HTTPError(httplib.LENGTH_REQUIRED)
+    if request_length < 0:
+        raise _HTTPError(httplib.BAD_REQUEST)
+    request_bytes = environ["wsgi.input"].read(request_length)
+    request_content_type = environ.get("CONTENT_TYPE", None)
+    return (request_bytes, request_content_type)
+
+# Same separators as cgi.parse_qs
+_query_item_split = re.compile("[&;]").split
+
+class _ArgBinder(object):
+    """How to turn a request into the arguments for a simple service
+
+    This is made once, from the function signature, when the service
+    is registered. Binding a request then needs one pass over the query
+    string. Query parameters which the function does not accept, and
+    missing parameters which it requires, are reported as a 400 error
+    instead of failing in the function call. A function with a
+    **kwargs parameter accepts any query parameter.
+
+    'arg_types' maps a parameter name to a callable, like int, which
+    converts the query string value. If it raises a ValueError or
+    TypeError then the request is a 400 error. With allow_repeated_args
+    each item of the list is converted.
+    """
+    def __init__(self, func, method, allow_repeated_args, arg_types=None):
+        self.is_post = (method == "POST")
+        self.allow_repeated_args = allow_repeated_args
         try:
-            request_length = int(environ["CONTENT_LENGTH"])
-        except (KeyError, ValueError):
-            raise _HTTPError(httplib.LENGTH_REQUIRED)
-        if request_length < 0:
-            raise _HTTPError(httplib.BAD_REQUEST)
-        request_bytes = environ["wsgi.input"].read(request_length)
-        request_content_type = environ.get("CONTENT_TYPE", None)
-        args = (request_bytes, request_content_type)
-    else:
-        args = ()
-
-    # Build up the keyword parameters from the query string
-    query_string = environ["QUERY_STRING"]
-    kwargs = {}
-    if query_string:
-        qs_dict = cgi.parse_qs(query_string)
-        if allow_repeated_args:
-            kwargs = qs_dict
+            argspec = inspect.getargspec(func)
+        except TypeError:
+            # Not a Python function. Pass everything through and let
+            # the call decide.
+            names, defaults, accepts_any = [], (), True
+        else:
+            names = argspec.args
+            if inspect.ismethod(func) and func.im_self is not None:
+                names = names[1:]
+            defaults = argspec.defaults or ()
+            accepts_any = argspec.keywords is not None
+        num_required = len(names) - len(defaults)
+        # A POST passes the request body and content-type as the
+        # first two parameters; they cannot come from the query string.
+        if self.is_post:
+            num_positional = 2
         else:
-            for k, v in qs_dict.iteritems():
-                if len(v) == 1:
-                    kwargs[k] = v[0]
+            num_positional = 0
+        self.names = frozenset(names[num_positional:])
+        self.required = tuple(names[num_positional:num_required])
+        self.accepts_any = accepts_any
+
+        self.arg_types = {}
+        for name, converter in (arg_types or {}).items():
+            if not accepts_any and name not in self.names:
+                raise ValueError("arg_types has %r but %r does not take that parameter"
+                                 % (name, getattr(func, "__name__", func)))
+            self.arg_types[name] = converter
+
+    def parse_query(self, query_string):
+        "Make the keyword arguments for the call from the QUERY_STRING"
+        kwargs = {}
+        if not query_string:
+            return kwargs
+        names = self.names
+        accepts_any = self.accepts_any
+        arg_types = self.arg_types
+        allow_repeated_args = self.allow_repeated_args
+        unquote = urllib.unquote_plus
+        for item in _query_item_split(query_string):
+            name, _, value = item.partition("=")
+            if not value:
+                # Like cgi.parse_qs, ignore blank values
+                continue
+            if "%" in name or "+" in name:
+                name = unquote(name)
+            if name not in names and not accepts_any:
+                raise _HTTPError(400,
+   message="The %r query parameter is not supported" % (name,))
+            if "%" in value or "+" in value:
+                value = unquote(value)
+            if name in arg_types:
+                try:
+                    value = arg_types[name](value)
+                except (ValueError, TypeError):
+                    raise _HTTPError(400,
+   message="Bad value for the %r query parameter" % (name,))
+            if allow_repeated_args:
+                if name in kwargs:
+                    kwargs[name].append(value)
                 else:
-                    raise _HTTPError(400, 
-   message="Using the %r query parameter multiple times is not supported" % (k,))
-            
-    return args, kwargs
+                    kwargs[name] = [value]
+            elif name in kwargs:
+                raise _HTTPError(400, 
+   message="Using the %r query parameter multiple times is not supported" % (name,))
+            else:
+                kwargs[name] = value
+        return kwargs
+
+    def bind(self, environ):
+        "Return the (args, kwargs) to call the function with"
+        if self.is_post:
+            args = _get_post_args(environ)
+        else:
+            args = ()
+        kwargs = self.parse_query(environ["QUERY_STRING"])
+        for name in self.required:
+            if name not in kwargs:
+                raise _HTTPError(400,
+   message="The %r query parameter is required" % (name,))
+        return args, kwargs
 
 ######
 
@@ -106,13 +197,16 @@ def new_request(environ):
     response.code = "200 OK"
     response.headers = []
 
-def send_headers(start_response, default_content_type, content_length):
-    "Send the WSGI headers, using values from akara.request.*"
-    from akara import response
-    code = response.code
+def _status_line(code):
     if isinstance(code, int):
         reason = http_responses[code][0]
         code = "%d %s" % (code, reason)
+    return code
+
+def send_headers(start_response, default_content_type, content_length):
+    "Send the WSGI headers, using values from akara.request.*"
+    from akara import response
+    code = _status_line(response.code)
     has_content_type = False
     has_content_length = False
     for k, v in response.headers:
@@ -127,10 +221,39 @@ def send_headers(start_response, default_content_type, content_length):
     if not has_content_length and content_length is not None:
         response.headers.append( ("Content-Length", content_length) )
 
-    start_response(code, response.headers)
+    return start_response(code, response.headers)
+
+
+# Streamed XML is sent to the client in blocks of about this size
+STREAM_BLOCK_SIZE = 16*1024
+
+class _TreeStream(object):
+    "Serialize an Amara tree straight to a WSGI write() callable"
+    def __init__(self, doc, writer, encoding):
+        self.doc = doc
+        self.writer = writer
+        self.encoding = encoding
+
+    def send(self, wsgi_write):
+        self._wsgi_write = wsgi_write
+        self._buffer = StringIO()
+        self.doc.xml_write(self.writer, self, self.encoding)
+        self.flush()
+        return []
 
+    # The Amara writers call this with many small strings
+    def write(self, s):
+        self._buffer.write(s)
+        if self._buffer.tell() >= STREAM_BLOCK_SIZE:
+            self.flush()
 
-def convert_body(body, content_type, encoding, writer):
+    def flush(self):
+        data = self._buffer.getvalue()
+        if data:
+            self._buffer = StringIO()
+            self._wsgi_write(data)
+
+def convert_body(body, content_type, encoding, writer, stream=False):
     if isinstance(body, str):
         if content_type is None:
             content_type = "text/plain"
@@ -145,6 +268,10 @@ def convert_body(body, content_type, encoding, writer):
             else:
                 content_type = "application/xml"
         w = writers.lookup(writer)
+        if stream:
+            # The caller must pass the write() callable from
+            # start_response to the result's send() method.
+            return _TreeStream(body, w, encoding), content_type, None
         body = body.xml_encode(w, encoding)
         return [body], content_type, len(body)
 
@@ -154,16 +281,134 @@ def convert_body(body, content_type, encoding, writer):
             content_type = "text/plain; charset=%s" % (encoding,)
         return [body], content_type, len(body)
 
-    # Probably one of the normal WSGI responses
+    if isinstance(body, file):
+        # A real file, like an akara.caching.CacheFile. Send the rest
+        # of it using the server's file_wrapper, which may be able to
+        # send it without copying it through Python.
+        if content_type is None:
+            info = getattr(body, "info", None)
+            if info is not None and info() is not None:
+                content_type = info().get("Content-Type")
+            if content_type is None:
+                content_type = "text/plain"
+        try:
+            content_length = os.fstat(body.fileno()).st_size - body.tell()
+        except (IOError, OSError, ValueError):
+            content_length = None
+        from akara import request
+        environ = getattr(request, "environ", None) or {}
+        file_wrapper = environ.get("wsgi.file_wrapper", httpserver.FileWrapper)
+        return file_wrapper(body, 64*1024), content_type, content_length
+
     if content_type is None:
         content_type = "text/plain"
+
+    if isinstance(body, types.GeneratorType):
+        # Send each part as soon as it's made. The server uses the
+        # chunked transfer-coding since the length isn't known.
+        return _convert_chunks(body, encoding, writer), content_type, None
+
+    # Probably one of the normal WSGI responses
     return body, content_type, None
 
+def _convert_chunks(body, encoding, writer):
+    w = None
+    try:
+        for chunk in body:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode(encoding)
+            elif isinstance(chunk, tree.entity):
+                if w is None:
+                    w = writers.lookup(writer)
+                chunk = chunk.xml_encode(w, encoding)
+            yield chunk
+    finally:
+        body.close()
+
 
 # The HTTP spec says a method can be and 1*CHAR, where CHAR is a
 # US-ASCII character excepting control characters and "punctuation".
 # (like '(){}' and even ' '). We're a bit more strict than that
 # because we haven't seen people use words like "get".
+def _make_cache_key(cache, path, environ, kwargs):
+    routing_args = environ.get("wsgiorg.routing_args", ((), {}))[1]
+    return cache.make_key(path, kwargs, routing_args)
+
+def _cache_response(cache, key, result):
+    "Store a successful response in the ResponseCache, if the body is complete"
+    from akara import response
+    if isinstance(result, list):
+        status = _status_line(response.code)
+        if status[:3] == "200":
+            cache.put(key, status, response.headers, "".join(result))
+
+def _get_header(headers, name):
+    "Return the value of the named response header, or None"
+    name = name.lower()
+    for k, v in headers:
+        if k.lower() == name:
+            return v
+    return None
+
+def _parse_http_date(s):
+    t = parsedate_tz(s)
+    if t is None:
+        return None
+    return mktime_tz(t)
+
+def _add_validator(version):
+    """Add a handler-supplied validator to the response headers
+
+    A string is a version, used as the ETag. A number is the time the
+    resource was last modified, used as the Last-Modified header.
+    """
+    from akara import response
+    if isinstance(version, basestring):
+        if not (version.startswith('"') or version.startswith('W/"')):
+            version = '"%s"' % (version,)
+        response.headers.append( ("ETag", version) )
+    else:
+        response.headers.append( ("Last-Modified", formatdate(version, usegmt=True)) )
+
+def _add_body_etag(result):
+    "Use the hash of a complete body as the ETag, unless there is a validator"
+    from akara import response
+    headers = response.headers
+    if (_get_header(headers, "ETag") is None and
+        _get_header(headers, "Last-Modified") is None):
+        digest = hashlib.sha1()
+        for s in result:
+            digest.update(s)
+        headers.append( ("ETag", '"%s"' % (digest.hexdigest(),)) )
+
+def _is_ok():
+    "Only a 200 response gets a body ETag and may become a 304"
+    from akara import response
+    return _status_line(response.code)[:3] == "200"
+
+def _is_not_modified(environ, headers):
+    "Check if the client's copy, according to its request headers, is current"
+    if_none_match = environ.get("HTTP_IF_NONE_MATCH")
+    if if_none_match is not None:
+        # If-Modified-Since is ignored when there is an If-None-Match
+        etag = _get_header(headers, "ETag")
+        return etag is not None and _etag_matches(if_none_match, etag)
+    if_modified_since = environ.get("HTTP_IF_MODIFIED_SINCE")
+    if if_modified_since is not None:
+        last_modified = _get_header(headers, "Last-Modified")
+        if last_modified is not None:
+            last_modified = _parse_http_date(last_modified)
+            if_modified_since = _parse_http_date(if_modified_since)
+            return (last_modified is not None and if_modified_since is not None and
+                    last_modified <= if_modified_since)
+    return False
+
+def _send_not_modified(start_response, headers):
+    headers = [(k, v) for (k, v) in headers
+                   if k.lower() not in ("content-type", "content-length")]
+    start_response("304 Not Modified", headers)
+    return []
+
 def _check_is_valid_method(method):
     min_c = min(method)
     max_c = max(method)
@@ -171,14 +416,17 @@ def _check_is_valid_method(method):
         raise ValueError("HTTP method %r value is not valid. "
                          "It must contain only uppercase ASCII letters" % (method,))
 
-def _no_slashes(path):
-    if path is not None and "/" in path:
-        # Really these are more like mount points
-        raise ValueError("service paths may not contain a '/'")
+def _check_path(path):
+    # Report a bad path pattern when the service is defined
+    if path is not None:
+        registry._parse_path(path)
 
-def ignore_start_response(status, response_headers, exc_info=None):
+def _ignore_write(data):
     pass
 
+def ignore_start_response(status, response_headers, exc_info=None):
+    return _ignore_write
+
 def _make_query_template(func):
     argspec = inspect.getargspec(func)
     if argspec.varargs is not None or argspec.keywords is not None:
@@ -216,28 +464,42 @@ def _handle_notify(environ, f, service_list):
             pass
 
 FROM_ENVIRON = object()
-def _handle_notify_before(environ, body, service_list):
+def _handle_notify_before(environ, body, service_list, notify_async=False):
     if not service_list:
         return
     if body is FROM_ENVIRON:
         body = environ["wsgi.input"].read()
     f = StringIO(body)
     environ["wsgi.input"] = f
+    if notify_async:
+        notify.spool_notifications(environ, body, service_list)
+        return
     _handle_notify(environ, f, service_list)
     f.seek(0)
 
-def _handle_notify_after(environ, result, service_list):
+def _handle_notify_after(environ, result, service_list, notify_async=False):
     if not service_list:
         return result
+    return _stream_then_notify(environ, result, service_list, notify_async)
+
+# Pass the response through to the client while keeping a copy. The
+# notify services get the copy once the response is done.
+def _stream_then_notify(environ, result, service_list, notify_async=False):
     f = StringIO()
-    for block in result:
-        f.write(block)
+    try:
+        for block in result:
+            f.write(block)
+            yield block
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    if notify_async:
+        notify.spool_notifications(environ, f.getvalue(), service_list)
+        return
     # XXX ALso need to set the CONTENT_TYPE (and others?)
     environ["CONTENT_LENGTH"] = f.tell()
     environ["wsgi.input"] = f
     _handle_notify(environ, f, service_list)
-    f.seek(0)
-    return f
 
 ###### public decorators
 
@@ -254,12 +516,13 @@ def service(service_id, path=None,
             query_template = None,
             wsgi_wrapper=None,
             notify_before = None,
-            notify_after = None):
-    _no_slashes(path)
+            notify_after = None,
+            notify_async = False):
+    _check_path(path)
     def service_wrapper(func):
         @functools.wraps(func)
         def wrapper(environ, start_response):
-            _handle_notify_before(environ, FROM_ENVIRON, notify_before)
+            _handle_notify_before(environ, FROM_ENVIRON, notify_before, notify_async)
             # 'service' passes the WSGI request straight through
             # to the handler so there's almost no point in
             # setting up the environment. However, I can conceive
@@ -270,7 +533,7 @@ def service(service_id, path=None,
 
             # You need to make sure you sent the correct content-type!
             result, ctype, length = convert_body(result, None, encoding, writer)
-            result = _handle_notify_after(environ, result, notify_after)
+            result = _handle_notify_after(environ, result, notify_after, notify_async)
             return result
 
         pth = path
@@ -299,17 +562,24 @@ def service(service_id, path=None,
 
 def simple_service(method, service_id, path=None,
                    content_type=None, encoding="utf-8", writer="xml",
+                   stream=False,
                    allow_repeated_args=False,
+                   arg_types=None,
+                   cache=None,
+                   conditional=False,
+                   validator=None,
                    query_template=None,
                    wsgi_wrapper=None,
-                   notify_before=None, notify_after=None):
+                   notify_before=None, notify_after=None, notify_async=False):
     """Add the function as an Akara resource
 
     These affect how the resource is registered in Akara
       method - the supported HTTP method (either "GET" or "POST")
       service_id - a string which identifies this service; should be a URL
-      path - the local URL path to the resource (must not at present
-           contain a '/') If None, use the function's name as the path.
+      path - the local URL path to the resource. It may have several
+           segments, and a segment like "{name}" matches any value, which
+           the handler gets from environ["wsgiorg.routing_args"]. (See
+           akara.registry.) If None, use the function's name as the path.
       query_template - An Akara URL service template (based on OpenSource; see akara.opensource)
            Can be used to help consumers compose resources withing this service.  The same
            template is used for all HTTP methods
@@ -323,6 +593,12 @@ def simple_service(method, service_id, path=None,
           to the bytes used in the HTTP response
       writer - Used to serialize the Amara tree for the HTTP response.
           This must be a name which can be used as an Amara.writer.lookup.
+      stream - If False, serialize a returned Amara tree to a string so
+          the response has a Content-Length. If True, send the XML to the
+          client while serializing it, without keeping the whole document
+          in memory. This uses the WSGI write() callable, which some
+          wsgi_wrapper middleware does not support. (Ignored when there
+          are notify_after services.)
 
     This affects how to convert the QUERY_STRING into function call parameters
       allow_repeated_args - The query string may have multiple items with the
@@ -332,11 +608,52 @@ def simple_service(method, service_id, path=None,
           contains no repeated arguments, as in "?a=x&b=w". If
           allow_repeated_args is True then the function is called as
           as "f(a=['x'], b=['w'])" and if False, like "f(a='x', b='w')".
+      arg_types - a dictionary mapping a parameter name to a callable, like
+          int or float, used to convert its query string value. A value
+          which can't be converted gives a 400 error.
+
+    The function signature is checked when the service is registered. A
+    request with a query parameter the function does not take, or
+    missing one it requires, gets a 400 error without calling it.
     
+    This memoizes the response
+      cache - an akara.caching.ResponseCache. A GET response with a complete
+          body is stored and later requests with the same query parameters
+          get it without calling the function. This also turns off 'stream'.
+          If the cache was made with single_flight=True then only one server
+          process at a time calls the function for a given key.
+
+    These pass the request to other services
+      notify_before - a list of service ids. Each of these services gets a
+          copy of the request before the function is called.
+      notify_after - a list of service ids. Each of these services gets the
+          response body once it has been sent.
+      notify_async - If True, don't call the notify services while handling
+          the request. Save the notifications in a spool under the
+          ModuleCache directory, where the server processes deliver them
+          between requests, with retries. (See akara.notify.)
+
+    These support conditional GET requests (If-None-Match and If-Modified-Since)
+      conditional - If True, and the function did not add an ETag or
+          Last-Modified header to akara.response, use a hash of the
+          complete response body as the ETag. A client which already has
+          the current response gets a "304 Not Modified" with no body.
+      validator - a function called with the same arguments as the
+          decorated function, before it. It returns a version string,
+          used as the ETag, a time.time() number, used as Last-Modified,
+          or None if it doesn't know. If the client already has that
+          version, the decorated function is not called.
+
     A simple_service decorated function can get request information from
     akara.request and use akara.response to set the HTTP reponse code
     and the HTTP response headers.
 
+    If the function is a generator then each string, Unicode string or
+    Amara tree it yields is sent to the client as soon as it is made,
+    using the HTTP/1.1 chunked transfer-coding. The response code and
+    headers are sent before the generator starts, so it cannot change
+    them.
+
     Here is an example of use:
 
       @simple_service("GET", "http://example.com/get_date")
@@ -389,13 +706,19 @@ def simple_service(method, service_id, path=None,
     See implementation notes in the code below.
 
 """
-    _no_slashes(path)
+    _check_path(path)
     _check_is_valid_method(method)
     if method not in ("GET", "POST"):
         raise ValueError(
             "simple_service only supports GET and POST methods, not %s" % (method,))
+    if cache is not None and method != "GET":
+        raise ValueError("simple_service only supports a cache for GET, not %s" % (method,))
+    if (conditional or validator is not None) and method != "GET":
+        raise ValueError("simple_service only supports conditional requests for GET, not %s" %
+                         (method,))
 
     def service_wrapper(func):
+        bind_args = _ArgBinder(func, method, allow_repeated_args, arg_types).bind
         @functools.wraps(func)
         def wrapper(environ, start_response):
             try:
@@ -404,21 +727,56 @@ def simple_service(method, service_id, path=None,
                         raise _HTTP405(["GET"])
                     else:
                         raise _HTTP405(["POST"])
-                args, kwargs = _get_function_args(environ, allow_repeated_args)
+                args, kwargs = bind_args(environ)
             except _HTTPError, err:
                 return err.make_wsgi_response(environ, start_response)
             if args:
                 body = args[0]
             else:
                 body = ""
-            _handle_notify_before(environ, body, notify_before)
+            _handle_notify_before(environ, body, notify_before, notify_async)
 
             new_request(environ)
-            result = func(*args, **kwargs)
+            if validator is not None:
+                from akara import response
+                version = validator(*args, **kwargs)
+                if version is not None:
+                    _add_validator(version)
+                    if _is_not_modified(environ, response.headers):
+                        return _send_not_modified(start_response, response.headers)
+
+            lock = None
+            if cache is not None:
+                cache_key = _make_cache_key(cache, pth, environ, kwargs)
+                cached, lock = cache.get_or_lock(cache_key)
+                if cached is not None:
+                    status, headers, body = cached
+                    if conditional and _is_not_modified(environ, headers):
+                        return _send_not_modified(start_response, headers)
+                    start_response(status, list(headers))
+                    return _handle_notify_after(environ, [body], notify_after,
+                                                notify_async)
+
+            try:
+                result = func(*args, **kwargs)
 
-            result, ctype, clength = convert_body(result, content_type, encoding, writer)
-            send_headers(start_response, ctype, clength)
-            result = _handle_notify_after(environ, result, notify_after)
+                result, ctype, clength = convert_body(result, content_type, encoding, writer,
+                                                      stream and not notify_after and cache is None)
+                if conditional and isinstance(result, list) and _is_ok():
+                    from akara import response
+                    _add_body_etag(result)
+                    if _is_not_modified(environ, response.headers):
+                        return _send_not_modified(start_response, response.headers)
+                write = send_headers(start_response, ctype, clength)
+                if isinstance(result, _TreeStream):
+                    return result.send(write)
+                if cache is not None:
+                    _cache_response(cache, cache_key, result)
+            finally:
+                # Let the other processes waiting for this response find it
+                if lock is not None:
+                    lock.release()
+            result = _handle_notify_after(environ, result, notify_after, notify_async)
             return result
 
         pth = path
@@ -440,6 +798,9 @@ def simple_service(method, service_id, path=None,
         wrapper.content_type = content_type
         wrapper.encoding = encoding
         wrapper.writer = writer
+        wrapper.stream = stream
+        wrapper.cache = cache
+        wrapper.conditional = conditional
 
         registry.register_service(service_id, pth, wrapper, query_template=qt)
         return wrapper
@@ -521,8 +882,10 @@ def method_dispatcher(service_id, path=None, wsgi_wrapper=None, query_template=N
     Used for resources which handle, say, both GET and POST requests.
 
       service_id - a string which identifies this service; should be a URL
-      path - the local URL path to the resource (must not at present
-           contain a '/') If None, use the function's name as the path.
+      path - the local URL path to the resource. It may have several
+           segments, and a segment like "{name}" matches any value, which
+           the handler gets from environ["wsgiorg.routing_args"]. (See
+           akara.registry.) If None, use the function's name as the path.
       wsgi_wrapper - An outer WSGI component to be wrapped around the methods
       query_template - An Akara URL service template (based on OpenSource; see akara.opensource)
            Can be used to help consumers compose resources withing this service.  The same
@@ -550,7 +913,7 @@ def method_dispatcher(service_id, path=None, wsgi_wrapper=None, query_template=N
         curl --data "" http://localhost:8880/something
 
     """
-    _no_slashes(path)
+    _check_path(path)
     def method_dispatcher_wrapper(func):
         # Have to handle a missing docstring here as otherwise
         # the registry will try to get it from the dispatcher.
@@ -614,31 +977,76 @@ class service_dispatcher_decorator(object):
         return service_dispatch_decorator_method_wrapper
 
     def simple_method(self, method, content_type=None,
-                      encoding="utf-8", writer="xml", allow_repeated_args=False):
+                      encoding="utf-8", writer="xml", allow_repeated_args=False,
+                      stream=False, arg_types=None, cache=None,
+                      conditional=False, validator=None):
         _check_is_valid_method(method)
         if method not in ("GET", "POST"):
             raise ValueError(
                 "simple_method only supports GET and POST methods, not %s" %
                 (method,))
+        if cache is not None and method != "GET":
+            raise ValueError("simple_method only supports a cache for GET, not %s" %
+                             (method,))
+        if (conditional or validator is not None) and method != "GET":
+            raise ValueError("simple_method only supports conditional requests for GET, not %s" %
+                             (method,))
         
         def service_dispatch_decorator_simple_method_wrapper(func):
+            bind_args = _ArgBinder(func, method, allow_repeated_args, arg_types).bind
             @functools.wraps(func)
             def simple_method_wrapper(environ, start_response):
                 try:
-                    args, kwargs = _get_function_args(environ, allow_repeated_args)
+                    args, kwargs = bind_args(environ)
                 except _HTTPError, err:
                     return err.make_wsgi_response(environ, start_response)
                 new_request(environ)
-                result = func(*args, **kwargs)
+                if validator is not None:
+                    from akara import response
+                    version = validator(*args, **kwargs)
+                    if version is not None:
+                        _add_validator(version)
+                        if _is_not_modified(environ, response.headers):
+                            return _send_not_modified(start_response, response.headers)
+
+                lock = None
+                if cache is not None:
+                    cache_key = _make_cache_key(cache, self.dispatcher.path, environ, kwargs)
+                    cached, lock = cache.get_or_lock(cache_key)
+                    if cached is not None:
+                        status, headers, body = cached
+                        if conditional and _is_not_modified(environ, headers):
+                            return _send_not_modified(start_response, headers)
+                        start_response(status, list(headers))
+                        return [body]
 
-                result, ctype, clength = convert_body(result, content_type, encoding, writer)
-                send_headers(start_response, ctype, clength)
+                try:
+                    result = func(*args, **kwargs)
+
+                    result, ctype, clength = convert_body(result, content_type, encoding, writer,
+                                                          stream and cache is None)
+                    if conditional and isinstance(result, list) and _is_ok():
+                        from akara import response
+                        _add_body_etag(result)
+                        if _is_not_modified(environ, response.headers):
+                            return _send_not_modified(start_response, response.headers)
+                    write = send_headers(start_response, ctype, clength)
+                    if isinstance(result, _TreeStream):
+                        return result.send(write)
+                    if cache is not None:
+                        _cache_response(cache, cache_key, result)
+                finally:
+                    if lock is not None:
+                        lock.release()
                 return result
 
             #For purposes of inspection (not a good idea to change these otherwise you'll lose sync with the values closed over)
             simple_method_wrapper.content_type = content_type
             simple_method_wrapper.encoding = encoding
             simple_method_wrapper.writer = writer
+            simple_method_wrapper.stream = stream
+            simple_method_wrapper.cache = cache
+            simple_method_wrapper.conditional = conditional
 
             self.dispatcher.add_handler(method, simple_method_wrapper)
             return simple_method_wrapper
@@ -648,9 +1056,340 @@ class service_dispatcher_decorator(object):
     #def xml_method(self, method="POST", content_type="text/xml"):
     # ...
 
+def _etag_matches(if_none_match, etag):
+    "Check an If-None-Match header value against an entity tag"
+    if if_none_match.strip() == "*":
+        return True
+    if etag.startswith("W/"):
+        opaque_tag = etag[2:]
+    else:
+        opaque_tag = etag
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        # If-None-Match uses the weak comparison
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == opaque_tag:
+            return True
+    return False
+
+# Pollers ask for the service listing all the time, and it only
+# changes when a service is registered. Keep the serialized listing
+# for each 'service' filter, and its ETag, until the registry changes.
+# The ETag is the listing service's validator, so a poller which has
+# the current listing gets a 304 without it being serialized again.
+_listing_cache = {}
+_listing_generation = None
+
+def _get_listing(ident):
+    global _listing_generation
+    generation = registry.get_generation()
+    if generation != _listing_generation:
+        _listing_cache.clear()
+        _listing_generation = generation
+    try:
+        return _listing_cache[ident]
+    except KeyError:
+        pass
+    doc = registry.list_services(ident=ident)
+    body = doc.xml_encode(writers.lookup("xml"), "utf-8")
+    etag = '"%s"' % (hashlib.sha1(body).hexdigest(),)
+    if ident is None or registry.get_services_by_id(ident):
+        # Only cache listings for known idents so clients can't fill memory
+        _listing_cache[ident] = (body, etag)
+    return body, etag
+
+def _listing_version(service=None):
+    return _get_listing(service)[1]
+
 # Install some built-in services
 @simple_service("GET", "http://purl.org/xml3k/akara/services/registry", "",
-                allow_repeated_args=False)
+                content_type="application/xml", allow_repeated_args=False,
+                validator=_listing_version)
 def list_services(service=None):
-    return registry.list_services(ident=service) # XXX 'ident' or 'service' ?
+    body, etag = _get_listing(service) # XXX 'ident' or 'service' ?
+    return body
 
+
+# The batch service runs at most this many requests
+MAX_BATCH_SIZE = 100
+
+BATCH_SERVICE_ID = "http://purl.org/xml3k/akara/services/batch"
+
+class _BatchItemError(Exception):
+    pass
+
+def _utf8(value):
+    if isinstance(value, unicode):
+        return value.encode("utf8")
+    if isinstance(value, list):
+        return [_utf8(v) for v in value]
+    return value
+
+def _run_batch_item(environ, item):
+    "Run one request from a batch. Returns (status, headers, body)"
+    if not isinstance(item, dict):
+        raise _BatchItemError("each item must be a JSON object")
+    path = item.get("path")
+    if not isinstance(path, basestring):
+        raise _BatchItemError("missing 'path'")
+    path = path.encode("utf8")
+    if not path.startswith("/"):
+        path = "/" + path
+    method = item.get("method", "GET")
+    if not isinstance(method, basestring) or not method.isupper():
+        raise _BatchItemError("bad 'method'")
+    query = item.get("query", "")
+    if isinstance(query, dict):
+        # A list value means the parameter is repeated
+        query = urllib.urlencode([(_utf8(k), _utf8(v)) for (k, v) in query.items()], True)
+    elif isinstance(query, basestring):
+        query = query.encode("utf8")
+    else:
+        raise _BatchItemError("bad 'query'")
+    body = item.get("body", "")
+    if not isinstance(body, basestring):
+        raise _BatchItemError("bad 'body'")
+    body = body.encode("utf8")
+
+    try:
+        service, args, num_segments = registry.match_path(path)
+    except KeyError:
+        raise _HTTPError(404)
+    if service.ident == BATCH_SERVICE_ID:
+        raise _BatchItemError("a batch cannot contain another batch")
+
+    environ = environ.copy()
+    environ["SCRIPT_NAME"] = ""
+    environ["PATH_INFO"] = path
+    for i in range(num_segments):
+        shift_path_info(environ)
+    environ["wsgiorg.routing_args"] = ((), args)
+    environ["QUERY_STRING"] = query
+    # Like the server, treat a HEAD like a GET and leave out the body
+    environ["REQUEST_METHOD"] = (method == "HEAD") and "GET" or method
+    environ["CONTENT_LENGTH"] = str(len(body))
+    environ["CONTENT_TYPE"] = _utf8(item.get("content_type",
+                                             "application/x-www-form-urlencoded"))
+    environ["wsgi.input"] = StringIO(body)
+    for k in ("HTTP_IF_NONE_MATCH", "HTTP_IF_MODIFIED_SINCE"):
+        environ.pop(k, None)
+
+    response = []
+    output = StringIO()
+    def start_response(status, headers, exc_info=None):
+        response[:] = [status, headers]
+        return output.write
+    result = service.handler(environ, start_response)
+    try:
+        for block in result:
+            output.write(block)
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    status, headers = response
+    if method == "HEAD":
+        return status, headers, ""
+    return status, headers, output.getvalue()
+
+def _batch_item_response(status, headers, body):
+    result = dict(status = int(status.split(" ", 1)[0]),
+                  headers = [[k, v] for (k, v) in headers])
+    try:
+        result["body"] = body.decode("utf8")
+    except UnicodeDecodeError:
+        result["body"] = body.encode("base64")
+        result["body_encoding"] = "base64"
+    return result
+
+@simple_service("POST", BATCH_SERVICE_ID, "batch", content_type="application/json")
+def batch(body, content_type):
+    """Run several service requests in one HTTP request
+
+    POST a JSON list of requests, like
+      [{"path": "/charbyname", "query": {"name": "DIGIT ONE"}},
+       {"path": "/xslt", "method": "POST", "query": "@xslt=...", "body": "<doc/>",
+        "content_type": "application/xml"}]
+    Only "path" is required. The default "method" is GET. The "query" may
+    be a string or an object.
+
+    The response is a JSON list with the result of each request, in order,
+    as {"status": 200, "headers": [[name, value], ...], "body": "..."}. A
+    body which isn't UTF-8 is base64 encoded, and the result then also has
+    "body_encoding": "base64". A request which fails gets its own error
+    status; it doesn't affect the others.
+    """
+    from akara import request, response
+    try:
+        import json
+    except ImportError:
+        # Python 2.5
+        from amara.thirdparty import json
+    try:
+        items = json.loads(body)
+    except ValueError, err:
+        response.code = 400
+        return json.dumps(dict(error = "Cannot parse the batch: %s" % (err,)))
+    if not isinstance(items, list):
+        response.code = 400
+        return json.dumps(dict(error = "The batch must be a JSON list"))
+    if len(items) > MAX_BATCH_SIZE:
+        response.code = 400
+        return json.dumps(dict(error = "A batch may contain at most %d requests" %
+                               (MAX_BATCH_SIZE,)))
+
+    # The requests are run here, in turn. They can't run in threads
+    # because akara.request and akara.response describe only one
+    # request at a time. Save the ones for the batch itself.
+    environ = request.environ
+    saved_response = (response.code, response.headers)
+    results = []
+    try:
+        for item in items:
+            try:
+                result = _run_batch_item(environ, item)
+            except _BatchItemError, err:
+                result = ("400 Bad Request", [("Content-Type", "text/plain")], str(err))
+            except _HTTPError, err:
+                result = ("%d %s" % (err.code, err.reason), err.headers, err.text)
+            except Exception, err:
+                logger.error("Uncaught exception in batch request %r" % (item,),
+                             exc_info = True)
+                result = ("500 Internal Server Error", [("Content-Type", "text/plain")],
+                          "Internal error: %s" % (err,))
+            results.append(_batch_item_response(*result))
+    finally:
+        request.environ = environ
+        response.code, response.headers = saved_response
+    return json.dumps(results)
+
+# The request line comes straight from the client. Don't let it break the XML.
+_control_characters = re.compile(u"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+def _status_text(s):
+    return _control_characters.sub(u"?", s.decode("utf8", "replace"))
+
+@simple_service("GET", "http://purl.org/xml3k/akara/services/server-status", "server-status",
+                allow_repeated_args=False)
+def server_status():
+    "Report the status of all of the Akara server processes"
+    from akara import global_config, response, scoreboard
+    filename = getattr(global_config, "scoreboard_file", None)
+    try:
+        if filename is None:
+            raise IOError("Akara is not running as a server")
+        status = scoreboard.read_scoreboard(filename)
+    except (IOError, ValueError), err:
+        response.code = 503
+        return "Cannot read the server scoreboard: %s\n" % (err,)
+    summary = scoreboard.summarize(status)
+
+    document = tree.entity()
+    root = document.xml_append(tree.element(None, 'server-status'))
+    root.xml_attributes['uptime'] = u"%.0f" % summary["uptime"]
+    root.xml_attributes['busy'] = unicode(summary["busy"])
+    root.xml_attributes['idle'] = unicode(summary["idle"])
+    root.xml_attributes['total-requests'] = unicode(summary["total_requests"])
+    root.xml_attributes['total-bytes'] = unicode(summary["total_bytes"])
+    root.xml_attributes['requests-per-second'] = u"%.2f" % summary["requests_per_second"]
+    for worker in summary["workers"]:
+        E = root.xml_append(tree.element(None, 'worker'))
+        E.xml_attributes['slot'] = unicode(worker["index"])
+        E.xml_attributes['pid'] = unicode(worker["pid"])
+        E.xml_attributes['state'] = unicode(worker["state"])
+        E.xml_attributes['requests'] = unicode(worker["requests"])
+        E.xml_attributes['bytes'] = unicode(worker["bytes"])
+        if worker["elapsed"] is not None:
+            E.xml_attributes['elapsed'] = u"%.3f" % worker["elapsed"]
+            E.xml_attributes['mount-point'] = _status_text(worker["mount_point"])
+            E.xml_append(tree.text(_status_text(worker["request"])))
+    return document
+
+# Reported for each latency histogram
+_METRICS_QUANTILES = ("0.5", "0.9", "0.99", "0.999")
+
+def _metrics_label(s):
+    s = s.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return _control_characters.sub(u"?", s.decode("utf8", "replace")).encode("utf8")
+
+def _metrics_summary(name, labels, histogram):
+    from akara import scoreboard
+    lines = []
+    for q in _METRICS_QUANTILES:
+        value = scoreboard.quantile(histogram["buckets"], float(q))
+        lines.append('%s{%s,quantile="%s"} %.6f' % (name, labels, q, value / 1000000.0))
+    lines.append("%s_sum{%s} %.6f" % (name, labels, histogram["sum_us"] / 1000000.0))
+    lines.append("%s_count{%s} %d" % (name, labels, histogram["count"]))
+    return lines
+
+@simple_service("GET", "http://purl.org/xml3k/akara/services/metrics", "metrics",
+                content_type="text/plain; version=0.0.4", allow_repeated_args=False)
+def metrics():
+    "Report request latency and throughput, in the Prometheus text format"
+    from akara import global_config, response, scoreboard
+    filename = getattr(global_config, "scoreboard_file", None)
+    try:
+        if filename is None:
+            raise IOError("Akara is not running as a server")
+        status = scoreboard.read_scoreboard(filename)
+    except (IOError, ValueError), err:
+        response.code = 503
+        return "Cannot read the server scoreboard: %s\n" % (err,)
+    summary = scoreboard.summarize(status)
+    uptime = summary["uptime"]
+
+    lines = [
+        "# HELP akara_uptime_seconds Time since the Akara server started.",
+        "# TYPE akara_uptime_seconds gauge",
+        "akara_uptime_seconds %.3f" % (uptime,),
+        "# HELP akara_workers Number of server processes.",
+        "# TYPE akara_workers gauge",
+        'akara_workers{state="busy"} %d' % (summary["busy"],),
+        'akara_workers{state="idle"} %d' % (summary["idle"],),
+        "# HELP akara_requests_total Requests handled since the server started.",
+        "# TYPE akara_requests_total counter",
+        "akara_requests_total %d" % (summary["total_requests"],),
+        "# HELP akara_sent_bytes_total Response body bytes sent since the server started.",
+        "# TYPE akara_sent_bytes_total counter",
+        "akara_sent_bytes_total %d" % (summary["total_bytes"],),
+        "# HELP akara_request_duration_seconds Request latency by mount point and status class.",
+        "# TYPE akara_request_duration_seconds summary",
+        ]
+    rates = []
+    deliveries = []
+    for (mount_point, status_class), histogram in sorted(status["histograms"].items()):
+        if status_class.isdigit():
+            status_class += "xx"
+        if mount_point.startswith(notify.MOUNT_POINT_PREFIX):
+            labels = 'path="%s",status="%s"' % (
+                _metrics_label(mount_point[len(notify.MOUNT_POINT_PREFIX):]),
+                _metrics_label(status_class))
+            deliveries.extend(_metrics_summary("akara_notify_delivery_seconds",
+                                               labels, histogram))
+            continue
+        labels = 'mount_point="%s",status="%s"' % (_metrics_label(mount_point),
+                                                   _metrics_label(status_class))
+        lines.extend(_metrics_summary("akara_request_duration_seconds", labels, histogram))
+        if uptime > 0:
+            rates.append("akara_requests_per_second{%s} %.3f" %
+                         (labels, histogram["count"] / uptime))
+    lines.append("# HELP akara_requests_per_second Average request rate since the server started.")
+    lines.append("# TYPE akara_requests_per_second gauge")
+    lines.extend(rates)
+
+    lines.append("# HELP akara_notify_delivery_seconds Time from spooling a notification to its delivery.")
+    lines.append("# TYPE akara_notify_delivery_seconds summary")
+    lines.extend(deliveries)
+    try:
+        queued, delivering, failed = notify.spool_depth()
+    except (IOError, OSError):
+        pass
+    else:
+        lines.extend([
+            "# HELP akara_notify_spool_depth Spooled notifications by state.",
+            "# TYPE akara_notify_spool_depth gauge",
+            'akara_notify_spool_depth{state="queued"} %d' % (queued,),
+            'akara_notify_spool_depth{state="delivering"} %d' % (delivering,),
+            'akara_notify_spool_depth{state="failed"} %d' % (failed,),
+            ])
+    lines.append("")
+    return "\n".join(lines)
@@ -14,8 +14,6 @@ if pyOpenSSL is installed, it also provides SSL capabilities.
 # @@: add in protection against HTTP/1.0 clients who claim to
 #     be 1.1 but do not send a Content-Length
 
-# @@: add support for chunked encoding, this is not a 1.1 server
-#     till this is completed.
 
 import atexit
 import traceback
@@ -24,6 +22,7 @@ import posixpath
 import time
 import thread
 import os
+import errno
 from itertools import count
 from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 from SocketServer import ThreadingMixIn
@@ -37,7 +36,7 @@ except ImportError:
     # Not available, probably no ctypes
     killthread = None
 
-__all__ = ['WSGIHandlerMixin', 'WSGIServer', 'WSGIHandler', 'serve']
+__all__ = ['WSGIHandlerMixin', 'WSGIServer', 'WSGIHandler', 'FileWrapper', 'serve']
 __version__ = "0.5"
 
 # Copied from paste.util.converters for use in Akara.
@@ -55,6 +54,62 @@ def asbool(obj):
     return bool(obj)
 
 
+# sendfile() copies from a file to a socket inside the kernel. Python
+# 3.3 has os.sendfile. For older Pythons on Linux, call the C library.
+# (The BSD and Mac OS X versions take different arguments.)
+_sendfile = getattr(os, 'sendfile', None)
+if _sendfile is None and sys.platform.startswith('linux'):
+    try:
+        import ctypes, ctypes.util
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        # sendfile64 uses a 64 bit offset, even on 32 bit systems
+        _libc_sendfile = _libc.sendfile64
+        _libc_sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                                   ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+        _libc_sendfile.restype = ctypes.c_ssize_t
+    except (ImportError, AttributeError, OSError, TypeError):
+        pass
+    else:
+        def _sendfile(out_fd, in_fd, offset, count):
+            offset = ctypes.c_int64(offset)
+            sent = _libc_sendfile(out_fd, in_fd, ctypes.byref(offset), count)
+            if sent < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            return sent
+
+class FileWrapper(object):
+    """
+    The ``wsgi.file_wrapper`` for this server.
+
+    Iterating over it reads the file in blocks, as in PEP 333. When
+    the wrapped object is a real file, the response has a
+    Content-Length, and the platform has sendfile(), then the
+    server instead sends Content-Length bytes straight from the
+    file to the socket, starting at the current file position.
+    """
+    def __init__(self, filelike, blksize=8192):
+        self.filelike = filelike
+        self.blksize = blksize
+        if hasattr(filelike, 'close'):
+            self.close = filelike.close
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        data = self.filelike.read(self.blksize)
+        if data:
+            return data
+        raise StopIteration
+
+    def fileno(self):
+        """The file descriptor of the wrapped file, or None"""
+        try:
+            return self.filelike.fileno()
+        except (AttributeError, IOError, ValueError):
+            return None
+
 class ContinueHook(object):
     """
     When a client request includes a 'Expect: 100-continue' header, then
@@ -159,12 +214,103 @@ class WSGIHandlerMixin:
                         self.close_connection = 1
                         send_close = False
                 self.send_header(k, v)
-            if send_close:
+            if send_close and (code[:1] == '1' or code in ('204', '304')):
+                # There is no body, so no need to know its length
+                pass
+            elif send_close and self.wsgi_can_chunk(code):
+                # The length isn't known yet. Send the body as it
+                # comes and keep the connection open.
+                self.wsgi_chunked = True
+                self.send_header('Transfer-Encoding', 'chunked')
+            elif send_close:
                 self.close_connection = 1
                 self.send_header('Connection', 'close')
 
             self.end_headers()
-        self.wfile.write(chunk)
+        if self.command == 'HEAD':
+            # Applications may use the write() callable for HEAD too
+            return
+        if self.wsgi_chunked:
+            # An empty chunk would end the body
+            if chunk:
+                self.wfile.write("%x\r\n%s\r\n" % (len(chunk), chunk))
+        else:
+            self.wfile.write(chunk)
+
+    def wsgi_can_chunk(self, code):
+        """
+        Can the response body use the chunked transfer-coding?
+        """
+        return (self.protocol_version == 'HTTP/1.1' and
+                self.request_version == 'HTTP/1.1' and
+                self.command != 'HEAD' and
+                code[:1] != '1' and code not in ('204', '304'))
+
+    def wsgi_end_chunks(self):
+        """
+        Send the last chunk, if the body is chunked.
+        """
+        if self.wsgi_chunked:
+            self.wsgi_chunked = False
+            self.wfile.write("0\r\n\r\n")
+
+    def wsgi_send_file(self, wrapper):
+        """
+        Send the response body from the file in a FileWrapper using
+        sendfile(). Returns the number of bytes sent, or None if it
+        can't be done this way (the caller should iterate instead).
+        """
+        if (_sendfile is None or self.wsgi_headers_sent or
+            not self.wsgi_curr_headers or
+            self.wsgi_environ.get('wsgi.url_scheme') == 'https' or
+            self.command == 'HEAD'):
+            return None
+        in_fd = wrapper.fileno()
+        if in_fd is None:
+            return None
+        length = None
+        for (k, v) in self.wsgi_curr_headers[1]:
+            if k.lower() == 'content-length':
+                try:
+                    length = int(v)
+                except ValueError:
+                    return None
+        if length is None:
+            return None
+        try:
+            offset = wrapper.filelike.tell()
+        except (AttributeError, IOError):
+            return None
+
+        self.wsgi_write_chunk('')  # Send the headers
+        self.wfile.flush()
+        out_fd = self.connection.fileno()
+        sent = 0
+        while sent < length:
+            try:
+                n = _sendfile(out_fd, in_fd, offset + sent, length - sent)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno in (errno.EPIPE, errno.ECONNRESET):
+                    raise socket.error(e.errno, e.strerror)
+                # Some file systems don't support sendfile. Copy the rest.
+                wrapper.filelike.seek(offset + sent)
+                while sent < length:
+                    data = wrapper.filelike.read(min(wrapper.blksize, length - sent))
+                    if not data:
+                        break
+                    self.wfile.write(data)
+                    sent += len(data)
+                break
+            if n == 0:
+                break
+            sent += n
+        if sent < length:
+            # The file is shorter than promised. The client can't tell
+            # where this response ends, so don't send another.
+            self.close_connection = 1
+        return sent
 
     def wsgi_start_response(self, status, response_headers, exc_info=None):
         if exc_info:
@@ -228,6 +374,7 @@ class WSGIHandlerMixin:
                ,'wsgi.multithread': True
                ,'wsgi.multiprocess': False
                ,'wsgi.run_once': False
+               ,'wsgi.file_wrapper': FileWrapper
                # CGI variables required by PEP-333
                ,'REQUEST_METHOD': self.command
                ,'SCRIPT_NAME': '' # application is root of server
@@ -284,6 +431,7 @@ class WSGIHandlerMixin:
 
         self.wsgi_curr_headers = None
         self.wsgi_headers_sent = False
+        self.wsgi_chunked = False
 
     def wsgi_connection_drop(self, exce, environ=None):
         """
@@ -303,10 +451,15 @@ class WSGIHandlerMixin:
             result = self.server.wsgi_application(self.wsgi_environ,
                                                   self.wsgi_start_response)
             try:
-                for chunk in result:
-                    self.wsgi_write_chunk(chunk)
+                if (isinstance(result, FileWrapper) and
+                    self.wsgi_send_file(result) is not None):
+                    pass
+                else:
+                    for chunk in result:
+                        self.wsgi_write_chunk(chunk)
                 if not self.wsgi_headers_sent:
                     self.wsgi_write_chunk('')
+                self.wsgi_end_chunks()
             finally:
                 if hasattr(result,'close'):
                     result.close()
@@ -315,6 +468,11 @@ class WSGIHandlerMixin:
             self.wsgi_connection_drop(exce, environ)
             return
         except:
+            if self.wsgi_chunked:
+                # Leave off the last chunk so the client can tell the
+                # response is incomplete, and don't reuse the connection.
+                self.wsgi_chunked = False
+                self.close_connection = 1
             if not self.wsgi_headers_sent:
                 error_msg = "Internal Server Error\n"
                 self.wsgi_curr_headers = (
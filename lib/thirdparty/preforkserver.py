@@ -36,6 +36,8 @@ import signal
 import random
 import time
 
+from akara.scoreboard import Scoreboard, SLOT_IDLE, SLOT_BUSY
+
 try:
     import fcntl
 except ImportError:
@@ -82,10 +84,20 @@ class PreforkServer(object):
 
     jobClass should have a run() method (taking no arguments) that does
     the actual work. When run() returns, the request is considered
-    complete and the child process moves to idle state.
+    complete and the child process moves to idle state. If maxRequests
+    is positive, the job's 'maxRequests' attribute is set to the
+    number of requests the child may still handle before run() is
+    called. run() may return the number of requests it handled (for
+    example, over a keep-alive connection); None counts as one.
+
+    Each child has a slot in the scoreboard (see akara.scoreboard),
+    which is where it records whether it is available. The job's
+    'scoreboardSlot' attribute is set to that slot so the job can
+    record what it is doing. If scoreboard is None an anonymous one
+    is used, with room for maxChildren children.
     """
     def __init__(self, minSpare=1, maxSpare=5, maxChildren=50,
-                 maxRequests=0, jobClass=None, jobArgs=()):
+                 maxRequests=0, jobClass=None, jobArgs=(), scoreboard=None):
         self._minSpare = minSpare
         self._maxSpare = maxSpare
         self._maxChildren = max(maxSpare, maxChildren)
@@ -93,11 +105,20 @@ class PreforkServer(object):
         self._jobClass = jobClass
         self._jobArgs = jobArgs
 
+        if scoreboard is None:
+            scoreboard = Scoreboard(None, self._maxChildren)
+        elif scoreboard.num_slots < self._maxChildren:
+            raise ValueError("scoreboard must have at least maxChildren slots!")
+        self._scoreboard = scoreboard
+
         # Internal state of children. Maps pids to dictionaries with two
-        # members: 'file' and 'avail'. 'file' is the socket to that
-        # individidual child and 'avail' is whether or not the child is
-        # free to process requests.
+        # members: 'file' and 'slot'. 'file' is the socket to that
+        # individidual child and 'slot' is the child's scoreboard slot.
+        # A child is free to process requests if its file is open and
+        # its scoreboard state says it is available.
         self._children = {}
+        # Reverse map from child socket to pid
+        self._files = {}
 
         self._children_to_purge = []
         self._last_purge = 0
@@ -134,17 +155,14 @@ class PreforkServer(object):
             while len(self._children) < self._maxSpare:
                 if not self._spawnChild(sock): break
 
-            # Wait on any socket activity from live children.
-            r = [x['file'] for x in self._children.values()
-                 if x['file'] is not None]
-
-            if len(r) == len(self._children) and not self._children_to_purge:
-                timeout = None
-            else:
-                # There are dead children that need to be reaped, ensure
-                # that they are by timing out, if necessary. Or there are some
-                # children that need to die.
-                timeout = 2
+            # Wait on any socket activity from live children. The
+            # children report their status through the scoreboard. A
+            # child also sends a byte when it becomes busy, so that a
+            # burst of requests wakes us up to start spare children
+            # right away, and closes its end when it exits. Wake up
+            # every second anyway to check the scoreboard.
+            r = self._files.keys()
+            timeout = 1
 
             w = []
             if (time.time() > self._last_purge + 10):
@@ -154,30 +172,21 @@ class PreforkServer(object):
             except select.error, e:
                 if e[0] != errno.EINTR:
                     raise
+                r, w = [], []
 
             # Scan child sockets and tend to those that need attention.
             for child in r:
-                # Receive status byte.
                 try:
-                    state = child.recv(1)
+                    # Only a wakeup. The scoreboard says who is busy.
+                    data = child.recv(64)
                 except socket.error, e:
                     if e[0] in (errno.EAGAIN, errno.EINTR):
                         # Guess it really didn't need attention?
                         continue
                     raise
-                # Try to match it with a child. (Do we need a reverse map?)
-                for pid,d in self._children.items():
-                    if child is d['file']:
-                        if state:
-                            # Set availability status accordingly.
-                            self._children[pid]['avail'] = state != '\x00'
-                        else:
-                            # Didn't receive anything. Child is most likely
-                            # dead.
-                            d = self._children[pid]
-                            d['file'].close()
-                            d['file'] = None
-                            d['avail'] = False
+                if not data:
+                    # Didn't receive anything. Child is most likely dead.
+                    self._closeChildFile(self._files[child])
 
             for child in w:
                 # purging child
@@ -185,19 +194,20 @@ class PreforkServer(object):
                 del self._children_to_purge[self._children_to_purge.index(child)]
                 self._last_purge = time.time()
 
-                # Try to match it with a child. (Do we need a reverse map?)
-                for pid,d in self._children.items():
-                    if child is d['file']:
-                        d['file'].close()
-                        d['file'] = None
-                        d['avail'] = False
+                pid = self._files.get(child)
+                if pid is not None:
+                    self._closeChildFile(pid)
                 break
 
             # Reap children.
             self._reapChildren()
 
-            # See who and how many children are available.
-            availList = filter(lambda x: x[1]['avail'], self._children.items())
+            # See who and how many children are available. This reads
+            # one scoreboard slot per child, at most _maxChildren, once
+            # per wakeup.
+            availList = [pid for pid, d in self._children.items()
+                         if d['file'] is not None and
+                            self._scoreboard.is_available(d['slot'])]
             avail = len(availList)
 
             if avail < self._minSpare:
@@ -208,14 +218,9 @@ class PreforkServer(object):
                     avail += 1
             elif avail > self._maxSpare:
                 # Too many spares, kill off the extras.
-                pids = [x[0] for x in availList]
-                pids.sort()
-                pids = pids[self._maxSpare:]
-                for pid in pids:
-                    d = self._children[pid]
-                    d['file'].close()
-                    d['file'] = None
-                    d['avail'] = False
+                availList.sort()
+                for pid in availList[self._maxSpare:]:
+                    self._closeChildFile(pid)
 
         # Clean up all child processes.
         self._cleanupChildren()
@@ -236,10 +241,9 @@ class PreforkServer(object):
         """
         # Let all children know it's time to go.
         for pid,d in self._children.items():
-            if d['file'] is not None:
-                d['file'].close()
-                d['file'] = None
-            if not d['avail']:
+            avail = self._scoreboard.is_available(d['slot'])
+            self._closeChildFile(pid)
+            if not avail:
                 # Child is unavailable. SIGINT it.
                 try:
                     os.kill(pid, signal.SIGINT)
@@ -263,7 +267,7 @@ class PreforkServer(object):
                 if e[0] in (errno.ECHILD, errno.EINTR):
                     break
             if self._children.has_key(pid):
-                del self._children[pid]
+                self._removeChild(pid)
 
         signal.signal(signal.SIGALRM, oldSIGALRM)
 
@@ -287,15 +291,29 @@ class PreforkServer(object):
             if pid <= 0:
                 break
             if self._children.has_key(pid): # Sanity check.
-                if self._children[pid]['file'] is not None:
-                    self._children[pid]['file'].close()
-                    self._children[pid]['file'] = None
-                del self._children[pid]
+                self._removeChild(pid)
+
+    def _closeChildFile(self, pid):
+        """Closes the socket to a child, which tells it to exit."""
+        d = self._children[pid]
+        if d['file'] is not None:
+            del self._files[d['file']]
+            d['file'].close()
+            d['file'] = None
+
+    def _removeChild(self, pid):
+        """Forget about a child which has exited and free its slot."""
+        self._closeChildFile(pid)
+        self._scoreboard.release(self._children[pid]['slot'])
+        del self._children[pid]
 
     def _spawnChild(self, sock):
         """
         Spawn a single child. Returns True if successful, False otherwise.
         """
+        slot = self._scoreboard.allocate()
+        if slot is None:
+            return False # No room on the scoreboard.
         # This socket pair is used for very simple communication between
         # the parent and its children.
         parent, child = socket.socketpair()
@@ -306,6 +324,7 @@ class PreforkServer(object):
         try:
             pid = os.fork()
         except OSError, e:
+            self._scoreboard.release(slot)
             if e[0] in (errno.EAGAIN, errno.ENOMEM):
                 return False # Can't fork anymore.
             raise
@@ -322,6 +341,8 @@ class PreforkServer(object):
                       if x['file'] is not None]:
                 f.close()
             self._children = {}
+            self._files = {}
+            self._scoreboardSlot = self._scoreboard.slot(slot)
             try:
                 # Enter main loop.
                 self._child(sock, parent)
@@ -331,30 +352,25 @@ class PreforkServer(object):
         else:
             # Parent
             parent.close()
+            self._scoreboard.set_pid(slot, pid)
             d = self._children[pid] = {}
             d['file'] = child
-            d['avail'] = True
+            d['slot'] = slot
+            self._files[child] = pid
             return True
 
     def _isClientAllowed(self, addr):
         """Override to provide access control."""
         return True
 
-    def _notifyParent(self, parent, msg):
-        """Send message to parent, ignoring EPIPE and retrying on EAGAIN"""
-        while True:
-            try:
-                parent.send(msg)
-                return True
-            except socket.error, e:
-                if e[0] == errno.EPIPE:
-                    return False # Parent is gone
-                if e[0] == errno.EAGAIN:
-                    # Wait for socket change before sending again
-                    select.select([], [parent], [])
-                else:
-                    raise
-                
+    # An idle child calls _childTick() each time it has waited
+    # _childTimeout seconds without a connection (never if None).
+    _childTimeout = None
+
+    def _childTick(self):
+        """Override to do periodic work in the child."""
+        pass
+
     def _child(self, sock, parent):
         """Main loop for children."""
         requestCount = 0
@@ -371,9 +387,12 @@ class PreforkServer(object):
         random.seed('%s%s%s' % (preseed, os.getpid(), time.time()))
         del preseed
 
+        slot = self._scoreboardSlot
         while True:
+            slot.set_state(SLOT_IDLE)
+
             # Wait for any activity on the main socket or parent socket.
-            r, w, e = select.select([sock, parent], [], [])
+            r, w, e = select.select([sock, parent], [], [], self._childTimeout)
 
             for f in r:
                 # If there's any activity on the parent socket, it
@@ -382,6 +401,12 @@ class PreforkServer(object):
                 if f is parent:
                     return
 
+            if not r:
+                # Timed out. Nothing is waiting, so give subclasses a
+                # chance to do periodic work.
+                self._childTick()
+                continue
+
             # Otherwise, there's activity on the main socket...
             try:
                 clientSock, addr = sock.accept()
@@ -398,21 +423,31 @@ class PreforkServer(object):
                 clientSock.close()
                 continue
 
-            # Notify parent we're no longer available.
-            self._notifyParent(parent, '\x00')
+            # Let the parent know we're no longer available.
+            slot.set_state(SLOT_BUSY)
+            try:
+                parent.send('B')
+            except socket.error:
+                # The buffer is full, so the parent has wakeups waiting,
+                # or the parent is gone, which the next select() finds.
+                pass
 
-            # Do the job.
-            self._jobClass(clientSock, addr, *self._jobArgs).run()
+            # Do the job. A job may handle several requests over the
+            # same connection (HTTP keep-alive). Tell it how many it
+            # may still handle and count the ones it says it did.
+            job = self._jobClass(clientSock, addr, *self._jobArgs)
+            job.scoreboardSlot = slot
+            if self._maxRequests > 0:
+                job.maxRequests = self._maxRequests - requestCount
+            handled = job.run()
 
             # If we've serviced the maximum number of requests, exit.
             if self._maxRequests > 0:
-                requestCount += 1
+                if handled is None:
+                    handled = 1
+                requestCount += handled
                 if requestCount >= self._maxRequests:
                     break
-                
-            # Tell parent we're free again.
-            if not self._notifyParent(parent, '\xff'):
-                return # Parent is gone.
 
     # Signal handlers
 
@@ -428,8 +463,7 @@ class PreforkServer(object):
         pass
 
     def _usr1Handler(self, signum, frame):
-        self._children_to_purge = [x['file'] for x in self._children.values()
-                                   if x['file'] is not None]
+        self._children_to_purge = self._files.keys()
 
     def _installSignalHandlers(self):
         supportedSignals = [signal.SIGINT, signal.SIGTERM]
@@ -131,9 +131,9 @@ def find_peer_service(peer_id, environ=None):
         serverbase = guess_self_uri(environ)
     else:
         serverbase = getattr(global_config, 'server_root')
-    for (path, s) in _current_registry._registered_services.iteritems():
-        if s.ident == peer_id:
-            return join(serverbase, '..', path)
+    s = _current_registry.get_a_service_by_ident(peer_id)
+    if s is not None:
+        return join(serverbase, '..', s.path)
     return None
 
 
@@ -154,10 +154,7 @@ def discover_service(sid):
         raise RuntimeError('find_peer_service is meant to be called from within Akara process space')
     from akara.registry import _current_registry
     from akara import request
-    for (path, s) in _current_registry._registered_services.iteritems():
-        if s.ident == peer_id:
-            return s
-    return None
+    return _current_registry.get_a_service_by_ident(sid)
 
 
 def server_call_base(environ=None):
@@ -0,0 +1,136 @@
+# Test the buffered access log writer
+
+import os
+import time
+import shutil
+import tempfile
+
+from akara import logger_config, multiprocess_http
+
+def tmpdir(func):
+    def wrapper():
+        dirname = tempfile.mkdtemp(prefix="akara_test_")
+        try:
+            func(dirname)
+        finally:
+            shutil.rmtree(dirname)
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+def read(filename):
+    f = open(filename)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+@tmpdir
+def test_unbuffered(dirname):
+    filename = os.path.join(dirname, "access.log")
+    log = logger_config.AccessLogger(filename)
+    log.write("first")
+    assert read(filename) == "first\n"
+    log.write("second")
+    assert read(filename) == "first\nsecond\n"
+    log.close()
+
+@tmpdir
+def test_buffered(dirname):
+    filename = os.path.join(dirname, "access.log")
+    log = logger_config.AccessLogger(filename, flush_interval=60)
+    log.write("first")
+    log.write("second")
+    assert read(filename) == ""
+    log.flush_if_due()
+    assert read(filename) == ""
+    log.flush()
+    assert read(filename) == "first\nsecond\n"
+    log.write("third")
+    log.close()
+    assert read(filename) == "first\nsecond\nthird\n"
+
+@tmpdir
+def test_flush_interval(dirname):
+    filename = os.path.join(dirname, "access.log")
+    log = logger_config.AccessLogger(filename, flush_interval=1)
+    log.write("first")
+    assert read(filename) == ""
+    time.sleep(1.1)
+    log.flush_if_due()
+    assert read(filename) == "first\n"
+    log.write("second")
+    time.sleep(1.1)
+    # The line is old enough so this write flushes everything
+    log.write("third")
+    assert read(filename) == "first\nsecond\nthird\n"
+    log.close()
+
+@tmpdir
+def test_max_buffer_size(dirname):
+    filename = os.path.join(dirname, "access.log")
+    log = logger_config.AccessLogger(filename, flush_interval=60, max_buffer_size=100)
+    for i in range(9):
+        log.write("%09d" % i)
+    assert read(filename) == ""
+    log.write("%09d" % 9)
+    assert len(read(filename)) == 100
+    log.close()
+
+@tmpdir
+def test_rotation(dirname):
+    filename = os.path.join(dirname, "access.log")
+    rotated_filename = filename + ".1"
+    log = logger_config.AccessLogger(filename, flush_interval=60)
+    log.write("before")
+    os.rename(filename, rotated_filename)
+    log.write("during")
+    # Rotation is only checked once a second
+    log._rotation_check_time = 0
+    log.flush()
+    log.write("after")
+    log.close()
+    assert read(rotated_filename) == "before\nduring\n"
+    assert read(filename) == "after\n"
+
+def test_get_time():
+    before = int(time.time())
+    t = multiprocess_http._get_time()
+    after = int(time.time())
+    assert t in (multiprocess_http._format_time(before),
+                 multiprocess_http._format_time(after)), t
+    # Cached until the next second
+    t2 = multiprocess_http._get_time()
+    if int(time.time()) == after:
+        assert t2 is t, (t, t2)
+
+###### Benchmark
+
+def benchmark_access_log(n=100000, flush_interval=1):
+    "Time the logging overhead per request, in microseconds"
+    dirname = tempfile.mkdtemp(prefix="akara_benchmark_")
+    try:
+        filename = os.path.join(dirname, "access.log")
+        log = logger_config.AccessLogger(filename, flush_interval=flush_interval)
+        fields = dict(REMOTE_ADDR = "127.0.0.1",
+                      REMOTE_USER = "-",
+                      REQUEST_METHOD = "GET",
+                      REQUEST_URI = "/xslt?@xslt=http://example.com/spam.xslt",
+                      HTTP_VERSION = "HTTP/1.1",
+                      status = "200",
+                      bytes = "1234",
+                      HTTP_REFERER = "-",
+                      HTTP_USER_AGENT = "Python-urllib/2.7",
+                      elapsed_us = 1234)
+        t1 = time.time()
+        for i in xrange(n):
+            fields["start_time"] = multiprocess_http._get_time()
+            log.write(multiprocess_http.ACCESS_LOG_MESSAGE % fields)
+        log.close()
+        t2 = time.time()
+        return (t2-t1) / n * 1000000
+    finally:
+        shutil.rmtree(dirname)
+
+if __name__ == "__main__":
+    print "Unbuffered: %.2f us/request" % benchmark_access_log(flush_interval=0)
+    print "Buffered:   %.2f us/request" % benchmark_access_log(flush_interval=1)
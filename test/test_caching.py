@@ -0,0 +1,655 @@
+# Test the response cache used by the service decorators
+
+import os
+import time
+import hashlib
+import cPickle as pickle
+import urllib2
+import mimetools
+from cStringIO import StringIO
+from email.utils import formatdate
+import shutil
+import tempfile
+
+from akara import caching, global_config, registry
+
+def tmpdir(func):
+    def wrapper():
+        dirname = tempfile.mkdtemp(prefix="akara_test_")
+        old_module_cache = getattr(global_config, "module_cache", None)
+        old_server_address = getattr(global_config, "server_address", None)
+        global_config.module_cache = os.path.join(dirname, "caches")
+        global_config.server_address = ("localhost", 8880)
+        try:
+            func(dirname)
+        finally:
+            global_config.module_cache = old_module_cache
+            global_config.server_address = old_server_address
+            shutil.rmtree(dirname)
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+def test_lru_maxentries():
+    lru = caching._LRU(maxentries=3)
+    for key in "abc":
+        lru.put(key, key.upper())
+    assert lru.get("a") == "A"
+    lru.put("d", "D")
+    # "b" was the least recently used
+    assert "b" not in lru
+    assert [lru.get(key) for key in "acd"] == ["A", "C", "D"]
+    assert len(lru) == 3
+
+def test_lru_maxbytes():
+    lru = caching._LRU(maxbytes=10)
+    lru.put("a", "x", 4)
+    lru.put("b", "y", 4)
+    lru.put("a", "z", 5)
+    assert lru.size == 9, lru.size
+    lru.put("c", "w", 3)
+    assert "b" not in lru
+    assert lru.size == 8, lru.size
+    assert lru.put("d", "v", 11) is False
+    assert "d" not in lru
+    lru.remove("a")
+    assert lru.size == 3, lru.size
+
+def test_make_key():
+    cache = caching.ResponseCache()
+    assert (cache.make_key("spam", dict(b="2", a="1")) ==
+            cache.make_key("spam", dict(a="1", b="2")) == "spam?a=1&b=2")
+    assert cache.make_key("spam", dict(a=["1", "2"])) == "spam?a=1&a=2"
+    assert cache.make_key("spam", {}, {"x": "y"}) == "spam?#x=y"
+    cache = caching.ResponseCache(key=["a"])
+    assert cache.make_key("spam", dict(a="1", b="2")) == "spam?a=1"
+
+def test_response_cache():
+    cache = caching.ResponseCache(expires=60)
+    assert cache.get("k") is None
+    cache.put("k", "200 OK", [("Content-Type", "text/plain")], "body")
+    assert cache.get("k") == ("200 OK", [("Content-Type", "text/plain")], "body")
+    stats = cache.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1, stats
+    assert stats["entries"] == 1 and stats["bytes"] == 4, stats
+
+def test_response_cache_expires():
+    cache = caching.ResponseCache(expires=0.1)
+    cache.put("k", "200 OK", [], "body")
+    assert cache.get("k") is not None
+    time.sleep(0.2)
+    assert cache.get("k") is None
+    assert cache.stats()["entries"] == 0
+
+@tmpdir
+def test_response_cache_disk(dirname):
+    cache1 = caching.ResponseCache(expires=60, disk="spam")
+    cache2 = caching.ResponseCache(expires=60, disk="spam")
+    cache1.put("k", "200 OK", [("X-Spam", "eggs")], "body")
+    assert os.path.isdir(os.path.join(dirname, "caches", "spam"))
+    # As if from another process
+    assert cache2.get("k") == ("200 OK", [("X-Spam", "eggs")], "body")
+    assert cache2.disk_hits == 1
+    # Now in memory
+    assert cache2.get("k") is not None
+    assert cache2.disk_hits == 1
+    assert cache2.get("other") is None
+
+@tmpdir
+def test_single_flight(dirname):
+    # Several processes want the same result at once. Only one computes it.
+    result_file = os.path.join(dirname, "result")
+    calls_file = os.path.join(dirname, "calls")
+    def lookup(key):
+        if os.path.exists(result_file):
+            return open(result_file).read()
+        return None
+    def compute(key):
+        open(calls_file, "a").write("x")
+        time.sleep(0.3)
+        f = open(result_file + ".tmp", "w")
+        f.write("result for " + key)
+        f.close()
+        os.rename(result_file + ".tmp", result_file)
+        return "result for " + key
+
+    pids = []
+    for i in range(5):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                flight = caching.SingleFlight("flight")
+                if flight.run("spam", lookup, compute) == "result for spam":
+                    status = 0
+            finally:
+                os._exit(status)
+        pids.append(pid)
+    for pid in pids:
+        assert os.waitpid(pid, 0)[1] == 0
+    assert open(calls_file).read() == "x"
+    # The lock files are cleaned up
+    assert os.listdir(os.path.join(dirname, "caches", "flight")) == []
+
+@tmpdir
+def test_single_flight_timeout(dirname):
+    flight1 = caching.SingleFlight("flight")
+    flight2 = caching.SingleFlight("flight", timeout=0.2)
+    lock1 = flight1.acquire("spam")
+    t1 = time.time()
+    lock2 = flight2.acquire("spam")
+    assert time.time() - t1 >= 0.2
+    assert flight2.timeouts == 1
+    # Doesn't hold the lock
+    lock2.release()
+    lock1.release()
+    lock3 = flight2.acquire("spam")
+    assert flight2.timeouts == 1
+    lock3.release()
+
+@tmpdir
+def test_response_cache_single_flight(dirname):
+    cache1 = caching.ResponseCache(expires=60, disk="spam", single_flight=True)
+    cache2 = caching.ResponseCache(expires=60, disk="spam", single_flight=True)
+    response, lock = cache1.get_or_lock("k")
+    assert response is None and lock is not None
+    cache1.put("k", "200 OK", [], "body")
+    lock.release()
+    response, lock = cache2.get_or_lock("k")
+    assert response == ("200 OK", [], "body"), response
+    assert lock is None
+    try:
+        caching.ResponseCache(single_flight=True)
+        raise AssertionError("single_flight without a disk cache was allowed")
+    except ValueError:
+        pass
+
+def _add_file(index, identifier, size, expires_at):
+    subdir = os.path.join(index.cachedir, identifier[:2])
+    if not os.path.exists(subdir):
+        try:
+            os.mkdir(subdir)
+        except OSError:
+            pass    # Made by another process
+    open(os.path.join(subdir, identifier[2:] + ".p"), "wb").write("x" * size)
+    index.add(identifier, size, expires_at)
+
+def _has_file(index, identifier):
+    return os.path.exists(os.path.join(index.cachedir, identifier[:2], identifier[2:] + ".p"))
+
+@tmpdir
+def test_index_maxentries(dirname):
+    index = caching._CacheIndex(dirname, maxentries=3)
+    index.ATIME_RESOLUTION = 0
+    expires_at = time.time() + 60
+    for identifier in ("aa1", "bb2", "cc3"):
+        _add_file(index, identifier, 10, expires_at)
+        time.sleep(0.01)
+    index.touch("aa1")
+    _add_file(index, "dd4", 10, expires_at)
+    # "bb2" was the least recently used
+    assert not _has_file(index, "bb2")
+    assert [_has_file(index, identifier) for identifier in ("aa1", "cc3", "dd4")] == [True]*3
+    assert index.totals() == (3, 30), index.totals()
+
+@tmpdir
+def test_index_maxbytes(dirname):
+    index = caching._CacheIndex(dirname, maxbytes=100)
+    expires_at = time.time() + 60
+    _add_file(index, "aa1", 40, expires_at)
+    _add_file(index, "bb2", 40, expires_at)
+    _add_file(index, "aa1", 50, expires_at)
+    assert index.totals() == (2, 90), index.totals()
+    _add_file(index, "cc3", 30, expires_at)
+    assert not _has_file(index, "bb2")
+    assert index.totals() == (2, 80), index.totals()
+    index.remove("aa1")
+    assert not _has_file(index, "aa1")
+    assert index.totals() == (1, 30), index.totals()
+
+@tmpdir
+def test_index_expired_first(dirname):
+    index = caching._CacheIndex(dirname, maxentries=2)
+    _add_file(index, "aa1", 10, time.time() + 60)
+    _add_file(index, "bb2", 10, time.time() - 1)
+    _add_file(index, "cc3", 10, time.time() + 60)
+    assert not _has_file(index, "bb2")
+    assert _has_file(index, "aa1") and _has_file(index, "cc3")
+
+@tmpdir
+def test_index_existing_files(dirname):
+    os.mkdir(os.path.join(dirname, "ab"))
+    open(os.path.join(dirname, "ab", "cdef.p"), "wb").write("x" * 25)
+    index = caching._CacheIndex(dirname, maxentries=1)
+    assert index.totals() == (1, 25), index.totals()
+    _add_file(index, "ff1", 10, time.time() + 60)
+    assert not os.path.exists(os.path.join(dirname, "ab", "cdef.p"))
+
+@tmpdir
+def test_index_processes(dirname):
+    # All of the server processes share the index and its totals
+    index = caching._CacheIndex(dirname, maxentries=50)
+    index.totals()
+    pids = []
+    for i in range(4):
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                for j in range(30):
+                    _add_file(index, "%02x%d" % (j, i), 10, time.time() + 60)
+                status = 0
+            finally:
+                os._exit(status)
+        pids.append(pid)
+    for pid in pids:
+        assert os.waitpid(pid, 0)[1] == 0
+    assert index.totals() == (50, 500), index.totals()
+    num_files = len([name for subdir in os.listdir(dirname) if len(subdir) == 2
+                         for name in os.listdir(os.path.join(dirname, subdir))])
+    assert num_files == 50, num_files
+
+@tmpdir
+def test_response_cache_disk_maxentries(dirname):
+    cache = caching.ResponseCache(expires=60, disk="spam", disk_maxentries=2)
+    for key in ("a", "b", "c"):
+        cache.put(key, "200 OK", [], "body")
+    assert cache.index.totals()[0] == 2
+    assert caching.ResponseCache(expires=60, disk="spam").get("a") is None
+
+registry.register_service("urn:x-test:cached_upstream", "cached_upstream", lambda e, s: [])
+
+class _FakeResponse(object):
+    def __init__(self, url, data, headers):
+        self.url = url
+        self.data = data
+        self.headers = mimetools.Message(StringIO(
+            "".join("%s: %s\r\n" % item for item in headers.items()) + "\r\n"))
+        # As httplib does, so it can be pickled
+        self.headers.fp = None
+    def info(self):
+        return self.headers
+    def close(self):
+        pass
+    def read(self, size=-1):
+        if size < 0:
+            size = len(self.data)
+        data, self.data = self.data[:size], self.data[size:]
+        return data
+
+class _FakeOpener(object):
+    def __init__(self):
+        self.urls = []
+        self.requests = []
+        self.error = None
+        self.version = ""
+        self.headers = {"Content-Type": "text/plain"}
+        self.body = None
+        self.not_modified_headers = {}
+    def __call__(self, request):
+        if isinstance(request, basestring):
+            request = urllib2.Request(request)
+        url = request.get_full_url()
+        self.urls.append(url)
+        self.requests.append(request)
+        if self.error is not None:
+            raise self.error
+        etag = self.headers.get("ETag")
+        if etag is not None and request.get_header("If-none-match") == etag:
+            headers = _FakeResponse(url, "", self.not_modified_headers).info()
+            raise urllib2.HTTPError(url, 304, "Not Modified", headers, None)
+        body = self.body
+        if body is None:
+            body = "data for " + url.split("?")[1] + self.version
+        return _FakeResponse(url, body, self.headers)
+
+def _wait_for(condition):
+    deadline = time.time() + 5
+    while not condition():
+        assert time.time() < deadline, "timed out"
+        time.sleep(0.01)
+
+@tmpdir
+def test_cache_memory_tier(dirname):
+    opener = _FakeOpener()
+    c = caching.cache("urn:x-test:cached_upstream", opener=opener, memory_maxbytes=1000)
+    f = c.get(q="spam")
+    assert f.read() == "data for q=spam"
+    assert f.getcode() == 200
+    assert f.geturl() == "http://localhost:8880/cached_upstream?q=spam"
+    assert f.info()["Content-Type"] == "text/plain"
+    f = c.get(q="spam")
+    assert isinstance(f, caching.MemoryCacheFile)
+    assert f.read() == "data for q=spam"
+    assert len(opener.urls) == 1
+    stats = c.stats()
+    assert (stats["memory_hits"], stats["memory_misses"]) == (1, 1), stats
+    assert (stats["disk_hits"], stats["disk_misses"]) == (0, 1), stats
+    assert stats["memory_bytes"] == 15, stats
+
+    # Another process only has the disk tier. A hit there fills its memory tier.
+    c2 = caching.cache("urn:x-test:cached_upstream", opener=opener, memory_maxbytes=1000)
+    assert c2.get(q="spam").read() == "data for q=spam"
+    assert c2.get(q="spam").read() == "data for q=spam"
+    assert (c2.disk_hits, c2.memory_hits) == (1, 1)
+    assert len(opener.urls) == 1
+
+@tmpdir
+def test_cache_memory_tier_limits(dirname):
+    opener = _FakeOpener()
+    c = caching.cache("urn:x-test:cached_upstream", opener=opener, expires=0.2,
+                      memory_maxbytes=1000, memory_maxitem=16)
+    # Too large for memory, but still on disk
+    f = c.get(q="a longer value")
+    assert isinstance(f, caching.CacheFile)
+    assert f.read() == "data for q=a%20longer%20value"
+    assert c.get(q="a longer value").read() == "data for q=a%20longer%20value"
+    assert c.disk_hits == 1 and c.memory_hits == 0
+    # Expires from both tiers at the same time
+    c.get(q="x")
+    assert c.get(q="x").read() == "data for q=x"
+    time.sleep(0.3)
+    assert c.get(q="x").read() == "data for q=x"
+    assert len(opener.urls) == 3, opener.urls
+
+@tmpdir
+def test_cache_stale_while_revalidate(dirname):
+    opener = _FakeOpener()
+    c = caching.cache("urn:x-test:cached_upstream", opener=opener, expires=0.1,
+                      stale_while_revalidate=10)
+    assert c.get(q="x").read() == "data for q=x"
+    time.sleep(0.2)
+    opener.version = " v2"
+    # The expired result comes back right away, and is refreshed in the background
+    assert c.get(q="x").read() == "data for q=x"
+    assert (c.stale_hits, c.refreshes) == (1, 1)
+    _wait_for(lambda: c.get(q="x").read() == "data for q=x v2")
+    assert len(opener.urls) == 2, opener.urls
+
+    # Another process is already refreshing it
+    time.sleep(0.2)
+    lock = caching.SingleFlight("cached_upstream.refresh").acquire(
+        hashlib.sha1("q=x").hexdigest())
+    stale_hits = c.stale_hits
+    try:
+        assert c.get(q="x").read() == "data for q=x v2"
+        assert (c.stale_hits, c.refreshes) == (stale_hits + 1, 1)
+    finally:
+        lock.release()
+    assert len(opener.urls) == 2, opener.urls
+
+@tmpdir
+def test_cache_stale_if_error(dirname):
+    opener = _FakeOpener()
+    c = caching.cache("urn:x-test:cached_upstream", opener=opener, expires=0.1,
+                      stale_if_error=0.5)
+    assert c.get(q="x").read() == "data for q=x"
+    time.sleep(0.2)
+    opener.error = urllib2.URLError("connection refused")
+    assert c.get(q="x").read() == "data for q=x"
+    opener.error = urllib2.HTTPError("http://localhost/", 503, "Unavailable", {}, None)
+    assert c.get(q="x").read() == "data for q=x"
+    assert c.stale_errors == 2
+    # The service's answer
+    opener.error = urllib2.HTTPError("http://localhost/", 404, "Not Found", {}, None)
+    try:
+        c.get(q="x")
+        raise AssertionError("the 404 was not raised")
+    except urllib2.HTTPError, err:
+        assert err.code == 404
+    # Too old
+    time.sleep(0.5)
+    opener.error = urllib2.URLError("connection refused")
+    try:
+        c.get(q="x")
+        raise AssertionError("the error was not raised")
+    except urllib2.URLError:
+        pass
+    assert c.stale_errors == 2
+    # Works again
+    opener.error = None
+    assert c.get(q="x").read() == "data for q=x"
+
+def test_cache_http_lifetime():
+    c = caching.cache("urn:x-test:cached_upstream", expires=60, http_expires=True,
+                      min_expires=5, max_expires=3600)
+    def lifetime(**headers):
+        return c._lifetime(_FakeResponse("", "", headers).info())
+    assert lifetime() == 60
+    assert lifetime(**{"Cache-Control": "max-age=120"}) == 120
+    assert lifetime(**{"Cache-Control": "public, s-maxage=30, max-age=120"}) == 30
+    assert lifetime(**{"Cache-Control": "max-age=86400"}) == 3600
+    assert lifetime(**{"Cache-Control": "no-cache"}) == 5
+    assert lifetime(**{"Cache-Control": "max-age=spam"}) == 5
+    assert lifetime(**{"Cache-Control": "no-store"}) is None
+    now = time.time()
+    assert lifetime(Date=formatdate(now), Expires=formatdate(now + 600)) == 600
+    assert lifetime(Expires="0") == 5
+    # Only with http_expires
+    c = caching.cache("urn:x-test:cached_upstream", expires=60)
+    assert c._lifetime(_FakeResponse("", "", {"Cache-Control": "max-age=1"}).info()) == 60
+
+@tmpdir
+def test_cache_http_expires(dirname):
+    opener = _FakeOpener()
+    opener.headers["Cache-Control"] = "max-age=0"
+    c = caching.cache("urn:x-test:cached_upstream", opener=opener, expires=60,
+                      http_expires=True, min_expires=0.1)
+    c.get(q="x")
+    assert c.get(q="x").read() == "data for q=x"
+    assert len(opener.urls) == 1
+    time.sleep(0.2)
+    c.get(q="x")
+    assert len(opener.urls) == 2
+    # Not stored at all
+    opener.headers["Cache-Control"] = "no-store"
+    opener.version = " v2"
+    time.sleep(0.2)
+    assert c.get(q="x").read() == "data for q=x v2"
+    assert c.get(q="x").read() == "data for q=x v2"
+    assert len(opener.urls) == 4
+
+@tmpdir
+def test_cache_revalidate(dirname):
+    opener = _FakeOpener()
+    opener.headers["ETag"] = '"v1"'
+    c = caching.cache("urn:x-test:cached_upstream", opener=opener, expires=0.1)
+    assert c.get(q="x").read() == "data for q=x"
+    cache_file = c.get(q="x").name
+    mtime = os.path.getmtime(cache_file)
+    size = os.path.getsize(cache_file)
+    time.sleep(0.2)
+    # The service says it hasn't changed
+    f = c.get(q="x")
+    assert f.read() == "data for q=x"
+    assert f.info()["ETag"] == '"v1"'
+    assert opener.requests[-1].get_header("If-none-match") == '"v1"'
+    assert c.revalidations == 1
+    assert os.path.getmtime(cache_file) > mtime
+    assert os.path.getsize(cache_file) == size
+    # Fresh again
+    c.get(q="x")
+    assert len(opener.urls) == 2
+    # Now it has
+    time.sleep(0.2)
+    opener.headers["ETag"] = '"v2"'
+    opener.version = " v2"
+    assert c.get(q="x").read() == "data for q=x v2"
+    assert c.revalidations == 1
+    assert len(opener.urls) == 3
+
+@tmpdir
+def test_cache_revalidate_headers(dirname):
+    opener = _FakeOpener()
+    opener.headers["ETag"] = '"v1"'
+    opener.headers["Cache-Control"] = "max-age=0"
+    c = caching.cache("urn:x-test:cached_upstream", opener=opener, http_expires=True,
+                      min_expires=0.1)
+    c.get(q="x").close()
+    time.sleep(0.2)
+    # The 304 gives the entry a new lifetime, which is stored with it
+    opener.not_modified_headers = {"Cache-Control": "max-age=60", "ETag": '"v1"',
+                                   "Content-Length": "0"}
+    f = c.get(q="x")
+    assert f.read() == "data for q=x"
+    assert f.info()["Cache-Control"] == "max-age=60", f.info()["Cache-Control"]
+    assert f.info()["Content-Type"] == "text/plain"
+    assert f.info().getheaders("Cache-Control") == ["max-age=60"]
+    assert f.info().get("Content-Length") is None
+    assert c.revalidations == 1
+    time.sleep(0.2)
+    f = c.get(q="x")
+    assert f.info()["Cache-Control"] == "max-age=60"
+    assert len(opener.urls) == 2
+
+@tmpdir
+def test_cache_index_expires(dirname):
+    # The index counts the lifetime from the same time as lookups do
+    c = caching.cache("urn:x-test:cached_upstream", opener=_FakeOpener(), expires=60)
+    c.get(q="x").close()
+    identifier = hashlib.sha1("q=x").hexdigest()
+    expires = c.index._connect().execute(
+        "SELECT expires FROM entries WHERE identifier = ?", (identifier,)).fetchone()[0]
+    assert abs(expires - (os.path.getmtime(_cache_file(c, "q=x")) + 60)) < 0.001, expires
+
+def test_update_headers():
+    stored = caching._parse_headers("Content-Type: text/plain\r\nContent-Length: 4\r\n"
+                                    "Cache-Control: max-age=0,\r\n must-revalidate\r\n"
+                                    "Date: Mon, 01 Jan 2001 00:00:00 GMT\r\n\r\n")
+    update = caching._parse_headers("Date: Tue, 02 Jan 2001 00:00:00 GMT\r\n"
+                                    "Cache-Control: max-age=60\r\nContent-Length: 0\r\n\r\n")
+    headers = caching._update_headers(stored, update)
+    assert headers["Content-Type"] == "text/plain"
+    assert headers["Content-Length"] == "4"
+    assert headers["Cache-Control"] == "max-age=60"
+    assert headers["Date"] == "Tue, 02 Jan 2001 00:00:00 GMT"
+    assert caching._update_headers(stored, None) is stored
+
+def _cache_file(c, query):
+    identifier = hashlib.sha1(query).hexdigest()
+    return os.path.join(c.cachedir, identifier[:2], identifier[2:] + ".p")
+
+@tmpdir
+def test_cache_file_format(dirname):
+    opener = _FakeOpener()
+    opener.headers["ETag"] = '"v1"'
+    c = caching.cache("urn:x-test:cached_upstream", opener=opener)
+    c.get(q="x").close()
+    data = open(_cache_file(c, "q=x"), "rb").read()
+    assert data.startswith(caching.CACHE_FILE_MAGIC)
+    assert data.endswith("data for q=x")
+    f = c.get(q="x")
+    assert f.tell() == f.body_offset == len(data) - len("data for q=x")
+    assert str(f.body()) == "data for q=x"
+    assert f.read() == "data for q=x"
+    assert (f.getcode(), f.msg) == (200, "OK")
+    assert f.geturl() == "http://localhost:8880/cached_upstream?q=x"
+    assert f.info()["ETag"] == '"v1"'
+    assert f.info()["Content-Type"] == "text/plain"
+    assert len(opener.urls) == 1
+
+@tmpdir
+def test_cache_old_file_format(dirname):
+    opener = _FakeOpener()
+    c = caching.cache("urn:x-test:cached_upstream", opener=opener)
+    c.get(q="x").close()
+    # As written by older versions
+    f = open(_cache_file(c, "q=x"), "wb")
+    headers = _FakeResponse("", "", {"Content-Type": "text/html"}).info()
+    pickle.dump(("q=x", time.time(), "http://localhost:8880/cached_upstream?q=x", headers), f, -1)
+    f.write("old data")
+    f.close()
+    f = c.get(q="x")
+    assert f.read() == "old data"
+    assert f.info()["Content-Type"] == "text/html"
+    assert len(opener.urls) == 1
+    # Damaged files are misses
+    open(_cache_file(c, "q=x"), "wb").write(caching.CACHE_FILE_MAGIC + "\x01spam")
+    assert c.get(q="x").read() == "data for q=x"
+    open(_cache_file(c, "q=x"), "wb").write("spam")
+    assert c.get(q="x").read() == "data for q=x"
+    assert len(opener.urls) == 3
+
+###### Benchmark
+
+def benchmark_hit(n=100000):
+    "Time a response cache hit, in microseconds"
+    cache = caching.ResponseCache(expires=3600)
+    kwargs = dict(name="GREEK SMALL LETTER ALPHA")
+    cache.put(cache.make_key("charbyname", kwargs), "200 OK",
+              [("Content-Type", "text/plain")], "\xce\xb1")
+    t1 = time.time()
+    for i in xrange(n):
+        cache.get(cache.make_key("charbyname", kwargs))
+    t2 = time.time()
+    return (t2-t1) / n * 1000000
+
+def benchmark_index_add(num_entries=100000, n=1000):
+    "Time adding an entry to a full cache index, in microseconds"
+    dirname = tempfile.mkdtemp(prefix="akara_test_")
+    try:
+        index = caching._CacheIndex(dirname, maxentries=num_entries)
+        db = index._connect()
+        db.execute("BEGIN")
+        now = time.time()
+        for i in xrange(num_entries):
+            db.execute("INSERT INTO entries VALUES (?, 10, ?, ?)",
+                       ("%040x" % (i,), now - num_entries + i, now + 3600))
+        db.execute("UPDATE totals SET entries = ?, bytes = ?", (num_entries, num_entries*10))
+        db.execute("COMMIT")
+        t1 = time.time()
+        for i in xrange(n):
+            index.add("new%037x" % (i,), 10, now + 3600)
+        t2 = time.time()
+        return (t2-t1) / n * 1000000
+    finally:
+        shutil.rmtree(dirname)
+
+def benchmark_cache_hit(memory_maxbytes, size=15, n=20000, old_format=False,
+                        use_mmap=False):
+    "Time a caching.cache hit and read of a 'size' byte body, in microseconds"
+    dirname = tempfile.mkdtemp(prefix="akara_test_")
+    old_module_cache = getattr(global_config, "module_cache", None)
+    global_config.module_cache = dirname
+    global_config.server_address = ("localhost", 8880)
+    try:
+        opener = _FakeOpener()
+        opener.body = "x" * size
+        c = caching.cache("urn:x-test:cached_upstream", opener=opener,
+                          memory_maxbytes=memory_maxbytes)
+        c.get(q="spam").close()
+        if old_format:
+            f = open(_cache_file(c, "q=spam"), "wb")
+            pickle.dump(("q=spam", time.time(), opener.urls[0],
+                         _FakeResponse("", "", opener.headers).info()), f, -1)
+            f.write(opener.body)
+            f.close()
+        t1 = time.time()
+        if use_mmap:
+            for i in xrange(n):
+                f = c.get(q="spam")
+                f.body()[-1]
+                f.close()
+        else:
+            for i in xrange(n):
+                f = c.get(q="spam")
+                f.read()
+                f.close()
+        t2 = time.time()
+        return (t2-t1) / n * 1000000
+    finally:
+        global_config.module_cache = old_module_cache
+        shutil.rmtree(dirname)
+
+if __name__ == "__main__":
+    print "Response cache hit: %.2f us" % benchmark_hit()
+    for num_entries in (1000, 100000):
+        print "Index add, %6d entries: %.2f us" % (num_entries, benchmark_index_add(num_entries))
+    print "cache hit, disk: %.2f us" % benchmark_cache_hit(0)
+    print "cache hit, memory: %.2f us" % benchmark_cache_hit(1024*1024)
+    MB = 1024*1024
+    for label, size, n in (("1KB", 1024, 20000), ("10MB", 10*MB, 50)):
+        print "cache hit, %s, pickle format: %.2f us" % (
+            label, benchmark_cache_hit(0, size, n, old_format=True))
+        print "cache hit, %s: %.2f us" % (label, benchmark_cache_hit(0, size, n))
+        print "cache hit, %s, mmap: %.2f us" % (
+            label, benchmark_cache_hit(0, size, n, use_mmap=True))
@@ -1,6 +1,9 @@
 # Test internal Akara code
 
-from akara.services import convert_body
+import time
+import cgi
+
+from akara.services import convert_body, _ArgBinder, _HTTPError
 from amara import tree
 
 # Found a problem in the convert_body code. Returned the XML as a
@@ -38,3 +41,274 @@ def test_convert_body_list():
     result = convert_body(["blah"], None, None, None)
     assert result == (["blah"], "text/plain", None), result
 
+
+def test_convert_body_file():
+    import tempfile
+    from akara.thirdparty import httpserver
+    f = tempfile.TemporaryFile()
+    f.write("Hello, world")
+    f.seek(7)
+    result, ctype, length = convert_body(f, None, None, None)
+    assert isinstance(result, httpserver.FileWrapper), result
+    assert ctype == "text/plain", ctype
+    assert length == 5, length
+    assert "".join(result) == "world"
+    result.close()
+    assert f.closed
+
+def test_convert_body_generator():
+    closed = []
+    def gen():
+        try:
+            yield "Hello"
+            yield u", G\xf6teborg"
+            yield test_tree
+        finally:
+            closed.append(True)
+    result, ctype, length = convert_body(gen(), None, "utf-8", "xml")
+    assert ctype == "text/plain", ctype
+    assert length is None, length
+    s = "".join(result)
+    assert s == ('Hello, G\xc3\xb6teborg'
+                 '<?xml version="1.0" encoding="utf-8"?>\n<spam/>'), repr(s)
+    assert closed == [True]
+
+def test_convert_body_xml_stream():
+    result, ctype, length = convert_body(test_tree, None, "utf-8", "xml", stream=True)
+    assert ctype == "application/xml", ctype
+    assert length is None, length
+    written = []
+    assert result.send(written.append) == []
+    assert "".join(written) == '<?xml version="1.0" encoding="utf-8"?>\n<spam/>', written
+
+def _bind(binder, query_string, method="GET", body=""):
+    from cStringIO import StringIO
+    environ = {"REQUEST_METHOD": method, "QUERY_STRING": query_string,
+               "CONTENT_LENGTH": str(len(body)), "wsgi.input": StringIO(body),
+               "CONTENT_TYPE": "text/plain"}
+    return binder.bind(environ)
+
+def _bind_error(binder, query_string, method="GET"):
+    try:
+        _bind(binder, query_string, method)
+    except _HTTPError, err:
+        return err.code, err.message
+    raise AssertionError("no error for %r" % (query_string,))
+
+def test_arg_binder():
+    def f(a, b="x", c=None):
+        pass
+    binder = _ArgBinder(f, "GET", False)
+    assert _bind(binder, "a=1") == ((), {"a": "1"})
+    assert _bind(binder, "a=1&b=%41+B;c=") == ((), {"a": "1", "b": "A B"})
+    assert _bind(binder, "%61=1") == ((), {"a": "1"})
+    code, message = _bind_error(binder, "b=2")
+    assert code == 400 and "'a' query parameter is required" in message, message
+    code, message = _bind_error(binder, "a=1&d=2")
+    assert code == 400 and "'d' query parameter is not supported" in message, message
+    code, message = _bind_error(binder, "a=1&a=2")
+    assert code == 400 and "'a' query parameter multiple times" in message, message
+
+def test_arg_binder_repeated_args():
+    def f(a, b=[]):
+        pass
+    binder = _ArgBinder(f, "GET", True, dict(b=int))
+    assert _bind(binder, "a=1&b=2&a=3&b=4") == ((), {"a": ["1", "3"], "b": [2, 4]})
+    code, message = _bind_error(binder, "a=1&b=x")
+    assert code == 400 and "Bad value for the 'b' query parameter" in message, message
+
+def test_arg_binder_post():
+    def f(body, content_type, a=None):
+        pass
+    binder = _ArgBinder(f, "POST", False)
+    assert _bind(binder, "a=1", "POST", "data") == (("data", "text/plain"), {"a": "1"})
+    code, message = _bind_error(binder, "body=1", "POST")
+    assert code == 400, code
+
+def test_arg_binder_kwargs():
+    def f(a, **kwargs):
+        pass
+    binder = _ArgBinder(f, "GET", False, dict(n=int))
+    assert _bind(binder, "a=1&n=2&z=3") == ((), {"a": "1", "n": 2, "z": "3"})
+
+def test_arg_binder_bad_arg_types():
+    def f(a):
+        pass
+    try:
+        _ArgBinder(f, "GET", False, dict(b=int))
+        raise AssertionError("unknown arg_types name was allowed")
+    except ValueError, err:
+        assert "'b'" in str(err), str(err)
+
+###### Preloading extension modules
+
+import os
+import sys
+import shutil
+import logging
+import tempfile
+
+from akara import logger, read_config, multiprocess_http
+
+def _settings_for(preload_modules):
+    dirname = tempfile.mkdtemp(prefix="akara_test_")
+    try:
+        filename = os.path.join(dirname, "akara.conf")
+        f = open(filename, "w")
+        f.write("class Akara:\n  ConfigRoot = %r\n  PreloadModules = %r\nMODULES = []\n" %
+                (dirname, preload_modules))
+        f.close()
+        settings, config = read_config.read_config(filename)
+    finally:
+        shutil.rmtree(dirname)
+    return settings
+
+def test_preload_modules_setting():
+    assert _settings_for(0)["preload_modules"] is False
+    assert _settings_for(1)["preload_modules"] is True
+    assert _settings_for(["spam", "eggs"])["preload_modules"] == ["spam", "eggs"]
+    for bad in (2, "spam", ["spam", 1]):
+        try:
+            _settings_for(bad)
+            raise AssertionError("PreloadModules = %r was allowed" % (bad,))
+        except read_config.Error, err:
+            assert "PreloadModules" in str(err), str(err)
+
+# Each extension module written by these tests records its import here
+preload_imports = []
+
+def _write_module(dirname, module_name, fail=False):
+    f = open(os.path.join(dirname, module_name + ".py"), "w")
+    f.write("import test_internals\n"
+            "test_internals.preload_imports.append(__name__)\n")
+    if fail:
+        f.write("raise ValueError('cannot load ' + __name__)\n")
+    f.close()
+
+class _LogRecords(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+    def emit(self, record):
+        self.records.append(record)
+
+def preload_modules_dir(func):
+    def wrapper():
+        dirname = tempfile.mkdtemp(prefix="akara_test_")
+        module_names = ["akara_test_preload_%d" % i for i in range(3)]
+        for module_name in module_names:
+            _write_module(dirname, module_name)
+        # The tests rewrite the modules faster than the .pyc timestamps can tell
+        old_dont_write_bytecode = sys.dont_write_bytecode
+        sys.dont_write_bytecode = True
+        sys.path.insert(0, dirname)
+        records = _LogRecords()
+        logger.addHandler(records)
+        del preload_imports[:]
+        try:
+            func(dirname, module_names, records)
+        finally:
+            logger.removeHandler(records)
+            sys.path.remove(dirname)
+            sys.dont_write_bytecode = old_dont_write_bytecode
+            for module_name in module_names:
+                sys.modules.pop(module_name, None)
+            del multiprocess_http._preloaded_modules[:]
+            shutil.rmtree(dirname)
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+@preload_modules_dir
+def test_preload_none(dirname, module_names, records):
+    config = {"MODULES": module_names}
+    assert multiprocess_http._preload_modules(config, False) == ()
+    assert preload_imports == [], preload_imports
+
+@preload_modules_dir
+def test_preload_all(dirname, module_names, records):
+    config = {"MODULES": module_names}
+    preloaded = multiprocess_http._preload_modules(config, True)
+    assert preloaded == tuple(module_names), preloaded
+    assert preload_imports == module_names, preload_imports
+
+@preload_modules_dir
+def test_preload_some(dirname, module_names, records):
+    config = {"MODULES": module_names}
+    preloaded = multiprocess_http._preload_modules(config, [module_names[1], "akara_test_missing"])
+    assert preloaded == (module_names[1],), preloaded
+    assert preload_imports == [module_names[1]], preload_imports
+    # The name which isn't in MODULES is reported, not silently ignored
+    warnings = [record.getMessage() for record in records.records
+                    if record.levelno == logging.WARN]
+    assert len(warnings) == 1 and "'akara_test_missing'" in warnings[0], warnings
+
+@preload_modules_dir
+def test_preload_skipped_in_child(dirname, module_names, records):
+    config = {"MODULES": module_names}
+    preloaded = multiprocess_http._preload_modules(config, module_names[:2])
+    del preload_imports[:]
+    # As if in a newly forked child
+    multiprocess_http._init_modules(config, skip=preloaded)
+    assert preload_imports == [module_names[2]], preload_imports
+
+@preload_modules_dir
+def test_preload_failure_retried_in_child(dirname, module_names, records):
+    config = {"MODULES": module_names}
+    _write_module(dirname, module_names[0], fail=True)
+    preloaded = multiprocess_http._preload_modules(config, True)
+    assert preloaded == tuple(module_names[1:]), preloaded
+    assert module_names[0] not in sys.modules
+    errors = [record.getMessage() for record in records.records
+                  if record.levelno == logging.ERROR]
+    assert len(errors) == 1 and repr(module_names[0]) in errors[0], errors
+    # Fixed before the child gets to it
+    _write_module(dirname, module_names[0])
+    del preload_imports[:]
+    multiprocess_http._init_modules(config, skip=preloaded)
+    assert preload_imports == [module_names[0]], preload_imports
+    assert module_names[0] in sys.modules
+
+@preload_modules_dir
+def test_preload_again_after_sighup(dirname, module_names, records):
+    config = {"MODULES": module_names}
+    preloaded = multiprocess_http._preload_modules(config, True)
+    first = sys.modules[module_names[1]]
+    del preload_imports[:]
+    # A restart preloads the modules again, and runs their (new) code
+    _write_module(dirname, module_names[0], fail=True)
+    preloaded = multiprocess_http._preload_modules(config, True)
+    assert preloaded == tuple(module_names[1:]), preloaded
+    assert preload_imports == module_names, preload_imports
+    assert module_names[0] not in sys.modules
+    assert sys.modules[module_names[1]] is not first
+
+
+###### Benchmark
+
+def benchmark_arg_binding(n=100000):
+    "Time making the keyword arguments from a query string, in microseconds"
+    def f(q, start="0", count="10", format="xml"):
+        pass
+    query_string = "q=akara+services&start=20&count=10&format=json"
+    parse_query = _ArgBinder(f, "GET", False).parse_query
+    t1 = time.time()
+    for i in xrange(n):
+        parse_query(query_string)
+    t2 = time.time()
+    return (t2-t1) / n * 1000000
+
+def benchmark_parse_qs(n=100000):
+    "Time the cgi.parse_qs based argument handling, in microseconds"
+    query_string = "q=akara+services&start=20&count=10&format=json"
+    t1 = time.time()
+    for i in xrange(n):
+        kwargs = {}
+        for k, v in cgi.parse_qs(query_string).iteritems():
+            if len(v) == 1:
+                kwargs[k] = v[0]
+    t2 = time.time()
+    return (t2-t1) / n * 1000000
+
+if __name__ == "__main__":
+    print "cgi.parse_qs: %.2f us/request" % benchmark_parse_qs()
+    print "_ArgBinder:   %.2f us/request" % benchmark_arg_binding()
@@ -0,0 +1,149 @@
+# Test the spool for asynchronous notifications
+
+import os
+import time
+import shutil
+import tempfile
+
+from akara import notify, registry, global_config, scoreboard
+
+def tmpdir(func):
+    def wrapper():
+        dirname = tempfile.mkdtemp(prefix="akara_test_")
+        old_module_cache = getattr(global_config, "module_cache", None)
+        global_config.module_cache = os.path.join(dirname, "caches")
+        notify._spool_dir = None
+        try:
+            func(dirname)
+        finally:
+            global_config.module_cache = old_module_cache
+            notify._spool_dir = None
+            shutil.rmtree(dirname)
+    wrapper.__name__ = func.__name__
+    return wrapper
+
+received = []
+def record_handler(environ, start_response):
+    received.append((environ["QUERY_STRING"], environ["wsgi.input"].read()))
+    start_response("200 OK", [])
+    return ["ok"]
+
+def failing_handler(environ, start_response):
+    start_response("503 Service Unavailable", [])
+    return ["not now"]
+
+registry.register_service("urn:x-test:notify_record", "notify_record", record_handler)
+def hanging_handler(environ, start_response):
+    time.sleep(10)
+    start_response("200 OK", [])
+    return ["too late"]
+
+registry.register_service("urn:x-test:notify_failing", "notify_failing", failing_handler)
+registry.register_service("urn:x-test:notify_hanging", "notify_hanging", hanging_handler)
+
+def _spooled(spool_dir):
+    return sorted(name for name in os.listdir(spool_dir) if name.endswith(".job"))
+
+@tmpdir
+def test_deliver(dirname):
+    del received[:]
+    environ = {"QUERY_STRING": "a=1", "REQUEST_METHOD": "GET",
+               "wsgi.input": object(), "wsgiorg.routing_args": ((), {"x": "y"})}
+    notify.spool_notifications(environ, "the body", ["urn:x-test:notify_record"])
+    assert notify.spool_depth() == (1, 0, 0), notify.spool_depth()
+    notify.deliver_spooled()
+    assert received == [("a=1", "the body")], received
+    assert notify.spool_depth() == (0, 0, 0), notify.spool_depth()
+
+@tmpdir
+def test_spool_depth_without_spool(dirname):
+    assert notify.spool_depth() == (0, 0, 0), notify.spool_depth()
+    # Asking isn't a reason to make it
+    assert not os.path.exists(os.path.join(global_config.module_cache, "notify_spool"))
+
+@tmpdir
+def test_retry(dirname):
+    spool_dir = notify.get_spool_dir()
+    notify.spool_notifications({"QUERY_STRING": ""}, "", ["urn:x-test:notify_failing"])
+    first = _spooled(spool_dir)
+    notify.deliver_spooled()
+    # Spooled again, for later
+    second = _spooled(spool_dir)
+    assert len(second) == 1 and second[0][:17] > first[0][:17], (first, second)
+    notify.deliver_spooled()
+    assert _spooled(spool_dir) == second
+
+@tmpdir
+def test_give_up(dirname):
+    spool_dir = notify.get_spool_dir()
+    notify.spool_notifications({"QUERY_STRING": ""}, "", ["urn:x-test:notify_failing"])
+    for i in range(notify.MAX_DELIVERY_ATTEMPTS):
+        # Make the retry due now
+        for name in _spooled(spool_dir):
+            os.rename(os.path.join(spool_dir, name),
+                      os.path.join(spool_dir, "0" + name[1:]))
+        notify.deliver_spooled()
+    assert notify.spool_depth() == (0, 0, 1), notify.spool_depth()
+
+@tmpdir
+def test_reclaim_abandoned(dirname):
+    del received[:]
+    spool_dir = notify.get_spool_dir()
+    notify.spool_notifications({"QUERY_STRING": ""}, "spam", ["urn:x-test:notify_record"])
+    name = _spooled(spool_dir)[0]
+    # As if claimed by a server which has since died. Process ids
+    # don't go this high.
+    os.rename(os.path.join(spool_dir, name),
+              os.path.join(spool_dir, name + ".99999999.work"))
+    assert notify.spool_depth() == (0, 1, 0), notify.spool_depth()
+    notify.deliver_spooled()
+    assert received == [("", "spam")], received
+    assert notify.spool_depth() == (0, 0, 0), notify.spool_depth()
+
+@tmpdir
+def test_unreadable(dirname):
+    spool_dir = notify.get_spool_dir()
+    f = open(os.path.join(spool_dir, "0000000000.000000-1-1.job"), "wb")
+    f.write("not a pickle")
+    f.close()
+    notify.deliver_spooled()
+    assert notify.spool_depth() == (0, 0, 1), notify.spool_depth()
+
+@tmpdir
+def test_time_limit(dirname):
+    del received[:]
+    notify.spool_notifications({"QUERY_STRING": ""}, "", ["urn:x-test:notify_record"] * 3)
+    notify.deliver_spooled(time_limit=0)
+    assert received == [], received
+    notify.deliver_spooled(time_limit=60)
+    assert len(received) == 3, received
+
+@tmpdir
+def test_timeout(dirname):
+    spool_dir = notify.get_spool_dir()
+    notify.spool_notifications({"QUERY_STRING": ""}, "", ["urn:x-test:notify_hanging"])
+    first = _spooled(spool_dir)
+    t1 = time.time()
+    notify.deliver_spooled(timeout=0.2)
+    assert time.time() - t1 < 5
+    # Counted as a failed attempt and spooled again, for later
+    second = _spooled(spool_dir)
+    assert len(second) == 1 and second[0][:17] > first[0][:17], (first, second)
+    assert notify.spool_depth() == (1, 0, 0), notify.spool_depth()
+
+class _Slot(object):
+    def __init__(self):
+        self.states = []
+    def set_state(self, state):
+        self.states.append(state)
+    def record_latency(self, mount_point, status, elapsed_us):
+        pass
+
+@tmpdir
+def test_slot_state(dirname):
+    slot = _Slot()
+    notify.deliver_spooled(slot)
+    assert slot.states == [], slot.states
+    notify.spool_notifications({"QUERY_STRING": ""}, "", ["urn:x-test:notify_record"])
+    notify.deliver_spooled(slot)
+    assert slot.states == [scoreboard.SLOT_NOTIFY], slot.states
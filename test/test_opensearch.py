@@ -1,5 +1,6 @@
-from akara.opensearch import apply_template
+from akara.opensearch import apply_template, make_template, TemplateMatcher
 
+import time
 import unittest
 
 class Tests(unittest.TestCase):
@@ -177,5 +178,196 @@ class Tests(unittest.TestCase):
         self.assertEquals(apply_template("http://localhost:{port?}/?q", port="123"),
                           "http://localhost:123/?q")
 
+    def test_make_template_is_cached(self):
+        T = "http://example.com/search?q={searchTerms}&lang={lang?}"
+        t = make_template(T)
+        self.assert_(make_template(T) is t)
+        self.assertEquals(t.template, T)
+
+    def test_substitute_many(self):
+        t = make_template("http://{host}:{port?}/search?q={q}&lang={lang?}")
+        self.assertEquals(t.substitute_many([dict(host="a", q="x y"),
+                                             dict(host="b", port=8080, q=u"Espa\u00F1a", lang="es"),
+                                             ]),
+                          ["http://a/search?q=x+y&lang=",
+                           "http://b:8080/search?q=Espa%C3%B1a&lang=es"])
+        self.assertEquals(t.substitute_many([]), [])
+        self.assertRaises(KeyError, t.substitute_many, [dict(host="a")])
+
+    def test_compiled_matches_terms(self):
+        # The compiled function must give the same result as the terms
+        for T, params in (
+            ("http://example.com/", {}),
+            ("{scheme}://{user?}@{host}.example.com:{port}/{a}{b?}?x={c}#{d?}",
+             dict(scheme="ftp", host=u"Espa\u00F1a", port="21", a="/", c="&")),
+            ("http://localhost/{0}'\"\\n", {"0": "zero"}),
+            ):
+            t = make_template(T)
+            self.assertEquals(t.substitute(**params), _reference_substitute(t, params))
+
+    def test_match(self):
+        t = make_template("http://example.com/search?q={q}&lang={lang?}")
+        self.assertEquals(t.match("http://example.com/search?q=spam+%26+eggs&lang=en"),
+                          {"q": "spam & eggs", "lang": "en"})
+        # Optional fields are left out when empty
+        self.assertEquals(t.match("http://example.com/search?q=spam&lang="),
+                          {"q": "spam"})
+        # Required fields can be empty
+        self.assertEquals(t.match("http://example.com/search?q=&lang="),
+                          {"q": ""})
+        self.assertEquals(t.match("http://example.com/search?q=Espa%C3%B1a&lang="),
+                          {"q": u"Espa\u00F1a"})
+        # Query parameters in any order, and ones with only optional
+        # fields may be left out
+        self.assertEquals(t.match("http://example.com/search?lang=en&q=spam"),
+                          {"q": "spam", "lang": "en"})
+        self.assertEquals(t.match("http://example.com/search?q=spam"), {"q": "spam"})
+        # Values as they are in real URLs
+        self.assertEquals(t.match("http://example.com/search?q=a/b:c,d~e@f!g&lang=en"),
+                          {"q": "a/b:c,d~e@f!g", "lang": "en"})
+        for url in ("http://example.com/search?lang=en",
+                    "http://example.com/search",
+                    "http://example.com/search?q=spam&lang=en&x=1",
+                    "http://example.com/search?q=spam&q=eggs",
+                    "http://example.com/search?q=spam#top",
+                    "http://example.org/search?q=spam&lang=en"):
+            self.assertEquals(t.match(url), None)
+
+    def test_match_path(self):
+        t = make_template("http://example.com/{wiki}/{page}")
+        self.assertEquals(t.match("http://example.com/w:1/a,b~c@d!e"),
+                          {"wiki": "w:1", "page": "a,b~c@d!e"})
+        self.assertEquals(t.match("http://example.com/w/a/b"), None)
+        self.assertEquals(t.match("http://example.com/w/a?x=1"), None)
+
+    def test_match_query_structure(self):
+        # Without name=value parameters the query must match as it is
+        t = make_template("http://example.com/search?{q}")
+        self.assertEquals(t.match("http://example.com/search?a/b"), {"q": "a/b"})
+        self.assertEquals(t.match("http://example.com/search?a&b"), None)
+        t = make_template("http://example.com/search?q={q}&q={r}")
+        self.assertEquals(t.match("http://example.com/search?q=1&q=2"), {"q": "1", "r": "2"})
+        t = make_template("http://example.com/search?x=a{q}")
+        self.assertEquals(t.match("http://example.com/search?x=ab"), {"q": "b"})
+        self.assertEquals(t.match("http://example.com/search?x=b"), None)
+        self.assertEquals(t.match("http://example.com/search"), None)
+
+    def test_template_matcher(self):
+        matcher = TemplateMatcher(["http://localhost/a?x={x}",
+                                   "http://localhost/a?y={y}",
+                                   "http://localhost/{path}?x={x}"])
+        t, params = matcher.match("http://localhost/a?y=1")
+        self.assertEquals((t.template, params), ("http://localhost/a?y={y}", {"y": "1"}))
+        t, params = matcher.match("http://localhost/a?x=1")
+        self.assertEquals((t.template, params), ("http://localhost/a?x={x}", {"x": "1"}))
+        t, params = matcher.match("http://localhost/b?x=1")
+        self.assertEquals((t.template, params),
+                          ("http://localhost/{path}?x={x}", {"path": "b", "x": "1"}))
+        self.assertEquals(matcher.match("http://localhost/b?y=1"), (None, None))
+
+    def test_match_round_trip(self):
+        for T, params in (
+            ("http://example.com/", {}),
+            ("{scheme}://{user?}@{host}.example.com:{port}/{a}/{b?}?x={c}#{d?}",
+             dict(scheme="ftp", user=u"\u00F1", host=u"espa\u00F1a",
+                  port="21", a="/", b="b", c="&", d=" ")),
+            ("http://{host}:{port?}/{path}", dict(host="localhost", path="x y")),
+            ("http://localhost/{a?}/{a?}", dict(a="z")),
+            ):
+            t = make_template(T)
+            self.assertEquals(t.match(t.substitute(**params)), params)
+
+    def test_match_repeated_field(self):
+        t = make_template("http://localhost/{a}/{a}")
+        self.assertEquals(t.match("http://localhost/x/x"), {"a": "x"})
+        self.assertEquals(t.match("http://localhost/x/y"), None)
+
+###### Benchmarks
+
+# The way Template.substitute worked before the terms were compiled
+def _reference_substitute(template, kwargs):
+    results = []
+    for term in template.terms:
+        if isinstance(term, basestring):
+            results.append(term)
+        else:
+            results.append(term(kwargs))
+    return "".join(results)
+
+BENCHMARK_TEMPLATE = "http://localhost:8880/akara.xslt?@xslt={xslt}&format={format?}"
+BENCHMARK_PARAMS = dict(xslt="http://example.com/spam.xslt", format="xml")
+
+def benchmark_apply_template(n=20000):
+    "Time apply_template, in microseconds"
+    t1 = time.time()
+    for i in xrange(n):
+        apply_template(BENCHMARK_TEMPLATE, **BENCHMARK_PARAMS)
+    t2 = time.time()
+    return (t2-t1) / n * 1000000
+
+def benchmark_reference_apply_template(n=20000):
+    "Time the uncached parse and substitution, in microseconds"
+    from akara.opensearch import decompose_template
+    t1 = time.time()
+    for i in xrange(n):
+        terms = decompose_template(BENCHMARK_TEMPLATE)
+        results = []
+        for term in terms:
+            if isinstance(term, basestring):
+                results.append(term)
+            else:
+                results.append(term(BENCHMARK_PARAMS))
+        "".join(results)
+    t2 = time.time()
+    return (t2-t1) / n * 1000000
+
+def benchmark_substitute(n=200000):
+    "Time Template.substitute and the reference version, in microseconds"
+    t = make_template(BENCHMARK_TEMPLATE)
+    t1 = time.time()
+    for i in xrange(n):
+        t.substitute(**BENCHMARK_PARAMS)
+    t2 = time.time()
+    for i in xrange(n):
+        _reference_substitute(t, BENCHMARK_PARAMS)
+    t3 = time.time()
+    return (t2-t1) / n * 1000000, (t3-t2) / n * 1000000
+
+def benchmark_substitute_many(n=10000):
+    "Time building n URLs with substitute_many, in microseconds per URL"
+    t = make_template(BENCHMARK_TEMPLATE)
+    params_list = [dict(xslt="http://example.com/%d.xslt" % (i,)) for i in range(n)]
+    t1 = time.time()
+    t.substitute_many(params_list)
+    t2 = time.time()
+    return (t2-t1) / n * 1000000
+
+def benchmark_match(num_templates=1000, n=100000):
+    "Time finding the template for a URL among many with TemplateMatcher, in microseconds"
+    matcher = TemplateMatcher()
+    urls = []
+    for i in range(num_templates):
+        t = make_template("http://localhost:8880/service%d?a={a}&b={b?}&c={c?}" % (i,))
+        matcher.add(t)
+        # Some with fields in the path, which are tried one by one
+        if i % 100 == 0:
+            matcher.add("http://localhost:8880/wiki%d/{page}?a={a}" % (i,))
+        urls.append(t.substitute(a="spam/%d" % (i,), c=u"Espa\u00F1a"))
+    for url in urls:
+        matcher.match(url)  # compile the regular expressions
+    t1 = time.time()
+    for i in xrange(n):
+        matcher.match(urls[i % num_templates])
+    t2 = time.time()
+    return (t2-t1) / n * 1000000
+
 if __name__ == "__main__":
-    unittest.main()
+    import sys
+    if sys.argv[1:] == ["--benchmark"]:
+        print "apply_template:  %.2f us (reference: %.2f us)" % (
+            benchmark_apply_template(), benchmark_reference_apply_template())
+        print "substitute:      %.2f us (reference: %.2f us)" % benchmark_substitute()
+        print "substitute_many: %.2f us/URL" % benchmark_substitute_many()
+        print "match:           %.2f us" % benchmark_match()
+    else:
+        unittest.main()
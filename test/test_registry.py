@@ -0,0 +1,185 @@
+# Test the service registry
+
+import time
+
+from akara import registry
+
+def handler(environ, start_response):
+    "Test handler"
+    return []
+
+def test_get_service():
+    reg = registry.Registry()
+    reg.register_service("urn:x-test:a", "a", handler)
+    service = reg.get_service("a")
+    assert service.ident == "urn:x-test:a"
+    assert service.path == "a"
+    assert service.doc == "Test handler"
+    try:
+        reg.get_service("b")
+        raise AssertionError("unknown path was found")
+    except KeyError:
+        pass
+
+def test_get_services_by_ident():
+    reg = registry.Registry()
+    assert reg.get_services_by_ident("urn:x-test:a") == []
+    assert reg.get_a_service_by_ident("urn:x-test:a") is None
+
+    reg.register_service("urn:x-test:a", "a1", handler)
+    reg.register_service("urn:x-test:b", "b", handler)
+    reg.register_service("urn:x-test:a", "a2", handler)
+    paths = [service.path for service in reg.get_services_by_ident("urn:x-test:a")]
+    assert paths == ["a1", "a2"], paths
+    assert reg.get_a_service_by_ident("urn:x-test:a").path == "a1"
+    assert reg.get_a_service_by_ident("urn:x-test:b").path == "b"
+
+def test_replace_mount_point():
+    reg = registry.Registry()
+    reg.register_service("urn:x-test:a", "spam", handler)
+    reg.register_service("urn:x-test:b", "spam", handler)
+    assert reg.get_service("spam").ident == "urn:x-test:b"
+    assert reg.get_services_by_ident("urn:x-test:a") == []
+    assert reg.get_a_service_by_ident("urn:x-test:a") is None
+    assert reg.get_a_service_by_ident("urn:x-test:b").path == "spam"
+
+def test_generation():
+    reg = registry.Registry()
+    generation = reg.generation
+    reg.register_service("urn:x-test:a", "a", handler)
+    assert reg.generation != generation
+    generation = reg.generation
+    reg.register_service("urn:x-test:a", "a", handler)
+    assert reg.generation != generation
+
+def test_list_services_by_ident():
+    reg = registry.Registry()
+    reg.register_service("urn:x-test:a", "a2", handler)
+    reg.register_service("urn:x-test:b", "b", handler)
+    reg.register_service("urn:x-test:a", "a1", handler)
+    doc = reg.list_services(ident="urn:x-test:a")
+    paths = [path.xml_select(u"string(.)") for path in doc.xml_select(u"//service/path")]
+    assert paths == [u"a1", u"a2"], paths
+    doc = reg.list_services()
+    assert len(doc.xml_select(u"//service")) == 3
+
+def test_match_path():
+    reg = registry.Registry()
+    reg.register_service("urn:x-test:root", "", handler)
+    reg.register_service("urn:x-test:a", "a", handler)
+    reg.register_service("urn:x-test:page", "moin/{wiki}/{page}", handler)
+    reg.register_service("urn:x-test:index", "moin/{wiki}/index", handler)
+    reg.register_service("urn:x-test:wiki", "moin/{wiki}", handler)
+
+    def match(path_info):
+        service, args, num_segments = reg.match_path(path_info)
+        return service.ident, args, num_segments
+
+    assert match("/") == ("urn:x-test:root", {}, 1)
+    assert match("/a") == ("urn:x-test:a", {}, 1)
+    assert match("/a/b/c") == ("urn:x-test:a", {}, 1)
+    assert match("/moin/w") == ("urn:x-test:wiki", {"wiki": "w"}, 2)
+    assert match("/moin/w/") == ("urn:x-test:wiki", {"wiki": "w"}, 2)
+    assert match("/moin/w/p") == ("urn:x-test:page", {"wiki": "w", "page": "p"}, 3)
+    assert match("/moin/w/p/x") == ("urn:x-test:page", {"wiki": "w", "page": "p"}, 3)
+    assert match("/moin//w/./p") == ("urn:x-test:page", {"wiki": "w", "page": "p"}, 3)
+    assert match("/moin/w/index") == ("urn:x-test:index", {"wiki": "w"}, 3)
+    for path_info in ("/b", "/moin", "/moin/", "/A"):
+        try:
+            reg.match_path(path_info)
+            raise AssertionError("matched %r" % (path_info,))
+        except KeyError:
+            pass
+
+def test_match_path_backtrack():
+    reg = registry.Registry()
+    reg.register_service("urn:x-test:ab", "a/b", handler)
+    reg.register_service("urn:x-test:xc", "{x}/c", handler)
+    reg.register_service("urn:x-test:xyd", "{x}/{y}/d", handler)
+    reg.register_service("urn:x-test:a", "a", handler)
+
+    def match(path_info):
+        service, args, num_segments = reg.match_path(path_info)
+        return service.ident, args, num_segments
+
+    assert match("/a/b") == ("urn:x-test:ab", {}, 2)
+    assert match("/a/c") == ("urn:x-test:xc", {"x": "a"}, 2)
+    assert match("/z/c") == ("urn:x-test:xc", {"x": "z"}, 2)
+    # The longest match wins, then the literal
+    assert match("/a/b/d") == ("urn:x-test:xyd", {"x": "a", "y": "b"}, 3)
+    assert match("/a/b/e") == ("urn:x-test:ab", {}, 2)
+    assert match("/a/e") == ("urn:x-test:a", {}, 1)
+
+def test_match_path_segments():
+    # The matched segments are the ones shift_path_info() moves
+    from wsgiref.util import shift_path_info
+    reg = registry.Registry()
+    reg.register_service("urn:x-test:page", "moin/{wiki}/{page}", handler)
+    for path_info in ("/moin/w/p", "/moin/w/p/", "/moin//w/p/x/y", "/moin/./w/p//x"):
+        service, args, num_segments = reg.match_path(path_info)
+        environ = {"SCRIPT_NAME": "", "PATH_INFO": path_info}
+        names = [shift_path_info(environ) for i in range(num_segments)]
+        assert names == ["moin", "w", "p"], (path_info, names)
+
+def test_bad_paths():
+    reg = registry.Registry()
+    for path in ("a//b", "a/", "/a", "a/{b", "a/{}", "a/{1x}", "a/b{c}"):
+        try:
+            reg.register_service("urn:x-test:a", path, handler)
+            raise AssertionError("path %r was allowed" % (path,))
+        except ValueError:
+            pass
+
+def test_conflicting_paths():
+    reg = registry.Registry()
+    reg.register_service("urn:x-test:a", "a/{x}", handler)
+    try:
+        reg.register_service("urn:x-test:b", "a/{y}", handler)
+        raise AssertionError("conflicting path was allowed")
+    except ValueError, err:
+        assert "conflicts" in str(err)
+    assert reg.get_a_service_by_ident("urn:x-test:b") is None
+
+###### Benchmark
+
+def benchmark_ident_lookup(num_services=500, n=100000):
+    "Time the lookup of a service by ident, in microseconds"
+    reg = registry.Registry()
+    for i in range(num_services):
+        reg.register_service("urn:x-test:%d" % (i,), "service%d" % (i,), handler)
+    # Look for the services in the order most likely to be slow for a scan
+    idents = ["urn:x-test:%d" % (i,) for i in range(num_services-1, -1, -1)]
+    lookup = reg.get_a_service_by_ident
+    t1 = time.time()
+    for i in xrange(n):
+        lookup(idents[i % num_services])
+    t2 = time.time()
+    return (t2-t1) / n * 1000000
+
+def benchmark_routing(num_routes=5000, n=100000):
+    "Time finding the service for a request path, in microseconds"
+    reg = registry.Registry()
+    for i in range(num_routes):
+        if i % 2:
+            path = "service%d/{wiki}/{page}" % (i,)
+        else:
+            path = "service%d/static/index" % (i,)
+        reg.register_service("urn:x-test:%d" % (i,), path, handler)
+    paths = []
+    for i in range(num_routes):
+        if i % 2:
+            paths.append("/service%d/spam/eggs/extra" % (i,))
+        else:
+            paths.append("/service%d/static/index" % (i,))
+    match = reg.match_path
+    t1 = time.time()
+    for i in xrange(n):
+        match(paths[i % num_routes])
+    t2 = time.time()
+    return (t2-t1) / n * 1000000
+
+if __name__ == "__main__":
+    for num_services in (10, 100, 500, 1000):
+        print "%4d services: %.2f us/lookup" % (num_services, benchmark_ident_lookup(num_services))
+    for num_routes in (10, 1000, 10000):
+        print "%5d routes: %.2f us/match" % (num_routes, benchmark_routing(num_routes))
@@ -0,0 +1,325 @@
+# Test the shared-memory server scoreboard
+
+import os
+import time
+import tempfile
+import sys
+import urllib2
+from cStringIO import StringIO
+
+from akara import scoreboard, commandline
+import server_support
+
+
+def _make_scoreboard(num_slots=3):
+    fd, filename = tempfile.mkstemp(prefix="akara_scoreboard_")
+    os.close(fd)
+    return scoreboard.Scoreboard(filename, num_slots)
+
+def test_empty():
+    board = _make_scoreboard()
+    try:
+        status = scoreboard.read_scoreboard(board.filename)
+        assert status["retired_requests"] == 0, status
+        assert status["retired_bytes"] == 0, status
+        assert abs(status["start_time"] - time.time()) < 5, status
+        assert len(status["slots"]) == 3, status
+        for slot in status["slots"]:
+            assert slot["state"] == scoreboard.SLOT_FREE, slot
+            assert slot["pid"] == 0, slot
+            assert slot["requests"] == 0, slot
+    finally:
+        os.unlink(board.filename)
+
+def test_allocate_and_release():
+    board = _make_scoreboard(2)
+    try:
+        assert board.allocate() == 0
+        assert board.allocate() == 1
+        assert board.allocate() is None
+        assert board.state(0) == scoreboard.SLOT_STARTING
+        assert board.is_available(0)
+        board.release(0)
+        assert board.state(0) == scoreboard.SLOT_FREE
+        assert board.allocate() == 0
+    finally:
+        os.unlink(board.filename)
+
+def test_slot_updates():
+    board = _make_scoreboard()
+    try:
+        index = board.allocate()
+        board.set_pid(index, 1234)
+        slot = board.slot(index)
+        slot.set_state(scoreboard.SLOT_IDLE)
+        assert board.is_available(index)
+
+        slot.start_request("GET /spam?x=1 HTTP/1.1")
+        slot.set_mount_point(u"spam")
+        assert not board.is_available(index)
+        status = scoreboard.read_scoreboard(board.filename)
+        info = status["slots"][index]
+        assert info["pid"] == 1234, info
+        assert info["state"] == scoreboard.SLOT_BUSY, info
+        assert info["request"] == "GET /spam?x=1 HTTP/1.1", info
+        assert info["mount_point"] == "spam", info
+        assert info["requests"] == 0, info
+
+        slot.end_request(100)
+        slot.start_request("GET /eggs HTTP/1.1")
+        slot.end_request(20)
+        slot.set_state(scoreboard.SLOT_KEEPALIVE)
+        assert not board.is_available(index)
+        info = scoreboard.read_scoreboard(board.filename)["slots"][index]
+        assert info["requests"] == 2, info
+        assert info["bytes"] == 120, info
+        assert info["mount_point"] == "", info
+
+        # The totals are kept after the server goes away
+        board.release(index)
+        status = scoreboard.read_scoreboard(board.filename)
+        assert status["retired_requests"] == 2, status
+        assert status["retired_bytes"] == 120, status
+        assert status["slots"][index]["requests"] == 0, status
+    finally:
+        os.unlink(board.filename)
+
+def test_long_request_line():
+    board = _make_scoreboard()
+    try:
+        slot = board.slot(board.allocate())
+        slot.start_request("GET /" + "x"*1000 + " HTTP/1.1")
+        info = scoreboard.read_scoreboard(board.filename)["slots"][0]
+        assert info["request"] == "GET /" + "x"*123, info
+    finally:
+        os.unlink(board.filename)
+
+def test_not_a_scoreboard():
+    fd, filename = tempfile.mkstemp(prefix="akara_scoreboard_")
+    try:
+        os.write(fd, "This is not a scoreboard" * 10)
+        os.close(fd)
+        try:
+            scoreboard.read_scoreboard(filename)
+            raise AssertionError("should not get here")
+        except ValueError:
+            pass
+    finally:
+        os.unlink(filename)
+
+def test_summarize():
+    board = _make_scoreboard(4)
+    try:
+        for i in range(3):
+            board.set_pid(board.allocate(), 100+i)
+        board.slot(0).set_state(scoreboard.SLOT_IDLE)
+        slot = board.slot(1)
+        slot.start_request("GET /spam HTTP/1.1")
+        slot.end_request(10)
+        slot.start_request("GET /eggs HTTP/1.1")
+        board.slot(2).set_state(scoreboard.SLOT_KEEPALIVE)
+
+        status = scoreboard.read_scoreboard(board.filename)
+        summary = scoreboard.summarize(status, status["start_time"] + 10)
+        assert summary["busy"] == 2, summary
+        assert summary["idle"] == 1, summary
+        assert summary["total_requests"] == 1, summary
+        assert summary["requests_per_second"] == 0.1, summary
+        assert [w["pid"] for w in summary["workers"]] == [100, 101, 102], summary
+        assert summary["workers"][0]["elapsed"] is None
+        assert summary["workers"][1]["elapsed"] >= 0.0
+        assert summary["workers"][2]["elapsed"] is None
+
+        # And the command-line version of the report
+        stdout = sys.stdout
+        sys.stdout = io = StringIO()
+        try:
+            commandline.live_status(board.filename)
+        finally:
+            sys.stdout = stdout
+        content = io.getvalue()
+        assert "Servers: 2 busy, 1 idle" in content, content
+        assert "GET /eggs HTTP/1.1" in content, content
+        assert "GET /spam" not in content, content
+    finally:
+        os.unlink(board.filename)
+
+def test_latency_histograms():
+    board = _make_scoreboard(2)
+    try:
+        slot = board.slot(board.allocate())
+        for elapsed_us in (1, 100, 150, 3000):
+            slot.record_latency("xslt", "200", elapsed_us)
+        slot.record_latency(u"xslt", "404", 5)
+        other = board.slot(board.allocate())
+        other.record_latency("xslt", "200", 120)
+
+        histograms = scoreboard.read_scoreboard(board.filename)["histograms"]
+        assert sorted(histograms) == [("xslt", "2"), ("xslt", "4")], histograms
+        h = histograms["xslt", "2"]
+        assert h["count"] == 5, h
+        assert h["sum_us"] == 3371, h
+        assert h["buckets"][0] == 1, h      # < 2us
+        assert h["buckets"][6] == 2, h      # [64, 128)us
+        assert h["buckets"][7] == 1, h      # [128, 256)us
+        assert h["buckets"][11] == 1, h     # [2048, 4096)us
+        assert sum(h["buckets"]) == 5, h
+
+        # Histograms survive the server which recorded them
+        board.release(0)
+        board.release(1)
+        histograms = scoreboard.read_scoreboard(board.filename)["histograms"]
+        assert histograms["xslt", "2"] == h, histograms
+        assert histograms["xslt", "4"]["count"] == 1, histograms
+    finally:
+        os.unlink(board.filename)
+
+def test_too_many_histograms():
+    board = _make_scoreboard(1)
+    try:
+        slot = board.slot(board.allocate())
+        num_regular = scoreboard.MAX_HISTOGRAMS - len(scoreboard._OVERFLOW_CLASSES)
+        for i in range(scoreboard.MAX_HISTOGRAMS + 10):
+            slot.record_latency("mount%d" % i, "200", 10)
+        # Once the table is full each status class has its own overflow
+        slot.record_latency("spam", "404", 10)
+        slot.record_latency("spam", "500", 10)
+        slot.record_latency("spam", None, 10)
+        slot.record_latency("mount0", "503", 10)
+        histograms = scoreboard.read_scoreboard(board.filename)["histograms"]
+        other = scoreboard.OTHER_MOUNT_POINTS
+        expected = {(other, "2"): scoreboard.MAX_HISTOGRAMS + 10 - num_regular,
+                    (other, "4"): 1, (other, "5"): 2, (other, "-"): 1}
+        def check(histograms):
+            assert len(histograms) == num_regular + len(expected), len(histograms)
+            for key, count in expected.items():
+                assert histograms[key]["count"] == count, (key, histograms[key])
+            assert histograms["mount0", "2"]["count"] == 1
+            assert sum(h["count"] for h in histograms.values()) == scoreboard.MAX_HISTOGRAMS + 14
+        check(histograms)
+        board.release(0)
+        check(scoreboard.read_scoreboard(board.filename)["histograms"])
+        # Another server with room for the pair gives it its own
+        # histogram, which is kept when the server exits
+        slot = board.slot(board.allocate())
+        slot.record_latency("spam", "404", 10)
+        board.release(0)
+        histograms = scoreboard.read_scoreboard(board.filename)["histograms"]
+        assert histograms[other, "4"]["count"] == 1, histograms[other, "4"]
+        assert histograms["spam", "4"]["count"] == 1, histograms["spam", "4"]
+    finally:
+        os.unlink(board.filename)
+
+def test_retired_histograms():
+    # Servers are recycled, each seeing a few of many mount points.
+    # Every mount point keeps its own histogram once its servers exit.
+    fd, filename = tempfile.mkstemp(prefix="akara_scoreboard_")
+    os.close(fd)
+    board = scoreboard.Scoreboard(filename, 2, num_histograms=9)
+    try:
+        num_mounts = 40
+        for i in range(num_mounts):
+            slot = board.slot(board.allocate())
+            slot.record_latency("akara.xslt", "200", 10)
+            slot.record_latency("mount%d" % i, "200", 10)
+            slot.record_latency("mount%d" % i, "500", 10)
+            board.release(slot.index)
+            histograms = scoreboard.read_scoreboard(filename)["histograms"]
+            assert histograms["akara.xslt", "2"]["count"] == i + 1, histograms
+        assert len(histograms) == 1 + 2 * num_mounts, len(histograms)
+        for i in range(num_mounts):
+            assert histograms["mount%d" % i, "2"]["count"] == 1
+            assert histograms["mount%d" % i, "5"]["count"] == 1
+        assert (scoreboard.OTHER_MOUNT_POINTS, "2") not in histograms
+        # A live server's histograms are added to the retired ones
+        slot = board.slot(board.allocate())
+        slot.record_latency("akara.xslt", "200", 10)
+        histograms = scoreboard.read_scoreboard(filename)["histograms"]
+        assert histograms["akara.xslt", "2"]["count"] == num_mounts + 1
+    finally:
+        os.unlink(filename)
+
+def test_quantile():
+    buckets = [0] * scoreboard.NUM_BUCKETS
+    assert scoreboard.quantile(buckets, 0.5) is None
+    buckets[10] = 100   # [1024, 2048)us
+    assert scoreboard.quantile(buckets, 0.5) == 1536.0
+    assert scoreboard.quantile(buckets, 1.0) == 2048.0
+    buckets[20] = 1     # [1048576, 2097152)us
+    assert 1024 <= scoreboard.quantile(buckets, 0.99) < 2048
+    assert scoreboard.quantile(buckets, 0.999) >= 1048576
+
+def test_server_scoreboard():
+    url = server_support.server() + "test_get_call_count"
+    if server_support.config_root is None:
+        # Using an external server
+        return
+    filename = os.path.join(server_support.config_root, "logs", "akara.scoreboard")
+    before = scoreboard.read_scoreboard(filename)
+    for i in range(3):
+        urllib2.urlopen(url).read()
+
+    def total(status):
+        return status["retired_requests"] + sum(slot["requests"] for slot in status["slots"])
+    # The client may get the response before the server updates
+    # its slot. Give it a moment.
+    for i in range(20):
+        after = scoreboard.read_scoreboard(filename)
+        if total(after) >= total(before) + 3:
+            break
+        time.sleep(0.1)
+    assert total(after) >= total(before) + 3, (total(before), total(after))
+
+    pids = [slot["pid"] for slot in after["slots"] if slot["state"] != scoreboard.SLOT_FREE]
+    assert pids, after
+    assert os.getpid() not in pids, pids
+    mount_points = [slot["mount_point"] for slot in after["slots"]]
+    assert "test_get_call_count" in mount_points, mount_points
+
+class _SleepJob(object):
+    def __init__(self, sock, addr):
+        self.sock = sock
+    def run(self):
+        time.sleep(2)
+        self.sock.close()
+
+def test_spawn_when_busy():
+    # When the only spare server takes a connection, it wakes up the
+    # master, which starts another spare right away.
+    import socket, signal
+    from akara.thirdparty import preforkserver
+    board = _make_scoreboard(3)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen(5)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            server = preforkserver.PreforkServer(minSpare=1, maxSpare=1, maxChildren=3,
+                                                 jobClass=_SleepJob, scoreboard=board)
+            server.run(listener)
+        finally:
+            os._exit(0)
+    def states():
+        return [slot["state"] for slot in scoreboard.read_scoreboard(board.filename)["slots"]]
+    def wait_for(condition):
+        t1 = time.time()
+        while not condition(states()):
+            assert time.time() - t1 < 5, states()
+            time.sleep(0.01)
+        return time.time() - t1
+    try:
+        wait_for(lambda s: s.count(scoreboard.SLOT_IDLE) == 1)
+        # Let the master settle into its select()
+        time.sleep(0.1)
+        client = socket.create_connection(listener.getsockname())
+        wait_for(lambda s: scoreboard.SLOT_BUSY in s)
+        elapsed = wait_for(lambda s: (scoreboard.SLOT_BUSY in s and
+                                      s.count(scoreboard.SLOT_FREE) < 2))
+        assert elapsed < 0.5, elapsed
+        client.close()
+    finally:
+        os.kill(pid, signal.SIGTERM)
+        os.waitpid(pid, 0)
+        listener.close()
+        os.unlink(board.filename)
@@ -1,4 +1,5 @@
-from server_support import server
+from server_support import server, httplib_server
+import time
 import urllib2
 from urllib2 import urlopen
 from collections import defaultdict
@@ -68,7 +69,11 @@ def test_404_error_message():
     except urllib2.HTTPError, err:
         assert err.code == 404
         assert err.headers["Content-Type"] == "text/html", err.headers["Content-Type"]
-        tree = amara.parse(err.fp, standalone=True)
+        # Sent in one piece, not chunked
+        assert "Transfer-Encoding" not in err.headers, err.headers
+        body = err.fp.read()
+        assert int(err.headers["Content-Length"]) == len(body), err.headers
+        tree = amara.parse(body, standalone=True)
 
 def test_405_error_message():
     url = server()
@@ -91,8 +96,75 @@ def test_405_error_message_mega(n=100):
     if n / (t2-t1+0.00001) < 2:
         raise AssertionError("Should be able to handle more than 2 failure requests/seconds")
 
+# HTTP/1.1 connections stay open between requests, up to the
+# MaxKeepAliveRequests and MaxRequestsPerServer limits.
+def test_keep_alive():
+    conn = httplib_server()
+    pids = []
+    for i in range(6):
+        conn.request("GET", "/test_get_call_count")
+        r = conn.getresponse()
+        assert r.status == 200, r.status
+        count, pid = r.read().split()
+        assert count in _legal_counts, count
+        pids.append( (pid, r.getheader("connection", "")) )
+    conn.close()
+    # Unless the server said it would close the connection,
+    # the next request must have gone to the same process.
+    for (pid, connection), (next_pid, ignore) in zip(pids, pids[1:]):
+        if connection.lower() != "close":
+            assert pid == next_pid, pids
+    # MaxRequestsPerServer = 5 so there must have been a switch
+    assert len(set(pid for (pid, ignore) in pids)) > 1, pids
+
+# A request body the service doesn't read must not be taken as the
+# next request on the connection.
+def test_keep_alive_unread_body():
+    import socket
+    conn = httplib_server()
+    smuggled = "GET /test_get_call_count HTTP/1.1\r\nHost: localhost\r\n\r\n"
+    sock = socket.create_connection((conn.host, conn.port))
+    sock.sendall("POST / HTTP/1.1\r\nHost: localhost\r\n"
+                 "Content-Length: %d\r\n\r\n%s" % (len(smuggled), smuggled))
+    sock.settimeout(1.0)
+    data = ""
+    try:
+        while True:
+            chunk = sock.recv(8192)
+            if not chunk:
+                break
+            data += chunk
+    except socket.timeout:
+        pass
+    sock.close()
+    assert data.startswith("HTTP/1.1 405 "), data[:100]
+    assert data.count("HTTP/1.1 ") == 1, data
+
+def _requests_per_second(url, n, keep_alive):
+    conn = httplib_server()
+    t1 = time.time()
+    for i in range(n):
+        if keep_alive:
+            conn.request("GET", url)
+        else:
+            conn.request("GET", url, headers={"Connection": "close"})
+        conn.getresponse().read()
+        if not keep_alive:
+            conn.close()
+    t2 = time.time()
+    conn.close()
+    return n / (t2-t1+0.00001)
+
+def benchmark_keep_alive(n=1000, url="/test_echo_simple_get"):
+    for keep_alive in (False, True):
+        print "keep-alive %-5s: %.1f requests/second" % (
+            keep_alive, _requests_per_second(url, n, keep_alive))
+
 if __name__ == "__main__":
+    import server_support
     def server():
         #return "http://192.168.2.101:8880/"
         return "http://localhost:8880/"
+    server_support.server = server
     test_405_error_message_mega(1000)
+    benchmark_keep_alive()
@@ -1,7 +1,10 @@
 import server_support
 from server_support import server, httplib_server
 
+import os
+import time
 import urllib, urllib2
+import hashlib
 from urllib2 import urlopen
 
 import amara
@@ -91,6 +94,117 @@ When the hurlyburly's done,
 When the battle's lost and won.
 """, body
 
+def _generator_data(count):
+    lines = []
+    for i in range(count):
+        lines.append("%d: bytes\n" % (i,))
+        lines.append(u"%d: G\xf6teborg\n".encode("utf8") % (i,))
+        lines.append('<?xml version="1.0" encoding="utf-8"?>\n<item/>\n')
+    return "".join(lines)
+
+def test_generator():
+    conn = httplib_server()
+    conn.request("GET", "/test_generator")
+    response = conn.getresponse()
+    assert response.status == 200, response.status
+    assert response.getheader("Transfer-Encoding") == "chunked"
+    assert response.getheader("Content-Length") is None
+    assert response.read() == _generator_data(3)
+
+    # The connection can be used for another request
+    conn.request("GET", "/test_generator?count=2000")
+    response = conn.getresponse()
+    assert response.getheader("Transfer-Encoding") == "chunked"
+    assert response.read() == _generator_data(2000)
+    conn.close()
+
+def test_generator_http10():
+    # HTTP/1.0 clients don't understand chunks. Close the connection instead.
+    conn = httplib_server()
+    conn._http_vsn = 10
+    conn._http_vsn_str = "HTTP/1.0"
+    conn.request("GET", "/test_generator")
+    response = conn.getresponse()
+    assert response.getheader("Transfer-Encoding") is None
+    assert response.getheader("Connection") == "close"
+    assert response.read() == _generator_data(3)
+    conn.close()
+
+def test_generator_head():
+    conn = httplib_server()
+    conn.request("HEAD", "/test_generator")
+    response = conn.getresponse()
+    assert response.status == 200, response.status
+    assert response.getheader("Transfer-Encoding") is None
+    assert response.read() == ""
+    conn.close()
+
+def _xml_stream_data(count):
+    return ('<?xml version="1.0" encoding="utf-8"?>\n<items>' +
+            "".join(['<item n="%d">G\xc3\xb6teborg</item>' % (i,) for i in range(count)]) +
+            '</items>')
+
+def test_xml_stream():
+    conn = httplib_server()
+    for count in (3, 20000):
+        conn.request("GET", "/test_xml_stream?count=%d" % (count,))
+        response = conn.getresponse()
+        assert response.status == 200, response.status
+        assert response.getheader("Content-Type") == "application/xml"
+        assert response.getheader("Transfer-Encoding") == "chunked"
+        assert response.read() == _xml_stream_data(count)
+    conn.close()
+
+def test_xml_stream_head():
+    conn = httplib_server()
+    conn.request("HEAD", "/test_xml_stream")
+    response = conn.getresponse()
+    assert response.status == 200, response.status
+    assert response.read() == ""
+    # The server must not have sent the body
+    conn.request("GET", "/test_xml_stream?count=1")
+    response = conn.getresponse()
+    assert response.read() == _xml_stream_data(1)
+    conn.close()
+
+def test_route():
+    assert GET("test.route/spam/eggs") == "spam eggs /test.route/spam/eggs "
+    assert GET("test.route/spam/eggs/more/path") == "spam eggs /test.route/spam/eggs /more/path"
+    # A literal segment takes priority
+    assert GET("test.route/spam/index") == "index of spam"
+    assert GET("test.route/spam/index/") == "index of spam"
+
+def test_route_not_found():
+    for path in ("test.route", "test.route/spam", "test.route/spam/"):
+        try:
+            GET(path)
+            raise AssertionError("unexpected success for %r" % (path,))
+        except urllib2.HTTPError, err:
+            assert err.code == 404, (path, err.code)
+
+def _file_data(size, offset):
+    return "".join([chr(i % 251) for i in xrange(size)])[offset:]
+
+def test_file():
+    code, headers, body = GET3("test_file")
+    assert headers["Content-Type"] == "text/plain", headers["Content-Type"]
+    assert headers["Content-Length"] == "100000", headers["Content-Length"]
+    assert body == _file_data(100000, 0)
+
+def test_file_large_with_offset():
+    code, headers, body = GET3("test_file", dict(size=3000000, offset=12345))
+    assert headers["Content-Length"] == str(3000000-12345), headers["Content-Length"]
+    assert body == _file_data(3000000, 12345)
+
+def test_file_head():
+    conn = httplib_server()
+    conn.request("HEAD", "/test_file")
+    response = conn.getresponse()
+    assert response.status == 200, response.status
+    assert response.getheader("Content-Length") == "100000"
+    assert response.read() == ""
+    conn.close()
+
 
 def test_args1():
     body = GET("test_args", dict(a="Andrew"))
@@ -125,6 +239,113 @@ def test_repeated_args3():
     body = GET("test_repeated_args", [("a", "Andrew"), ("b", "Sara Marie"), ("a", "Peter")])
     assert body == "Hello ['Andrew', 'Peter'] and ['Sara Marie']"
 
+def test_args_missing():
+    try:
+        GET("test_args", dict(b="Sara Marie"))
+        raise AssertionError("missing argument should not be allowed!")
+    except urllib2.HTTPError, err:
+        assert err.code == 400
+        s = err.fp.read()
+        assert "The 'a' query parameter is required" in s, s
+
+def test_arg_types():
+    body = GET("test_arg_types", dict(n="3", scale="0.5"))
+    assert body == "3 * 0.5 = 1.5", repr(body)
+    body = GET("test_arg_types", dict(n="3"))
+    assert body == "3 * 1.0 = 3.0", repr(body)
+
+def test_arg_types_bad_value():
+    try:
+        GET("test_arg_types", dict(n="three"))
+        raise AssertionError("bad value should not be allowed!")
+    except urllib2.HTTPError, err:
+        assert err.code == 400
+        s = err.fp.read()
+        assert "Bad value for the 'n' query parameter" in s, s
+
+def test_cache():
+    code, headers, body1 = GET3("test_cache", dict(a="spam"))
+    assert code == 200
+    assert body1.startswith("spam "), repr(body1)
+    assert headers["X-Akara-Test"] == "spam"
+    # 'b' is not part of the key
+    code, headers, body2 = GET3("test_cache", dict(a="spam", b="eggs"))
+    assert body2 == body1, (body1, body2)
+    assert headers["Content-Type"] == "text/plain"
+    assert headers["X-Akara-Test"] == "spam"
+    body3 = GET("test_cache", dict(a="eggs"))
+    assert body3.startswith("eggs "), repr(body3)
+
+def test_conditional():
+    conn = httplib_server()
+    conn.request("GET", "/test_conditional?a=Sweden")
+    response = conn.getresponse()
+    assert response.status == 200, response.status
+    etag = response.getheader("ETag")
+    assert etag == '"%s"' % (hashlib.sha1("Hello Sweden!").hexdigest(),), etag
+    assert response.read() == "Hello Sweden!"
+
+    conn.request("GET", "/test_conditional?a=Sweden", headers={"If-None-Match": etag})
+    response = conn.getresponse()
+    assert response.status == 304, response.status
+    assert response.getheader("ETag") == etag
+    assert response.getheader("Content-Type") is None
+    assert response.read() == ""
+
+    conn.request("GET", "/test_conditional?a=Norway", headers={"If-None-Match": etag})
+    response = conn.getresponse()
+    assert response.status == 200, response.status
+    assert response.read() == "Hello Norway!"
+
+    # An error response is never "not modified"
+    for if_none_match in ("*", '"%s"' % (hashlib.sha1("Nobody here").hexdigest(),)):
+        conn.request("GET", "/test_conditional?a=nobody",
+                     headers={"If-None-Match": if_none_match})
+        response = conn.getresponse()
+        assert response.status == 404, response.status
+        assert response.getheader("ETag") is None, response.getheader("ETag")
+        assert response.read() == "Nobody here"
+
+def test_validator_etag():
+    conn = httplib_server()
+    conn.request("GET", "/test_validator")
+    response = conn.getresponse()
+    assert response.status == 200, response.status
+    assert response.getheader("ETag") == '"v1"'
+    assert response.read() == "The etag version"
+
+    conn.request("GET", "/test_validator", headers={"If-None-Match": 'W/"v1"'})
+    response = conn.getresponse()
+    assert response.status == 304, response.status
+    assert response.read() == ""
+
+def test_validator_last_modified():
+    conn = httplib_server()
+    conn.request("GET", "/test_validator?kind=mtime")
+    response = conn.getresponse()
+    assert response.status == 200, response.status
+    last_modified = response.getheader("Last-Modified")
+    assert last_modified == "Sun, 09 Sep 2001 01:46:40 GMT", last_modified
+    response.read()
+
+    for (if_modified_since, status) in (
+        (last_modified, 304),
+        ("Mon, 10 Sep 2001 00:00:00 GMT", 304),
+        ("Sat, 08 Sep 2001 00:00:00 GMT", 200),
+        ("not a date", 200)):
+        conn.request("GET", "/test_validator?kind=mtime",
+                     headers={"If-Modified-Since": if_modified_since})
+        response = conn.getresponse()
+        assert response.status == status, (if_modified_since, response.status)
+        response.read()
+
+    # If-None-Match takes precedence
+    conn.request("GET", "/test_validator?kind=mtime",
+                 headers={"If-Modified-Since": last_modified, "If-None-Match": '"v1"'})
+    response = conn.getresponse()
+    assert response.status == 200, response.status
+    assert response.read() == "The mtime version"
+
 def test_add_headers():
     code, headers, body = GET3("test_add_headers")
     assert headers["Location"] == "http://freemix.it/"
@@ -224,6 +445,43 @@ def test_echo_simple_post_missing_content_length():
     assert r.status == 411, r.status
     
 
+def test_list_services_etag():
+    conn = httplib_server()
+    conn.request("GET", "/")
+    response = conn.getresponse()
+    assert response.status == 200, response.status
+    assert response.getheader("Content-Type") == "application/xml"
+    etag = response.getheader("ETag")
+    assert etag.startswith('"') and etag.endswith('"'), etag
+    body = response.read()
+    assert "http://purl.org/xml3k/akara/services/registry" in body
+
+    conn.request("GET", "/", headers={"If-None-Match": etag})
+    response = conn.getresponse()
+    assert response.status == 304, response.status
+    assert response.getheader("ETag") == etag
+    assert response.getheader("Content-Type") is None, response.getheader("Content-Type")
+    assert response.read() == ""
+
+    conn.request("GET", "/", headers={"If-None-Match": '"spam", W/' + etag})
+    response = conn.getresponse()
+    assert response.status == 304, response.status
+    response.read()
+
+    conn.request("GET", "/", headers={"If-None-Match": '"spam"'})
+    response = conn.getresponse()
+    assert response.status == 200, response.status
+    assert response.read() == body
+
+    # The filtered listing has its own ETag
+    conn.request("GET", "/?service=http://purl.org/xml3k/akara/services/registry",
+                 headers={"If-None-Match": etag})
+    response = conn.getresponse()
+    assert response.status == 200, response.status
+    assert response.getheader("ETag") != etag
+    assert response.read().count("<service ") == 1
+    conn.close()
+
 def test_service_no_path():
     code, headers, body = GET3("test_service_no_path")
     assert headers["Content-Type"] == "text/plain"
@@ -280,8 +538,9 @@ def test_dispatching_get_with_wrong_arg():
     try:
         GET("test_dispatching_get", [("b", "Sweden")])
     except urllib2.HTTPError, err:
-        # XXX should this be a 400 or 500 error?
-        assert err.code == 500, err.code
+        assert err.code == 400, err.code
+        body = err.read()
+        assert "'b' query parameter is not supported" in body, repr(body)
 
 def test_dispatching_get_with_duplicate_arg():
     try:
@@ -305,11 +564,11 @@ def test_multimethod_get_bad_args():
     try:
         GET("test_multimethod")
     except urllib2.HTTPError, err:
-        assert err.code == 500, err.code
+        assert err.code == 400, err.code
     try:
         GET("test_multimethod", [("qwe", "rty")])
     except urllib2.HTTPError, err:
-        assert err.code == 500, err.code
+        assert err.code == 400, err.code
 
 
 def test_multimethod_post():
@@ -335,7 +594,7 @@ def test_multimethod_post_with_bad_arg():
     try:
         GET3("test_multimethod", [("b", "something")], data="more data")
     except urllib2.HTTPError, err:
-        assert err.code == 500
+        assert err.code == 400
     
 
 def test_multimethod_delete():
@@ -388,6 +647,11 @@ def test_head_vs_get():
     head_body = r.read()
     assert head_body == "", head_body
 
+    # The second request may be the last one the server process takes
+    # on this kept-alive connection, in which case it says so.
+    # "Connection" is hop-by-hop and not part of the resource's headers.
+    get_headers = [(k, v) for (k, v) in get_headers if k != "connection"]
+    head_headers = [(k, v) for (k, v) in head_headers if k != "connection"]
     assert get_headers == head_headers, (get_headers, head_headers)
 
 
@@ -483,3 +747,103 @@ def test_additional_services():
     expected = ("URL: %stest_echo_simple_get?foo=baz\n"
                 "'foo' -> 'baz'\n") % (server_support.SERVER_URI,)
     assert body == expected, (body, expected)
+
+## Test the built-in server status report
+def test_server_status():
+    code, headers, body = GET3("server-status")
+    assert code == 200, code
+    assert headers["Content-Type"] == "application/xml", headers["Content-Type"]
+    tree = amara.parse(body)
+    status = tree.xml_select("/server-status")[0]
+    busy = int(status.xml_attributes[None, u"busy"])
+    idle = int(status.xml_attributes[None, u"idle"])
+    assert busy >= 1, busy  # This request is being served
+    workers = tree.xml_select("/server-status/worker")
+    assert len(workers) == busy + idle, (len(workers), busy, idle)
+    assert int(status.xml_attributes[None, u"total-requests"]) > 0
+    float(status.xml_attributes[None, u"requests-per-second"])
+
+    requests = [worker.xml_select(u"string(.)") for worker in workers
+                if worker.xml_attributes[None, u"state"] == u"W"]
+    assert u"GET /server-status HTTP/1.1" in requests, requests
+
+def test_notify_async():
+    key = "k%d" % (os.getpid(),)
+    body = GET("test_notify_async", dict(key=key))
+    assert body == "Notifying for " + key, repr(body)
+    # An idle server delivers it, within a few seconds
+    for i in range(50):
+        try:
+            recorded = GET("test_notify_received", dict(key=key))
+            break
+        except urllib2.HTTPError, err:
+            assert err.code == 404, err.code
+            time.sleep(0.1)
+    else:
+        raise AssertionError("notification was not delivered")
+    assert recorded == body, (recorded, body)
+
+    body = GET("metrics")
+    assert "# TYPE akara_notify_delivery_seconds summary" in body, body
+    assert 'akara_notify_delivery_seconds_count{path="test_notify_record",status="2xx"} ' in body, body
+    assert 'akara_notify_spool_depth{state="failed"} 0' in body, body
+
+def test_batch():
+    try:
+        import json
+    except ImportError:
+        from amara.thirdparty import json
+    requests = [
+        dict(path="/test_args", query=dict(a="Andrew")),
+        dict(path="test_repeated_args", query=dict(a=["x", "y"])),
+        dict(path="/test_args", query="b=2"),
+        dict(path="/no_such_service"),
+        dict(path="/test_exception"),
+        dict(path="/test_multimethod", method="POST", body=u"G\xf6teborg",
+             content_type="text/plain"),
+        dict(path="/test_args", method="HEAD", query="a=Sara"),
+        dict(path="/test.route/spam/eggs"),
+        dict(path="/batch", method="POST", body="[]"),
+        "not a request",
+        ]
+    code, headers, body = GET3("batch", data=json.dumps(requests))
+    assert code == 200, code
+    assert headers["Content-Type"] == "application/json", headers["Content-Type"]
+    results = json.loads(body)
+    assert len(results) == len(requests), results
+    statuses = [result["status"] for result in results]
+    assert statuses == [200, 200, 400, 404, 500, 200, 200, 200, 400, 400], statuses
+    assert results[0]["body"] == "Hi Andrew and 3", results[0]
+    assert ["Content-Type", "text/plain"] in results[0]["headers"], results[0]
+    assert results[1]["body"] == "Hello ['x', 'y'] and 3", results[1]
+    assert "'a' query parameter is required" in results[2]["body"], results[2]
+    assert results[5]["body"] == (
+        "You sent 9 bytes of 'text/plain' and 'default value'\n"
+        "First few bytes: 'G\\xc3\\xb6teborg'\n"), results[5]
+    assert results[6]["body"] == "", results[6]
+    assert "spam" in results[7]["body"], results[7]
+
+def test_batch_bad_request():
+    for data in ("[", '{"path": "/test_args"}', "[%s]" % ",".join(["{}"] * 1000)):
+        try:
+            GET3("batch", data=data)
+            raise AssertionError("%r was accepted" % (data,))
+        except urllib2.HTTPError, err:
+            assert err.code == 400, err.code
+
+def test_metrics():
+    GET("test_get_call_count")
+    code, headers, body = GET3("metrics")
+    assert code == 200, code
+    assert headers["Content-Type"].startswith("text/plain"), headers["Content-Type"]
+    lines = body.splitlines()
+    assert "# TYPE akara_request_duration_seconds summary" in lines, body
+    labels = 'mount_point="test_get_call_count",status="2xx"'
+    for q in ("0.5", "0.9", "0.99", "0.999"):
+        prefix = 'akara_request_duration_seconds{%s,quantile="%s"} ' % (labels, q)
+        values = [float(line[len(prefix):]) for line in lines if line.startswith(prefix)]
+        assert len(values) == 1, (prefix, body)
+        assert values[0] > 0, values
+    prefix = "akara_request_duration_seconds_count{%s} " % (labels,)
+    counts = [int(line[len(prefix):]) for line in lines if line.startswith(prefix)]
+    assert counts and counts[0] >= 1, (counts, body)